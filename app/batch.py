@@ -0,0 +1,266 @@
+"""
+Пакетная генерация квестов без интерфейса.
+
+Запуск из корня проекта:
+    python -m app.batch examples/ -o quests.jsonl --api-provider groq --model llama-3.1-8b-instant
+    python -m app.batch settings.jsonl -o quests.jsonl --concurrency 8 --scene-count 12
+
+Вход — папка с файлами *.txt (id — имя файла) или JSONL со строками
+{"id": ..., "setting": ..., ...}; в строке можно переопределить параметры генерации
+(scene_count, tone, pacing, narrative_elements, pipeline_mode). Результаты дописываются в выходной
+JSONL по мере готовности; id, уже сгенерированные успешно, при повторном запуске пропускаются,
+а отмененные продолжаются с сохраненной контрольной точки (run_id).
+Ключ API берется из --api-key или переменной PLOTIX_API_KEY; ключи резервных провайдеров
+(--fallback provider:model) и моделей этапов (--stage-model stage=provider:model) — из
+переменных <PROVIDER>_API_KEY.
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set
+
+from dotenv import load_dotenv
+
+from .services.async_bridge import run_sync
+from .services.quest_generator import acreate_quest_from_setting, aresume_quest_run, validate_stage_models
+from .services.run_store import RunNotFoundError, get_run_store
+
+ITEM_PARAMS = ("scene_count", "tone", "pacing", "narrative_elements", "pipeline_mode")
+
+
+def load_inputs(source: Path) -> List[Dict[str, Any]]:
+    """Сеттинги из папки *.txt или из JSONL-файла."""
+    if source.is_dir():
+        return [
+            {"id": path.stem, "setting": path.read_text(encoding="utf-8").strip()}
+            for path in sorted(source.glob("*.txt"))
+        ]
+    items = []
+    with source.open(encoding="utf-8") as f:
+        for line_no, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if not isinstance(item, dict) or not item.get("setting"):
+                raise ValueError(f"{source}:{line_no}: ожидается объект с полем 'setting'")
+            item.setdefault("id", f"line_{line_no}")
+            item["id"] = str(item["id"])
+            items.append(item)
+    return items
+
+
+def _read_records(output: Path) -> List[Dict[str, Any]]:
+    records: List[Dict[str, Any]] = []
+    if not output.exists():
+        return records
+    with output.open(encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # недописанная строка после аварийной остановки
+            if isinstance(record, dict):
+                records.append(record)
+    return records
+
+
+def load_completed_ids(output: Path) -> Set[str]:
+    """id, уже успешно сгенерированные в выходном файле (ошибки при повторном запуске повторяются)."""
+    return {str(record.get("id")) for record in _read_records(output) if record.get("status") == "done"}
+
+
+def load_cancelled_runs(output: Path) -> Dict[str, str]:
+    """id -> run_id для входов, последняя запись которых — отмена: их можно продолжить, а не генерировать заново."""
+    runs: Dict[str, str] = {}
+    for record in _read_records(output):
+        item_id = str(record.get("id"))
+        if record.get("status") == "cancelled" and record.get("run_id"):
+            runs[item_id] = record["run_id"]
+        else:
+            runs.pop(item_id, None)
+    return runs
+
+
+def _percentile(values: List[float], percent: float) -> float:
+    ordered = sorted(values)
+    index = max(0, math.ceil(percent / 100 * len(ordered)) - 1)
+    return ordered[index]
+
+
+def format_stats(latencies: List[float], failed: int, skipped: int, elapsed: float, cancelled: int = 0) -> str:
+    done = len(latencies)
+    lines = [
+        f"Готово: {done}, ошибок: {failed}, отменено: {cancelled}, пропущено: {skipped}, время: {elapsed:.1f} с",
+        f"Пропускная способность: {(done + failed) / elapsed * 60 if elapsed > 0 else 0.0:.2f} квестов/мин",
+    ]
+    if latencies:
+        lines.append(
+            f"Задержка, с: среднее {sum(latencies) / done:.1f}, p50 {_percentile(latencies, 50):.1f}, "
+            f"p95 {_percentile(latencies, 95):.1f}, макс {max(latencies):.1f}"
+        )
+    return "\n".join(lines)
+
+
+def _resumable(run_id: Optional[str]) -> bool:
+    if not run_id:
+        return False
+    try:
+        get_run_store().get(run_id)
+    except RunNotFoundError:
+        return False  # контрольная точка устарела — генерируем заново
+    return True
+
+
+async def _generate_one(
+    item: Dict[str, Any], defaults: Dict[str, Any], api_key: str, use_cache: bool, resume_run_id: Optional[str] = None,
+) -> Dict[str, Any]:
+    params = {**defaults, **{key: item[key] for key in ITEM_PARAMS if key in item}}
+    record: Dict[str, Any] = {"id": item["id"], "status": "error", "error": "Генерация завершилась без результата."}
+    started = time.perf_counter()
+    if _resumable(resume_run_id):
+        record["run_id"] = resume_run_id
+        events = aresume_quest_run(
+            resume_run_id, api_key, params["api_provider"], params["model"], use_cache=use_cache,
+            fallbacks=params.get("fallbacks"), stage_models=params.get("stage_models"),
+            pipeline_mode=params.get("pipeline_mode"),
+        )
+    else:
+        events = acreate_quest_from_setting(
+            item["setting"], api_key, params["api_provider"], params["model"],
+            params["scene_count"], params["tone"], params["pacing"], params["narrative_elements"],
+            use_cache=use_cache, fallbacks=params.get("fallbacks"), stage_models=params.get("stage_models"),
+            pipeline_mode=params.get("pipeline_mode"),
+        )
+    async for line in events:
+        event = json.loads(line)
+        status = event.get("status")
+        if status == "run":
+            record["run_id"] = event.get("run_id")
+        elif status == "done":
+            record.update(status="done", quest=event.get("quest"))
+            record.pop("error", None)
+        elif status in ("error", "cancelled"):
+            # run_id остается в записи: отмененный вход при повторном запуске продолжится с контрольной точки
+            record.update(status=status, error=event.get("message"))
+            if event.get("run_id"):
+                record["run_id"] = event["run_id"]
+    record["seconds"] = round(time.perf_counter() - started, 3)
+    return record
+
+
+async def run_batch(
+    items: List[Dict[str, Any]], output: Path, defaults: Dict[str, Any], api_key: str,
+    concurrency: int, use_cache: bool = True, log=print,
+) -> Dict[str, Any]:
+    """Генерирует квесты не более чем по concurrency одновременно и дописывает их в output."""
+    completed = load_completed_ids(output)
+    cancelled_runs = load_cancelled_runs(output)
+    pending = [item for item in items if item["id"] not in completed]
+    skipped = len(items) - len(pending)
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    latencies: List[float] = []
+    failed = 0
+    cancelled = 0
+
+    async def guarded(item: Dict[str, Any]) -> Dict[str, Any]:
+        resume_run_id = cancelled_runs.get(item["id"])
+        async with semaphore:
+            try:
+                return await _generate_one(item, defaults, api_key, use_cache, resume_run_id)
+            except Exception as e:
+                record = {"id": item["id"], "status": "error", "error": str(e)}
+                if resume_run_id:
+                    record["run_id"] = resume_run_id
+                return record
+
+    started = time.perf_counter()
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with output.open("a", encoding="utf-8") as out:
+        if out.tell() > 0 and not output.read_bytes().endswith(b"\n"):
+            out.write("\n")  # недописанная строка после аварийной остановки не склеится с новой
+        for task in asyncio.as_completed([guarded(item) for item in pending]):
+            record = await task
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+            if record["status"] == "done":
+                latencies.append(record["seconds"])
+            elif record["status"] == "cancelled":
+                cancelled += 1
+            else:
+                failed += 1
+            log(f"[{len(latencies) + failed + cancelled}/{len(pending)}] {record['id']}: {record['status']}"
+                + (f" ({record['error']})" if record["status"] != "done" else f", {record['seconds']:.1f} с"))
+    elapsed = time.perf_counter() - started
+    return {
+        "done": len(latencies), "failed": failed, "cancelled": cancelled, "skipped": skipped,
+        "elapsed": elapsed, "latencies": latencies,
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Пакетная генерация квестов Plotix")
+    parser.add_argument("source", type=Path, help="Папка с *.txt или JSONL с полями id и setting")
+    parser.add_argument("-o", "--output", type=Path, required=True, help="Выходной JSONL (дописывается)")
+    parser.add_argument("--api-provider", required=True, choices=["groq", "openai", "gemini", "vps_proxy", "local"])
+    parser.add_argument("--model", required=True)
+    parser.add_argument("--api-key", default=os.getenv("PLOTIX_API_KEY", ""), help="По умолчанию PLOTIX_API_KEY")
+    parser.add_argument("--concurrency", type=int, default=4, help="Сколько квестов генерируются одновременно")
+    parser.add_argument("--scene-count", type=int, default=8)
+    parser.add_argument("--tone", default="")
+    parser.add_argument("--pacing", default="")
+    parser.add_argument("--narrative-element", action="append", default=[], dest="narrative_elements")
+    parser.add_argument("--mode", choices=["full", "fast"], dest="pipeline_mode",
+                        help="Режим конвейера (по умолчанию PIPELINE_MODE или full)")
+    parser.add_argument("--no-cache", action="store_true", help="Не читать ответы из кэша LLM")
+    parser.add_argument("--fallback", action="append", default=[], metavar="PROVIDER:MODEL",
+                        help="Резервный провайдер (можно несколько, в порядке приоритета)")
+    parser.add_argument("--stage-model", action="append", default=[], metavar="STAGE=PROVIDER:MODEL",
+                        help="Модель для этапа concept/architect/director/writer/corrector (можно несколько)")
+    args = parser.parse_args(argv)
+
+    if not args.api_key and args.api_provider != "local":
+        parser.error("Нужен ключ API: --api-key или PLOTIX_API_KEY")
+    try:
+        items = load_inputs(args.source)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    defaults = {
+        "api_provider": args.api_provider, "model": args.model, "scene_count": args.scene_count,
+        "tone": args.tone, "pacing": args.pacing, "narrative_elements": args.narrative_elements,
+        "pipeline_mode": args.pipeline_mode,
+    }
+    if args.fallback:
+        fallbacks = []
+        for item in args.fallback:
+            provider, _, model = item.partition(":")
+            if not provider or not model:
+                parser.error(f"--fallback ожидает provider:model, получено {item!r}")
+            fallbacks.append({"api_provider": provider, "model": model})
+        defaults["fallbacks"] = fallbacks
+    if args.stage_model:
+        stage_models = {}
+        for item in args.stage_model:
+            stage, _, target = item.partition("=")
+            provider, _, model = target.partition(":")
+            if not stage or not provider or not model:
+                parser.error(f"--stage-model ожидает stage=provider:model, получено {item!r}")
+            stage_models[stage] = {"api_provider": provider, "model": model}
+        route_error = validate_stage_models(args.api_provider, args.api_key, stage_models)
+        if route_error:
+            parser.error(route_error)
+        defaults["stage_models"] = stage_models
+    # Конвейер выполняется в общем фоновом цикле, как и в веб-приложении
+    result = run_sync(run_batch(items, args.output, defaults, args.api_key, args.concurrency, use_cache=not args.no_cache))
+    print(format_stats(result["latencies"], result["failed"], result["skipped"], result["elapsed"], result["cancelled"]))
+    return 1 if result["failed"] or result["cancelled"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
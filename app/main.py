@@ -1,16 +1,27 @@
 import logging
 import os
 
+from typing import Any, Dict, Optional, Tuple
+
 from dotenv import load_dotenv
 from flask import Flask, jsonify, render_template, request, Response, stream_with_context
 
 
 from .models.recommended_models import RECOMMENDED_MODELS
+from .services.circuit_breaker import circuit_breakers
+from .services.job_queue import JobNotFoundError, QueueFullError, get_job_manager
+from .services.llm_cache import get_llm_cache
+from .services.local_workers import get_local_worker_pool
+from .services.run_store import RunNotFoundError, get_run_store
 from .services.quest_generator import (
+    cancel_generation,
+    PIPELINE_MODES,
     create_quest_from_setting,
     delete_local_models,
     get_available_models,
+    resume_quest_run,
     validate_api_key,
+    validate_stage_models,
 )
 
 load_dotenv()
@@ -26,6 +37,19 @@ if __name__ != "__main__":
     app.logger.setLevel(gunicorn_logger.level)
 
 
+def _parse_use_cache(data: Dict[str, Any]) -> Tuple[bool, Optional[str]]:
+    """Флаг use_cache из тела запроса: JSON-логическое значение или строка "true"/"false", "1"/"0", "yes"/"no".
+    Возвращает (значение, текст ошибки)."""
+    value = data.get("use_cache", True)
+    if isinstance(value, bool):
+        return value, None
+    if isinstance(value, str) and value.strip().lower() in ("true", "1", "yes"):
+        return True, None
+    if isinstance(value, str) and value.strip().lower() in ("false", "0", "no"):
+        return False, None
+    return True, f"Некорректное значение use_cache: {value!r}. Ожидается true или false."
+
+
 @app.route("/")
 def index():
     # Передаем флаг в шаблон
@@ -65,12 +89,28 @@ def generate_quest_endpoint():
     tone = data.get("tone", "")
     pacing = data.get("pacing", "")
     narrative_elements = data.get("narrative_elements", [])
+    # use_cache=false — принудительно запросить свежие ответы у LLM (кэш при этом обновится)
+    use_cache, use_cache_error = _parse_use_cache(data)
+    if use_cache_error:
+        return jsonify({"status": "error", "message": use_cache_error}), 400
+    # Резервные провайдеры: [{"api_provider", "model", "api_key"}] или {этап: [...]}
+    fallbacks = data.get("fallbacks")
+    # Модели отдельных этапов: {"architect": {"api_provider", "model", "api_key"?}, ...}
+    stage_models = data.get("stage_models")
+    route_error = validate_stage_models(api_provider, api_key, stage_models)
+    if route_error:
+        return jsonify({"status": "error", "message": route_error}), 400
+    # Режим конвейера: "full" (по умолчанию PIPELINE_MODE) или "fast" — меньше вызовов LLM
+    pipeline_mode = data.get("pipeline_mode")
+    if pipeline_mode is not None and pipeline_mode not in PIPELINE_MODES:
+        return jsonify({"status": "error", "message": f"Неизвестный pipeline_mode: {pipeline_mode}."}), 400
 
     def generate_stream():
         """Оборачивает генератор квестов для потоковой передачи."""
         quest_generator = create_quest_from_setting(
             setting, api_key, api_provider, model,
-            scene_count, tone, pacing, narrative_elements
+            scene_count, tone, pacing, narrative_elements,
+            use_cache=use_cache, fallbacks=fallbacks, stage_models=stage_models, pipeline_mode=pipeline_mode,
         )
         for progress_update in quest_generator:
             yield progress_update + '\n'
@@ -80,6 +120,108 @@ def generate_quest_endpoint():
     return Response(stream_with_context(generate_stream()), mimetype='application/x-ndjson')
 
 
+@app.route("/generate/resume", methods=["POST"])
+def resume_generation():
+    """Продолжает сохраненный запуск генерации (run_id из потока /generate) с последней контрольной точки."""
+    data = request.get_json()
+    if not data or not data.get("run_id") or "api_key" not in data:
+        return jsonify({"error": "Missing 'run_id' or 'api_key'"}), 400
+    use_cache, use_cache_error = _parse_use_cache(data)
+    if use_cache_error:
+        return jsonify({"status": "error", "message": use_cache_error}), 400
+    try:
+        run_params = get_run_store().get(data["run_id"])["params"]
+    except RunNotFoundError:
+        return jsonify({"status": "error", "message": f"Запуск {data['run_id']} не найден или устарел."}), 404
+    # Провайдера, модель и режим конвейера можно сменить; иначе берутся сохраненные в запуске
+    api_provider = data.get("api_provider") or run_params["api_provider"]
+    route_error = validate_stage_models(api_provider, data["api_key"], data.get("stage_models"))
+    if route_error:
+        return jsonify({"status": "error", "message": route_error}), 400
+    pipeline_mode = data.get("pipeline_mode")
+    if pipeline_mode is not None and pipeline_mode not in PIPELINE_MODES:
+        return jsonify({"status": "error", "message": f"Неизвестный pipeline_mode: {pipeline_mode}."}), 400
+
+    def generate_stream():
+        for progress_update in resume_quest_run(
+            data["run_id"], data["api_key"],
+            api_provider=data.get("api_provider"), model=data.get("model"),
+            use_cache=use_cache, fallbacks=data.get("fallbacks"),
+            stage_models=data.get("stage_models"), pipeline_mode=pipeline_mode,
+        ):
+            yield progress_update + '\n'
+
+    return Response(stream_with_context(generate_stream()), mimetype='application/x-ndjson')
+
+
+@app.route("/generate/<run_id>/cancel", methods=["POST"])
+def cancel_generation_endpoint(run_id):
+    """Останавливает генерацию (в том числе фоновое задание) по run_id из события run."""
+    if not cancel_generation(run_id):
+        return jsonify({"status": "error", "message": "Активная генерация с таким run_id не найдена."}), 404
+    return jsonify({"status": "ok"})
+
+
+@app.route("/jobs", methods=["POST"])
+def submit_job():
+    """Ставит генерацию в фоновую очередь; прогресс — через /jobs/<job_id> и /jobs/<job_id>/events."""
+    data = request.get_json()
+    if not data or not all(key in data for key in ("setting", "api_key", "api_provider", "model")):
+        return jsonify({"error": "Missing 'setting', 'api_key', 'api_provider' or 'model' in request body"}), 400
+    use_cache, use_cache_error = _parse_use_cache(data)
+    if use_cache_error:
+        return jsonify({"status": "error", "message": use_cache_error}), 400
+
+    params = {
+        "setting_text": data["setting"],
+        "api_provider": data["api_provider"],
+        "model": data["model"],
+        "scene_count": data.get("scene_count", 8),
+        "tone": data.get("tone", ""),
+        "pacing": data.get("pacing", ""),
+        "narrative_elements": data.get("narrative_elements", []),
+        "use_cache": use_cache,
+        "pipeline_mode": data.get("pipeline_mode"),
+    }
+    if params["pipeline_mode"] is not None and params["pipeline_mode"] not in PIPELINE_MODES:
+        return jsonify({"status": "error", "message": f"Неизвестный pipeline_mode: {params['pipeline_mode']}."}), 400
+    route_error = validate_stage_models(data["api_provider"], data["api_key"], data.get("stage_models"))
+    if route_error:
+        return jsonify({"status": "error", "message": route_error}), 400
+    try:
+        job_id = get_job_manager().submit(
+            params, data["api_key"], fallbacks=data.get("fallbacks"), stage_models=data.get("stage_models"),
+        )
+    except QueueFullError as e:
+        return jsonify({"error": f"Очередь генераций переполнена. {e}"}), 503
+    return jsonify({"job_id": job_id, "status": "queued"}), 202
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    try:
+        return jsonify(get_job_manager().get(job_id))
+    except JobNotFoundError:
+        return jsonify({"error": "Задание не найдено."}), 404
+
+
+@app.route("/jobs/<job_id>/events", methods=["GET"])
+def job_events(job_id):
+    """NDJSON-поток событий задания; ?after=<seq> — продолжить после последнего полученного события."""
+    manager = get_job_manager()
+    try:
+        manager.get(job_id)
+    except JobNotFoundError:
+        return jsonify({"error": "Задание не найдено."}), 404
+    after = request.args.get("after", default=0, type=int)
+
+    def generate_stream():
+        for event in manager.events(job_id, after=after):
+            yield event + '\n'
+
+    return Response(stream_with_context(generate_stream()), mimetype='application/x-ndjson')
+
+
 @app.route("/validate_api_key", methods=["POST"])
 def validate_api_key_endpoint():
     data = request.get_json()
@@ -147,4 +289,29 @@ def delete_local_models_endpoint():
     elif result.get("status") == "partial":
         status_code = 207  # Multi-Status
 
-    return jsonify(result), status_code
\ No newline at end of file
+    return jsonify(result), status_code
+
+
+@app.route("/api/providers/health", methods=["GET"])
+def providers_health():
+    """Состояние автоматов защиты провайдеров (closed / open / half_open) и счетчики ошибок
+    по каждому ключу; вместо ключа — его отпечаток key_id."""
+    return jsonify(circuit_breakers.health())
+
+
+@app.route("/api/local_workers/stats", methods=["GET"])
+def local_workers_stats():
+    """Процессы-исполнители локальной модели: живые, занятые, перезапуски и длина очереди запросов."""
+    pool = get_local_worker_pool()
+    if pool is None:
+        return jsonify({"enabled": False})
+    return jsonify({"enabled": True, **pool.stats()})
+
+
+@app.route("/api/llm_cache/stats", methods=["GET"])
+def llm_cache_stats():
+    """Статистика кэша ответов LLM (размер, попадания, промахи)."""
+    cache = get_llm_cache()
+    if cache is None:
+        return jsonify({"enabled": False})
+    return jsonify({"enabled": True, **cache.stats()})
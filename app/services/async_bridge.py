@@ -0,0 +1,51 @@
+import asyncio
+import threading
+from typing import Any, AsyncIterator, Coroutine, Iterator, Optional, TypeVar
+
+T = TypeVar("T")
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+
+
+def get_background_loop() -> asyncio.AbstractEventLoop:
+    """Возвращает общий для процесса цикл событий, работающий в отдельном потоке.
+
+    Через него синхронный код (Flask, CLI, тесты) выполняет асинхронный конвейер:
+    все генерации процесса делят один поток и один набор HTTP-клиентов.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None or _loop.is_closed():
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name="plotix-async-loop", daemon=True)
+            thread.start()
+            _loop = loop
+        return _loop
+
+
+def run_sync(coro: Coroutine[Any, Any, T], timeout: Optional[float] = None) -> T:
+    """Выполняет корутину в фоновом цикле и блокирует текущий поток до результата."""
+    return asyncio.run_coroutine_threadsafe(coro, get_background_loop()).result(timeout)
+
+
+def iterate_sync(agen: AsyncIterator[T]) -> Iterator[T]:
+    """Адаптер асинхронного генератора к обычному итератору.
+
+    Если потребитель перестал читать (например, клиент закрыл соединение и WSGI-сервер
+    закрыл генератор), асинхронный генератор закрывается в своем цикле — его блоки
+    finally отменяют незавершенные задачи.
+    """
+    loop = get_background_loop()
+    try:
+        while True:
+            future = asyncio.run_coroutine_threadsafe(agen.__anext__(), loop)  # type: ignore[arg-type]
+            try:
+                item = future.result()
+            except StopAsyncIteration:
+                return
+            yield item
+    finally:
+        aclose = getattr(agen, "aclose", None)
+        if aclose is not None:
+            asyncio.run_coroutine_threadsafe(aclose(), loop).result()
@@ -0,0 +1,101 @@
+import asyncio
+import contextvars
+import threading
+from typing import Any, Awaitable, Dict, Optional, Set, TypeVar
+
+T = TypeVar("T")
+
+
+class GenerationCancelled(Exception):
+    """Генерация остановлена пользователем или из-за отключения клиента."""
+
+
+class CancelToken:
+    """Признак отмены одной генерации.
+
+    Конвейер проверяет его между этапами и сценами, а вызовы LLM выполняет через guard():
+    cancel() из любого потока сразу отменяет эти задачи (закрывая HTTP-потоки), а
+    локальная модель видит токен через current_cancel_token и прерывает генерацию токенов.
+    """
+
+    def __init__(self) -> None:
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._tasks: Set["asyncio.Task[Any]"] = set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self) -> None:
+        self._event.set()
+        with self._lock:
+            tasks = list(self._tasks)
+        for task in tasks:
+            task.get_loop().call_soon_threadsafe(task.cancel)
+
+    def raise_if_cancelled(self) -> None:
+        if self._event.is_set():
+            raise GenerationCancelled()
+
+    async def guard(self, awaitable: Awaitable[T]) -> T:
+        """Выполняет awaitable отдельной задачей, которую cancel() может прервать на любом await."""
+        async def run() -> T:
+            current_cancel_token.set(self)  # контекст задачи копируется в asyncio.to_thread
+            return await awaitable
+
+        if self.cancelled:
+            if asyncio.iscoroutine(awaitable):
+                awaitable.close()
+            raise GenerationCancelled()
+        task = asyncio.ensure_future(run())
+        with self._lock:
+            self._tasks.add(task)
+        try:
+            return await task
+        except asyncio.CancelledError:
+            if self.cancelled and task.cancelled():
+                raise GenerationCancelled() from None
+            raise
+        finally:
+            with self._lock:
+                self._tasks.discard(task)
+
+
+# Токен генерации, в рамках которой выполняется текущий вызов LLM (в том числе в потоке llama.cpp)
+current_cancel_token: "contextvars.ContextVar[Optional[CancelToken]]" = contextvars.ContextVar("current_cancel_token", default=None)
+
+
+class CancellationRegistry:
+    """Токены активных генераций по run_id (для /generate/<run_id>/cancel)."""
+
+    def __init__(self) -> None:
+        self._tokens: Dict[str, CancelToken] = {}
+        self._lock = threading.Lock()
+
+    def register(self, run_id: str) -> CancelToken:
+        token = CancelToken()
+        with self._lock:
+            self._tokens[run_id] = token
+        return token
+
+    def unregister(self, run_id: str, token: CancelToken) -> None:
+        with self._lock:
+            if self._tokens.get(run_id) is token:
+                del self._tokens[run_id]
+
+    def cancel(self, run_id: str) -> bool:
+        """Отменяет генерацию. False — такой генерации сейчас нет."""
+        with self._lock:
+            token = self._tokens.get(run_id)
+        if token is None:
+            return False
+        token.cancel()
+        return True
+
+    def clear(self) -> None:
+        with self._lock:
+            self._tokens.clear()
+
+
+cancel_registry = CancellationRegistry()
@@ -0,0 +1,143 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_COOLDOWN_SECONDS = 30.0
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+class CircuitOpenError(RuntimeError):
+    """Провайдер временно отключен автоматом защиты после серии ошибок."""
+
+
+class CircuitBreaker:
+    """Автомат защиты провайдера: closed -> open после failure_threshold ошибок подряд
+    (5xx, 429, сетевые сбои), через cooldown секунд — half_open с одним пробным запросом.
+    Успешный пробный запрос закрывает автомат, неудачный — снова открывает.
+    """
+
+    def __init__(self, failure_threshold: int = DEFAULT_FAILURE_THRESHOLD, cooldown: float = DEFAULT_COOLDOWN_SECONDS):
+        self.failure_threshold = max(1, failure_threshold)
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.total_failures = 0
+        self.total_successes = 0
+        self.last_error: Optional[str] = None
+
+    @property
+    def is_open(self) -> bool:
+        with self._lock:
+            return self.state == OPEN
+
+    def allow(self) -> bool:
+        """Можно ли отправить запрос сейчас. В half_open пропускает один пробный запрос."""
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = HALF_OPEN
+                self.probe_in_flight = False
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and not self.probe_in_flight:
+                self.probe_in_flight = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.total_successes += 1
+            self.consecutive_failures = 0
+            self.probe_in_flight = False
+            self.state = CLOSED
+
+    def record_failure(self, error: str = "") -> None:
+        with self._lock:
+            self.total_failures += 1
+            self.consecutive_failures += 1
+            self.last_error = error or self.last_error
+            self.probe_in_flight = False
+            if self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    logger.warning(f"Автомат защиты открыт после {self.consecutive_failures} ошибок подряд: {error}")
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+    def release_probe(self) -> None:
+        """Пробный запрос завершился без вердикта (например, отменен) — следующий может попробовать снова."""
+        with self._lock:
+            self.probe_in_flight = False
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            retry_in = max(0.0, self.cooldown - (time.monotonic() - self.opened_at)) if self.state == OPEN else 0.0
+            return {
+                "state": self.state,
+                "consecutive_failures": self.consecutive_failures,
+                "retry_in": round(retry_in, 1),
+                "total_failures": self.total_failures,
+                "total_successes": self.total_successes,
+                "last_error": self.last_error,
+            }
+
+
+def key_id(api_key: str) -> str:
+    """Короткий отпечаток ключа API: различает ключи в отчете, не раскрывая их."""
+    if not api_key:
+        return ""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:12]
+
+
+class CircuitBreakerRegistry:
+    """Автоматы защиты по провайдеру и ключу, общие для всех генераций процесса:
+    ключ, упершийся в ошибки (например, в свою квоту), не отключает другие ключи того же провайдера.
+    Сами ключи не хранятся — только их отпечатки.
+    """
+
+    def __init__(self) -> None:
+        self._breakers: Dict[Tuple[str, str], CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    def get(self, api_provider: str, api_key: str = "") -> CircuitBreaker:
+        key = (api_provider, key_id(api_key))
+        with self._lock:
+            breaker = self._breakers.get(key)
+            if breaker is None:
+                try:
+                    threshold = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", str(DEFAULT_FAILURE_THRESHOLD)))
+                    cooldown = float(os.getenv("CIRCUIT_COOLDOWN", str(DEFAULT_COOLDOWN_SECONDS)))
+                except ValueError:
+                    logger.warning("Некорректные CIRCUIT_FAILURE_THRESHOLD/CIRCUIT_COOLDOWN, используются значения по умолчанию.")
+                    threshold, cooldown = DEFAULT_FAILURE_THRESHOLD, DEFAULT_COOLDOWN_SECONDS
+                breaker = CircuitBreaker(threshold, cooldown)
+                self._breakers[key] = breaker
+            return breaker
+
+    def health(self) -> Dict[str, List[Dict[str, Any]]]:
+        """Состояние автоматов по провайдерам: по записи на каждый ключ с его отпечатком key_id."""
+        with self._lock:
+            breakers = dict(self._breakers)
+        report: Dict[str, List[Dict[str, Any]]] = {}
+        for (provider, fingerprint), breaker in breakers.items():
+            report.setdefault(provider, []).append({"key_id": fingerprint, **breaker.snapshot()})
+        return report
+
+    def clear(self) -> None:
+        with self._lock:
+            self._breakers.clear()
+
+
+circuit_breakers = CircuitBreakerRegistry()
+
+
+def get_circuit_breaker(api_provider: str, api_key: str = "") -> CircuitBreaker:
+    return circuit_breakers.get(api_provider, api_key)
@@ -0,0 +1,12 @@
+import os
+from pathlib import Path
+
+# Та же папка данных, что использует десктопное приложение (run_desktop.py)
+DEFAULT_DATA_DIR = Path(__file__).resolve().parents[2] / "plotix_data"
+
+
+def get_data_dir() -> Path:
+    """Папка для локальных данных приложения (PLOTIX_DATA_DIR или plotix_data/ в корне проекта)."""
+    data_dir = Path(os.getenv("PLOTIX_DATA_DIR", str(DEFAULT_DATA_DIR)))
+    data_dir.mkdir(parents=True, exist_ok=True)
+    return data_dir
@@ -0,0 +1,354 @@
+import json
+import logging
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from .data_dir import get_data_dir
+from .quest_generator import create_quest_from_setting
+from .run_store import DEFAULT_RUNS_TTL_DAYS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_JOB_WORKERS = 2
+DEFAULT_JOB_QUEUE_MAX = 100
+# Сколько генераций одного провайдера идут одновременно (переопределяется JOB_CONCURRENCY_<PROVIDER>);
+# для провайдеров вне словаря ограничением служит только число воркеров
+DEFAULT_JOB_PROVIDER_CONCURRENCY = {"local": 1}
+
+ACTIVE_STATUSES = ("queued", "running")
+# События, которые не сохраняются в базе: черновики текста сцен нужны только подключенным клиентам
+TRANSIENT_EVENTS = {"scene_delta"}
+
+_JOB_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+Runner = Callable[..., Iterator[str]]
+
+
+class JobNotFoundError(KeyError):
+    pass
+
+
+class QueueFullError(RuntimeError):
+    pass
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    if not value:
+        return default
+    try:
+        return max(1, int(value))
+    except ValueError:
+        logger.warning(f"Некорректное значение {name}: {value}")
+        return default
+
+
+def get_job_provider_concurrency(api_provider: str) -> Optional[int]:
+    env_value = os.getenv(f"JOB_CONCURRENCY_{api_provider.upper()}")
+    if env_value:
+        try:
+            return max(1, int(env_value))
+        except ValueError:
+            logger.warning(f"Некорректное значение JOB_CONCURRENCY_{api_provider.upper()}: {env_value}")
+    return DEFAULT_JOB_PROVIDER_CONCURRENCY.get(api_provider)
+
+
+class JobManager:
+    """Очередь генераций в SQLite и пул потоков-воркеров.
+
+    Задание переживает обрыв HTTP-соединения: события прогресса сохраняются в базе
+    (кроме scene_delta), и клиент может подключиться к ним заново с любого номера.
+    API-ключи хранятся только в памяти процесса, поэтому после перезапуска сервера
+    незавершенные задания получают статус interrupted (их run_id можно продолжить
+    через /generate/resume).
+    """
+
+    def __init__(
+        self, db_path: Path, workers: Optional[int] = None, max_queued: Optional[int] = None,
+        runner: Optional[Runner] = None,
+    ):
+        self.db_path = Path(db_path)
+        self.workers = workers if workers is not None else _env_int("JOB_WORKERS", DEFAULT_JOB_WORKERS)
+        self.max_queued = max_queued if max_queued is not None else _env_int("JOB_QUEUE_MAX", DEFAULT_JOB_QUEUE_MAX)
+        self.runner: Runner = runner or create_quest_from_setting
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        # Ключи API (основной и резервных провайдеров) — только в памяти: job_id -> аргументы
+        self._secrets: Dict[str, Dict[str, Any]] = {}
+        self._running_by_provider: Dict[str, int] = {}
+        # Подписчики на живые события: job_id -> очереди (seq, строка события)
+        self._listeners: Dict[str, List["queue.Queue[Tuple[int, Optional[str]]]"]] = {}
+        self._threads: List[threading.Thread] = []
+        self._stopping = False
+
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " job_id TEXT PRIMARY KEY, status TEXT NOT NULL, api_provider TEXT NOT NULL, params TEXT NOT NULL,"
+            " run_id TEXT, progress TEXT NOT NULL, error TEXT, event_count INTEGER NOT NULL DEFAULT 0,"
+            " created_at REAL NOT NULL, started_at REAL, finished_at REAL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS job_events ("
+            " job_id TEXT NOT NULL, seq INTEGER NOT NULL, event TEXT NOT NULL, PRIMARY KEY (job_id, seq))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+        # Ключи API прежнего процесса потеряны: незавершенные задания продолжить нельзя
+        self._conn.execute(
+            "UPDATE jobs SET status = 'interrupted', error = ?, finished_at = ? WHERE status IN ('queued', 'running')",
+            ("Сервер был перезапущен до завершения задания.", time.time()),
+        )
+        self._conn.commit()
+
+    # --- Отправка и состояние ---
+
+    def submit(
+        self, params: Dict[str, Any], api_key: str, fallbacks: Optional[Any] = None, stage_models: Optional[Any] = None,
+    ) -> str:
+        """Ставит генерацию в очередь. params — аргументы create_quest_from_setting без ключей API;
+        fallbacks и stage_models могут содержать ключи и хранятся только в памяти."""
+        self.cleanup()
+        job_id = uuid.uuid4().hex
+        with self._wakeup:
+            queued = self._conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+            if queued >= self.max_queued:
+                raise QueueFullError(f"В очереди уже {queued} заданий.")
+            self._conn.execute(
+                "INSERT INTO jobs (job_id, status, api_provider, params, progress, created_at) VALUES (?, 'queued', ?, ?, ?, ?)",
+                (job_id, params["api_provider"], json.dumps(params, ensure_ascii=False), json.dumps({}), time.time()),
+            )
+            self._conn.commit()
+            self._secrets[job_id] = {"api_key": api_key, "fallbacks": fallbacks, "stage_models": stage_models}
+            self._ensure_workers()
+            self._wakeup.notify_all()
+        return job_id
+
+    def get(self, job_id: str) -> Dict[str, Any]:
+        if not _JOB_ID_RE.match(job_id or ""):
+            raise JobNotFoundError(job_id)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT status, api_provider, params, run_id, progress, error, event_count, created_at, started_at, finished_at"
+                " FROM jobs WHERE job_id = ?", (job_id,),
+            ).fetchone()
+            if row is None:
+                raise JobNotFoundError(job_id)
+            status, api_provider, params, run_id, progress, error, event_count, created_at, started_at, finished_at = row
+            position = None
+            if status == "queued":
+                position = self._conn.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND created_at < ?", (created_at,)
+                ).fetchone()[0]
+        return {
+            "job_id": job_id,
+            "status": status,
+            "api_provider": api_provider,
+            "model": json.loads(params).get("model"),
+            "run_id": run_id,
+            "queue_position": position,
+            "progress": json.loads(progress),
+            "error": error,
+            "events": event_count,
+            "created_at": created_at,
+            "started_at": started_at,
+            "finished_at": finished_at,
+        }
+
+    def events(self, job_id: str, after: int = 0, timeout: Optional[float] = None) -> Iterator[str]:
+        """События задания начиная с номера after + 1, затем живые события до завершения.
+
+        Сохраненные события получают поле seq: клиент, потерявший соединение, переподключается
+        с after = последний полученный seq. scene_delta приходят без seq и только вживую.
+        timeout — сколько ждать следующего события, прежде чем отключить клиента.
+        """
+        self.get(job_id)
+        listener: "queue.Queue[Tuple[int, Optional[str]]]" = queue.Queue()
+        with self._lock:
+            self._listeners.setdefault(job_id, []).append(listener)
+        try:
+            last_seq = after
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT seq, event FROM job_events WHERE job_id = ? AND seq > ? ORDER BY seq", (job_id, after)
+                ).fetchall()
+                finished = self._conn.execute("SELECT status FROM jobs WHERE job_id = ?", (job_id,)).fetchone()[0] not in ACTIVE_STATUSES
+            for seq, event in rows:
+                last_seq = seq
+                yield event
+            if finished:
+                return
+            while True:
+                try:
+                    seq, event = listener.get(timeout=timeout)
+                except queue.Empty:
+                    return
+                if event is None:  # задание завершено
+                    return
+                if seq > last_seq:
+                    last_seq = seq
+                    yield event
+                elif seq == last_seq and not event.startswith('{"seq"'):
+                    # черновик после уже отданного события; более ранние черновики устарели
+                    yield event
+        finally:
+            with self._lock:
+                listeners = self._listeners.get(job_id, [])
+                if listener in listeners:
+                    listeners.remove(listener)
+                if not listeners:
+                    self._listeners.pop(job_id, None)
+
+    def cleanup(self, max_age_seconds: Optional[float] = None) -> int:
+        """Удаляет завершенные задания старше RUNS_TTL_DAYS вместе с их событиями."""
+        if max_age_seconds is None:
+            try:
+                max_age_seconds = float(os.getenv("RUNS_TTL_DAYS", str(DEFAULT_RUNS_TTL_DAYS))) * 86400
+            except ValueError:
+                max_age_seconds = DEFAULT_RUNS_TTL_DAYS * 86400
+        threshold = time.time() - max_age_seconds
+        with self._lock:
+            stale = [row[0] for row in self._conn.execute(
+                "SELECT job_id FROM jobs WHERE status NOT IN ('queued', 'running') AND finished_at < ?", (threshold,)
+            )]
+            self._conn.executemany("DELETE FROM job_events WHERE job_id = ?", [(job_id,) for job_id in stale])
+            self._conn.executemany("DELETE FROM jobs WHERE job_id = ?", [(job_id,) for job_id in stale])
+            self._conn.commit()
+        return len(stale)
+
+    def shutdown(self, timeout: Optional[float] = None) -> None:
+        """Останавливает воркеры после текущих заданий (очередь в базе остается)."""
+        with self._wakeup:
+            self._stopping = True
+            self._wakeup.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        if not any(thread.is_alive() for thread in self._threads):
+            with self._lock:
+                self._conn.close()
+
+    # --- Воркеры ---
+
+    def _ensure_workers(self) -> None:
+        self._threads = [thread for thread in self._threads if thread.is_alive()]
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._worker_loop, name=f"plotix-job-worker-{len(self._threads)}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _claim_next(self) -> Optional[Tuple[str, Dict[str, Any], Dict[str, Any]]]:
+        """Старейшее задание, для провайдера которого есть свободное место. Вызывается под _lock."""
+        for job_id, api_provider, params in self._conn.execute(
+            "SELECT job_id, api_provider, params FROM jobs WHERE status = 'queued' ORDER BY created_at"
+        ).fetchall():
+            limit = get_job_provider_concurrency(api_provider)
+            if limit is not None and self._running_by_provider.get(api_provider, 0) >= limit:
+                continue
+            self._conn.execute("UPDATE jobs SET status = 'running', started_at = ? WHERE job_id = ?", (time.time(), job_id))
+            self._conn.commit()
+            self._running_by_provider[api_provider] = self._running_by_provider.get(api_provider, 0) + 1
+            return job_id, json.loads(params), self._secrets.pop(job_id, {"api_key": ""})
+        return None
+
+    def _worker_loop(self) -> None:
+        while True:
+            with self._wakeup:
+                claimed = None
+                while not self._stopping:
+                    claimed = self._claim_next()
+                    if claimed:
+                        break
+                    self._wakeup.wait()
+                if self._stopping:
+                    return
+            job_id, params, secrets = claimed
+            try:
+                self._run_job(job_id, params, secrets)
+            finally:
+                with self._wakeup:
+                    provider = params["api_provider"]
+                    self._running_by_provider[provider] = max(0, self._running_by_provider.get(provider, 1) - 1)
+                    self._wakeup.notify_all()
+
+    def _run_job(self, job_id: str, params: Dict[str, Any], secrets: Dict[str, Any]) -> None:
+        seq = 0
+        progress: Dict[str, Any] = {}
+        run_id: Optional[str] = None
+        final_status, error = "failed", "Генерация завершилась без результата."
+        try:
+            extra = {key: secrets[key] for key in ("fallbacks", "stage_models") if secrets.get(key) is not None}
+            for line in self.runner(api_key=secrets["api_key"], **params, **extra):
+                event = json.loads(line)
+                status = event.get("status")
+                if status in TRANSIENT_EVENTS:
+                    self._publish(job_id, seq, line)
+                    continue
+                seq += 1
+                line = f'{{"seq": {seq}, {line[1:]}' if line.startswith("{") and line != "{}" else line
+                if status == "run":
+                    run_id = event.get("run_id")
+                elif status == "skeleton":
+                    progress["scenes_total"] = len(event.get("quest", {}).get("scenes", []))
+                    progress["scenes_ready"] = 0
+                elif status == "scene_ready":
+                    progress["scenes_ready"] = progress.get("scenes_ready", 0) + 1
+                elif status == "done":
+                    final_status, error = "done", None
+                elif status == "error":
+                    final_status, error = "failed", event.get("message")
+                elif status == "cancelled":
+                    final_status, error = "cancelled", event.get("message")
+                if event.get("message"):
+                    progress.update(stage=status, message=event["message"])
+                with self._lock:
+                    self._conn.execute("INSERT INTO job_events (job_id, seq, event) VALUES (?, ?, ?)", (job_id, seq, line))
+                    self._conn.execute(
+                        "UPDATE jobs SET run_id = ?, progress = ?, event_count = ? WHERE job_id = ?",
+                        (run_id, json.dumps(progress, ensure_ascii=False), seq, job_id),
+                    )
+                    self._conn.commit()
+                self._publish(job_id, seq, line)
+        except Exception as e:
+            logger.error(f"Задание {job_id} завершилось с ошибкой: {e}", exc_info=True)
+            final_status, error = "failed", f"Произошла ошибка на сервере: {e}"
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE job_id = ?",
+                (final_status, error, time.time(), job_id),
+            )
+            self._conn.commit()
+        self._publish(job_id, seq, None)
+
+    def _publish(self, job_id: str, seq: int, line: Optional[str]) -> None:
+        with self._lock:
+            listeners = list(self._listeners.get(job_id, []))
+        for listener in listeners:
+            listener.put((seq, line))
+
+
+_manager: Optional[JobManager] = None
+_manager_lock = threading.Lock()
+
+
+def get_job_manager() -> JobManager:
+    """Общий на процесс менеджер заданий (база в plotix_data/jobs.sqlite3)."""
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = JobManager(get_data_dir() / "jobs.sqlite3")
+        return _manager
+
+
+def reset_job_manager() -> None:
+    """Останавливает воркеры и забывает текущий менеджер (тесты, смена настроек)."""
+    global _manager
+    with _manager_lock:
+        if _manager is not None:
+            _manager.shutdown(timeout=5)
+        _manager = None
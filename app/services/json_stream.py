@@ -0,0 +1,80 @@
+import re
+
+_SIMPLE_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+
+class JsonStringFieldStreamer:
+    """Извлекает значение строкового поля из JSON, который приходит по кускам.
+
+    Нужен для потоковой генерации: модель пишет {"text": "...", ...} токен за
+    токеном, а пользователю показываем только уже декодированный текст сцены.
+    Экранирование (включая \\uXXXX и суррогатные пары), разрезанное между
+    кусками, дожидается следующего куска.
+    """
+
+    def __init__(self, field: str):
+        self._start_re = re.compile(r'"%s"\s*:\s*"' % re.escape(field))
+        self._buffer = ""
+        self.started = False
+        self.finished = False
+
+    def feed(self, chunk: str) -> str:
+        """Добавляет кусок ответа и возвращает новый декодированный фрагмент значения."""
+        if self.finished or not chunk:
+            return ""
+        self._buffer += chunk
+        if not self.started:
+            match = self._start_re.search(self._buffer)
+            if match is None:
+                return ""
+            self.started = True
+            self._buffer = self._buffer[match.end():]
+
+        buf, i, n = self._buffer, 0, len(self._buffer)
+        out = []
+        while i < n:
+            ch = buf[i]
+            if ch == '"':
+                self.finished = True
+                i += 1
+                break
+            if ch != "\\":
+                j = i
+                while j < n and buf[j] not in '"\\':
+                    j += 1
+                out.append(buf[i:j])
+                i = j
+                continue
+            if i + 1 >= n:
+                break  # обратный слэш в конце куска — ждем продолжения
+            if buf[i + 1] != "u":
+                out.append(_SIMPLE_ESCAPES.get(buf[i + 1], buf[i + 1]))
+                i += 2
+                continue
+            if i + 6 > n:
+                break
+            try:
+                code = int(buf[i + 2:i + 6], 16)
+            except ValueError:
+                out.append(buf[i + 1])
+                i += 2
+                continue
+            if 0xD800 <= code < 0xDC00:
+                if i + 12 > n:
+                    break
+                if buf[i + 6:i + 8] == "\\u":
+                    try:
+                        low = int(buf[i + 8:i + 12], 16)
+                    except ValueError:
+                        low = 0
+                    if 0xDC00 <= low < 0xE000:
+                        out.append(chr(0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00)))
+                        i += 12
+                        continue
+                out.append("�")
+                i += 6
+                continue
+            out.append(chr(code))
+            i += 6
+        self._buffer = "" if self.finished else buf[i:]
+        return "".join(out)
@@ -0,0 +1,207 @@
+import asyncio
+import logging
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+import google.generativeai as genai
+from google.generativeai import client as genai_client
+import httpx
+import openai
+import requests
+from groq import AsyncGroq, Groq
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# Ключ клиента: (провайдер, api_key, base_url)
+ClientKey = Tuple[str, str, Optional[str]]
+
+MAX_CACHED_CLIENTS = 64
+HTTP_POOL_MAXSIZE = 16
+
+
+def _isolated_client_manager(api_key: str) -> Optional[Any]:
+    """Менеджер клиентов SDK только для этого ключа.
+
+    Опирается на внутренности google-generativeai 0.8.x (версия закреплена в requirements.txt);
+    если их нет, возвращает None, и сессия откатывается на глобальный genai.configure.
+    """
+    manager_cls = getattr(genai_client, "_ClientManager", None)
+    if manager_cls is None:
+        return None
+    manager = manager_cls()
+    if not (callable(getattr(manager, "configure", None)) and callable(getattr(manager, "get_default_client", None))):
+        return None
+    manager.configure(api_key=api_key)
+    return manager
+
+
+_global_configure_lock = threading.Lock()
+
+
+class GeminiSession:
+    """Клиенты Gemini, изолированные для одного API-ключа.
+
+    `genai.configure` меняет глобальное состояние SDK, поэтому одновременные
+    запросы с разными ключами могут перепутать их. Здесь у каждого ключа свой
+    менеджер клиентов, а глобальная конфигурация не трогается.
+    """
+
+    def __init__(self, api_key: str):
+        self._api_key = api_key
+        self._manager = _isolated_client_manager(api_key)
+        if self._manager is None:
+            logger.warning("Установленная версия google-generativeai не поддерживает отдельные клиенты для ключей: используется genai.configure.")
+        self._models: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def _configure_globally(self) -> None:
+        # Запасной путь при несовместимом SDK: одновременные запросы с разными ключами могут перепутать их
+        with _global_configure_lock:
+            genai.configure(api_key=self._api_key)
+
+    def _new_model(self, model_name: str, client_attr: str, client_name: str) -> Any:
+        gemini_model = genai.GenerativeModel(model_name)
+        if self._manager is not None and hasattr(gemini_model, client_attr):
+            setattr(gemini_model, client_attr, self._manager.get_default_client(client_name))
+        else:
+            self._configure_globally()
+        return gemini_model
+
+    def generative_model(self, model_name: str) -> Any:
+        with self._lock:
+            gemini_model = self._models.get(model_name)
+            if gemini_model is None:
+                gemini_model = self._models[model_name] = self._new_model(model_name, "_client", "generative")
+            return gemini_model
+
+    def async_generative_model(self, model_name: str) -> Any:
+        """Модель для generate_content_async; асинхронный gRPC-клиент привязан к текущему циклу."""
+        with self._lock:
+            cache_key = f"async:{model_name}"
+            gemini_model = self._models.get(cache_key)
+            if gemini_model is None:
+                gemini_model = self._models[cache_key] = self._new_model(model_name, "_async_client", "generative_async")
+            return gemini_model
+
+    def list_models(self) -> Any:
+        if self._manager is None:
+            self._configure_globally()
+            return genai.list_models()
+        return genai.list_models(client=self._manager.get_default_client("model"))
+
+
+def _make_http_session() -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_MAXSIZE)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class ClientPool:
+    """Кэш клиентов провайдеров с переиспользованием HTTP-соединений (keep-alive).
+
+    Клиенты Groq/OpenAI держат собственный пул соединений httpx, поэтому их
+    достаточно создавать один раз на ключ. Кэш ограничен по размеру (LRU).
+    """
+
+    def __init__(self, max_size: int = MAX_CACHED_CLIENTS):
+        self.max_size = max_size
+        self._clients: "OrderedDict[ClientKey, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, api_provider: str, api_key: str = "", base_url: Optional[str] = None) -> Any:
+        with self._lock:
+            return self._get_or_create(self._clients, api_provider, api_key, base_url)
+
+    def _get_or_create(
+        self, clients: "OrderedDict[ClientKey, Any]", api_provider: str, api_key: str, base_url: Optional[str]
+    ) -> Any:
+        key: ClientKey = (api_provider, api_key or "", base_url)
+        client = clients.get(key)
+        if client is not None:
+            clients.move_to_end(key)
+            self.hits += 1
+            return client
+        self.misses += 1
+        client = self._create(api_provider, api_key, base_url)
+        clients[key] = client
+        while len(clients) > self.max_size:
+            # Вытесненный клиент не закрываем явно: им может еще пользоваться другой поток.
+            clients.popitem(last=False)
+        return client
+
+    @staticmethod
+    def _create(api_provider: str, api_key: str, base_url: Optional[str]) -> Any:
+        if api_provider == "groq":
+            return Groq(api_key=api_key, base_url=base_url) if base_url else Groq(api_key=api_key)
+        if api_provider == "openai":
+            return openai.OpenAI(api_key=api_key, base_url=base_url) if base_url else openai.OpenAI(api_key=api_key)
+        if api_provider == "gemini":
+            return GeminiSession(api_key)
+        if api_provider == "vps_proxy":
+            return _make_http_session()
+        raise ValueError(f"Unknown API provider: {api_provider}")
+
+    def clear(self) -> None:
+        with self._lock:
+            self._clients.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+class AsyncClientPool(ClientPool):
+    """Кэш асинхронных клиентов провайдеров.
+
+    Асинхронные HTTP/gRPC-соединения привязаны к циклу событий, поэтому у
+    каждого цикла свой набор клиентов; он освобождается вместе с циклом.
+    """
+
+    def __init__(self, max_size: int = MAX_CACHED_CLIENTS):
+        super().__init__(max_size)
+        self._per_loop: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, OrderedDict[ClientKey, Any]]" = weakref.WeakKeyDictionary()
+
+    def get(self, api_provider: str, api_key: str = "", base_url: Optional[str] = None) -> Any:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            clients = self._per_loop.get(loop)
+            if clients is None:
+                clients = self._per_loop[loop] = OrderedDict()
+            return self._get_or_create(clients, api_provider, api_key, base_url)
+
+    @staticmethod
+    def _create(api_provider: str, api_key: str, base_url: Optional[str]) -> Any:
+        if api_provider == "groq":
+            return AsyncGroq(api_key=api_key, base_url=base_url) if base_url else AsyncGroq(api_key=api_key)
+        if api_provider == "openai":
+            return openai.AsyncOpenAI(api_key=api_key, base_url=base_url) if base_url else openai.AsyncOpenAI(api_key=api_key)
+        if api_provider == "gemini":
+            return GeminiSession(api_key)
+        if api_provider == "vps_proxy":
+            return httpx.AsyncClient(limits=httpx.Limits(max_keepalive_connections=HTTP_POOL_MAXSIZE), timeout=120)
+        raise ValueError(f"Unknown API provider: {api_provider}")
+
+    def clear(self) -> None:
+        with self._lock:
+            self._per_loop.clear()
+        super().clear()
+
+
+# Единые пулы на процесс
+client_pool = ClientPool()
+async_client_pool = AsyncClientPool()
+
+
+def get_client(api_provider: str, api_key: str = "", base_url: Optional[str] = None) -> Any:
+    """Возвращает закэшированный клиент провайдера (создает при первом обращении)."""
+    return client_pool.get(api_provider, api_key, base_url)
+
+
+def get_async_client(api_provider: str, api_key: str = "", base_url: Optional[str] = None) -> Any:
+    """Асинхронный вариант get_client для текущего цикла событий."""
+    return async_client_pool.get(api_provider, api_key, base_url)
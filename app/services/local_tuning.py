@@ -0,0 +1,439 @@
+import json
+import logging
+import os
+import struct
+import threading
+import time
+from pathlib import Path
+from typing import Any, BinaryIO, Callable, Dict, NamedTuple, Optional, Tuple
+
+from .data_dir import get_data_dir
+from .token_budget import LOCAL_N_CTX
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None  # type: ignore[assignment]
+
+logger = logging.getLogger(__name__)
+
+# Параметры llama.cpp, которые подбирает тюнер
+TUNING_PARAMS = ("n_ctx", "n_threads", "n_threads_batch", "n_batch", "n_gpu_layers", "use_mmap", "use_mlock")
+
+# Переопределения параметров переменными окружения (сильнее подобранных и заданных в файле)
+ENV_OVERRIDES: Dict[str, Tuple[str, type]] = {
+    "n_ctx": ("LOCAL_N_CTX", int),
+    "n_threads": ("LOCAL_N_THREADS", int),
+    "n_threads_batch": ("LOCAL_N_THREADS_BATCH", int),
+    "n_batch": ("LOCAL_N_BATCH", int),
+    "n_gpu_layers": ("LOCAL_N_GPU_LAYERS", int),
+    "use_mmap": ("LOCAL_USE_MMAP", bool),
+    "use_mlock": ("LOCAL_USE_MLOCK", bool),
+}
+
+# Контекст не уменьшается ниже MIN_N_CTX, даже если памяти мало
+MIN_N_CTX = 2048
+DEFAULT_N_BATCH = 512
+
+# Доля памяти, которую модель может закрепить через mlock (как бюджет RAM в model_registry)
+MLOCK_RAM_SHARE = 0.7
+
+
+# --- Заголовок GGUF ---
+
+GGUF_MAGIC = b"GGUF"
+_SCALAR_FORMATS = {0: "<B", 1: "<b", 2: "<H", 3: "<h", 4: "<I", 5: "<i", 6: "<f", 7: "<?", 10: "<Q", 11: "<q", 12: "<d"}
+_GGUF_STRING, _GGUF_ARRAY = 8, 9
+
+
+class GGUFError(ValueError):
+    """Файл не является моделью GGUF или его заголовок поврежден."""
+
+
+def _unpack(f: BinaryIO, fmt: str) -> Tuple[Any, ...]:
+    size = struct.calcsize(fmt)
+    data = f.read(size)
+    if len(data) < size:
+        raise GGUFError("Заголовок GGUF оборван.")
+    return struct.unpack(fmt, data)
+
+
+def _read_string(f: BinaryIO) -> str:
+    (length,) = _unpack(f, "<Q")
+    data = f.read(length)
+    if len(data) < length:
+        raise GGUFError("Заголовок GGUF оборван.")
+    return data.decode("utf-8", errors="replace")
+
+
+def _skip_value(f: BinaryIO, value_type: int) -> None:
+    if value_type in _SCALAR_FORMATS:
+        f.seek(struct.calcsize(_SCALAR_FORMATS[value_type]), os.SEEK_CUR)
+    elif value_type == _GGUF_STRING:
+        (length,) = _unpack(f, "<Q")
+        f.seek(length, os.SEEK_CUR)
+    elif value_type == _GGUF_ARRAY:
+        item_type, count = _unpack(f, "<IQ")
+        if item_type in _SCALAR_FORMATS:
+            f.seek(struct.calcsize(_SCALAR_FORMATS[item_type]) * count, os.SEEK_CUR)
+        else:
+            for _ in range(count):
+                _skip_value(f, item_type)
+    else:
+        raise GGUFError(f"Неизвестный тип значения GGUF: {value_type}")
+
+
+def read_gguf_metadata(path: str) -> Dict[str, Any]:
+    """Метаданные из заголовка GGUF (версии 2 и 3). Массивы (словарь токенизатора и т.п.)
+    пропускаются без чтения в память — в результат попадают только скалярные значения и строки."""
+    metadata: Dict[str, Any] = {}
+    with open(path, "rb") as f:
+        if f.read(4) != GGUF_MAGIC:
+            raise GGUFError(f"{path} не является файлом GGUF.")
+        (version,) = _unpack(f, "<I")
+        if version < 2:
+            raise GGUFError(f"Версия GGUF {version} не поддерживается.")
+        _tensor_count, kv_count = _unpack(f, "<QQ")
+        for _ in range(kv_count):
+            key = _read_string(f)
+            (value_type,) = _unpack(f, "<I")
+            if value_type in _SCALAR_FORMATS:
+                metadata[key] = _unpack(f, _SCALAR_FORMATS[value_type])[0]
+            elif value_type == _GGUF_STRING:
+                metadata[key] = _read_string(f)
+            else:
+                _skip_value(f, value_type)
+    return metadata
+
+
+class ModelInfo(NamedTuple):
+    """То, что тюнеру нужно знать о модели: размер файла и форма KV-кэша."""
+
+    file_size: int
+    context_length: Optional[int] = None
+    block_count: Optional[int] = None
+    embedding_length: Optional[int] = None
+    head_count: Optional[int] = None
+    head_count_kv: Optional[int] = None
+
+
+def read_model_info(path: str) -> ModelInfo:
+    """Сведения о модели из заголовка GGUF; если он не читается — только размер файла."""
+    file_size = os.path.getsize(path)
+    try:
+        metadata = read_gguf_metadata(path)
+    except (OSError, GGUFError) as e:
+        logger.warning(f"Не удалось прочитать метаданные GGUF {path}: {e}")
+        return ModelInfo(file_size)
+    arch = metadata.get("general.architecture", "llama")
+    head_count = metadata.get(f"{arch}.attention.head_count")
+    return ModelInfo(
+        file_size,
+        metadata.get(f"{arch}.context_length"),
+        metadata.get(f"{arch}.block_count"),
+        metadata.get(f"{arch}.embedding_length"),
+        head_count,
+        metadata.get(f"{arch}.attention.head_count_kv", head_count),
+    )
+
+
+def kv_cache_bytes(info: ModelInfo, n_ctx: int) -> int:
+    """Размер KV-кэша в f16 для n_ctx токенов (0, если форма модели неизвестна)."""
+    if not (info.block_count and info.embedding_length and info.head_count and info.head_count_kv):
+        return 0
+    kv_width = info.embedding_length * info.head_count_kv // info.head_count
+    return 2 * info.block_count * n_ctx * kv_width * 2
+
+
+# --- Железо ---
+
+class HardwareInfo(NamedTuple):
+    logical_cpus: int
+    physical_cores: int
+    total_ram: Optional[int]
+    available_ram: Optional[int]
+    gpu_offload: bool
+
+
+def _physical_cores(logical_cpus: int) -> int:
+    """Число физических ядер по /proc/cpuinfo (Linux), не больше доступных процессу CPU."""
+    cores = set()
+    physical_id = "0"
+    try:
+        with open("/proc/cpuinfo", encoding="utf-8") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                key = key.strip()
+                if key == "physical id":
+                    physical_id = value.strip()
+                elif key == "core id":
+                    cores.add((physical_id, value.strip()))
+    except OSError:
+        pass
+    return min(len(cores), logical_cpus) if cores else logical_cpus
+
+
+def _gpu_offload_supported() -> bool:
+    try:
+        import llama_cpp  # type: ignore[reportMissingImports]
+        return bool(llama_cpp.llama_supports_gpu_offload())
+    except (ImportError, AttributeError):
+        return False
+
+
+def _mem_available() -> Optional[int]:
+    """MemAvailable из /proc/meminfo: свободная память вместе с вытесняемым кэшем страниц."""
+    try:
+        with open("/proc/meminfo", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def detect_hardware() -> HardwareInfo:
+    try:
+        logical_cpus = len(os.sched_getaffinity(0))
+    except AttributeError:  # нет на Windows и macOS
+        logical_cpus = os.cpu_count() or 1
+    try:
+        page_size = os.sysconf("SC_PAGE_SIZE")
+        total_ram: Optional[int] = page_size * os.sysconf("SC_PHYS_PAGES")
+        available_ram: Optional[int] = _mem_available() or page_size * os.sysconf("SC_AVPHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        total_ram = available_ram = None
+    return HardwareInfo(logical_cpus, _physical_cores(logical_cpus), total_ram, available_ram, _gpu_offload_supported())
+
+
+def _mlock_allowed(size_bytes: int) -> bool:
+    if resource is None:
+        return False
+    soft_limit, _ = resource.getrlimit(resource.RLIMIT_MEMLOCK)
+    return soft_limit == resource.RLIM_INFINITY or soft_limit >= size_bytes
+
+
+def tune_parameters(info: ModelInfo, hardware: HardwareInfo, extra_bytes: int = 0, processes: int = 1) -> Dict[str, Any]:
+    """Параметры llama.cpp по железу и метаданным модели.
+
+    Генерация упирается в пропускную способность памяти, поэтому потоков генерации столько же,
+    сколько физических ядер (гиперпотоки ее только замедляют); prefill упирается в вычисления
+    и использует все доступные CPU. Контекст не больше LOCAL_N_CTX (на него рассчитаны бюджеты
+    токенов) и обучающего контекста модели и уменьшается, если модель с KV-кэшем не помещается
+    в свободную память. Веса загружаются через mmap и общие для processes процессов с моделью,
+    а KV-кэш и extra_bytes у каждого процесса свои.
+    """
+    processes = max(1, processes)
+
+    def resident_bytes(n_ctx: int) -> int:
+        return info.file_size + processes * (kv_cache_bytes(info, n_ctx) + extra_bytes)
+
+    n_ctx = min(LOCAL_N_CTX, info.context_length or LOCAL_N_CTX)
+    if hardware.available_ram:
+        while n_ctx > MIN_N_CTX and resident_bytes(n_ctx) > hardware.available_ram:
+            n_ctx //= 2
+    # Без GPU веса закрепляются в RAM, чтобы их не вытеснило в своп между генерациями
+    use_mlock = (
+        not hardware.gpu_offload and hardware.total_ram is not None
+        and resident_bytes(n_ctx) <= hardware.total_ram * MLOCK_RAM_SHARE and _mlock_allowed(info.file_size)
+    )
+    return {
+        "n_ctx": n_ctx,
+        "n_threads": hardware.physical_cores,
+        "n_threads_batch": hardware.logical_cpus,
+        "n_batch": min(n_ctx, DEFAULT_N_BATCH),
+        "n_gpu_layers": -1 if hardware.gpu_offload else 0,
+        "use_mmap": True,
+        "use_mlock": use_mlock,
+    }
+
+
+def _parse_env_value(value: str, kind: type) -> Any:
+    if kind is bool:
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    return kind(value)
+
+
+def apply_overrides(params: Dict[str, Any], overrides: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Накладывает на подобранные параметры переопределения из файла настроек, затем из окружения."""
+    result = dict(params)
+    result.update({key: value for key, value in (overrides or {}).items() if key in TUNING_PARAMS})
+    for key, (env_name, kind) in ENV_OVERRIDES.items():
+        value = os.getenv(env_name)
+        if value:
+            try:
+                result[key] = _parse_env_value(value, kind)
+            except ValueError:
+                logger.warning(f"Некорректное значение {env_name}: {value}")
+    return result
+
+
+# --- Хранилище подобранных параметров ---
+
+class LocalTuningStore:
+    """Подобранные параметры и замеры по моделям в plotix_data/local_tuning.json.
+
+    Запись модели: params — подобранные параметры, overrides — ручные переопределения
+    (сохраняются при повторном подборе), calibration — замер скорости, а также размер и время
+    изменения файла, сведения о железе, память сверх модели (extra_bytes) и число процессов
+    с моделью (processes): при их изменении параметры подбираются заново.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+
+    def load(self) -> Dict[str, Any]:
+        try:
+            data = json.loads(self.path.read_text(encoding="utf-8"))
+            return data if isinstance(data, dict) else {}
+        except FileNotFoundError:
+            return {}
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning(f"Не удалось прочитать {self.path}: {e}")
+            return {}
+
+    def get(self, model_name: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self.load().get(model_name)
+
+    def put(self, model_name: str, entry: Dict[str, Any]) -> None:
+        with self._lock:
+            data = self.load()
+            data[model_name] = entry
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_name(self.path.name + ".tmp")
+            tmp_path.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+            os.replace(tmp_path, self.path)
+
+
+def get_local_tuning_store() -> LocalTuningStore:
+    return LocalTuningStore(get_data_dir() / "local_tuning.json")
+
+
+def _file_signature(model_path: str) -> Dict[str, Any]:
+    stat = os.stat(model_path)
+    return {"file_size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _hardware_signature(hardware: HardwareInfo) -> Dict[str, Any]:
+    return {
+        "logical_cpus": hardware.logical_cpus, "physical_cores": hardware.physical_cores,
+        "total_ram": hardware.total_ram, "gpu_offload": hardware.gpu_offload,
+    }
+
+
+# Разрешенные параметры по (файл настроек, путь модели, размер, mtime, extra_bytes, processes):
+# файл читается один раз
+_resolved: Dict[Tuple[str, str, int, int, int, int], Dict[str, Any]] = {}
+_resolved_lock = threading.Lock()
+
+
+def clear_tuning_cache() -> None:
+    with _resolved_lock:
+        _resolved.clear()
+
+
+def tune_model(model_path: str, extra_bytes: int = 0, retune: bool = False, processes: int = 1) -> Dict[str, Any]:
+    """Запись модели в хранилище: сохраненная, если файл модели, железо, extra_bytes и processes
+    не менялись, иначе подобранная заново. KV-кэш и extra_bytes считаются на каждый из processes процессов."""
+    store = get_local_tuning_store()
+    model_name = os.path.basename(model_path)
+    signature = _file_signature(model_path)
+    entry = store.get(model_name) or {}
+    hardware = detect_hardware()
+    processes = max(1, processes)
+    if (
+        not retune and entry.get("params")
+        and all(entry.get(key) == value for key, value in signature.items())
+        and entry.get("hardware") == _hardware_signature(hardware)
+        and entry.get("extra_bytes", 0) == extra_bytes
+        and entry.get("processes", 1) == processes
+    ):
+        return entry
+    params = tune_parameters(read_model_info(model_path), hardware, extra_bytes, processes)
+    entry = {
+        **signature, "hardware": _hardware_signature(hardware), "extra_bytes": extra_bytes, "processes": processes, "params": params,
+        "overrides": entry.get("overrides", {}), "calibration": None, "tuned_at": time.time(),
+    }
+    store.put(model_name, entry)
+    logger.info(f"Параметры локальной модели {model_name} подобраны: {params}")
+    return entry
+
+
+def _share_threads(params: Dict[str, Any], processes: int) -> Dict[str, Any]:
+    """Делит потоки между процессами, одновременно работающими с моделью, чтобы они не вытесняли друг друга."""
+    if processes <= 1:
+        return params
+    return {
+        **params,
+        "n_threads": max(1, params["n_threads"] // processes),
+        "n_threads_batch": max(1, params["n_threads_batch"] // processes),
+    }
+
+
+def get_local_params(model_path: str, extra_bytes: int = 0, processes: int = 1) -> Dict[str, Any]:
+    """Параметры загрузки llama.cpp для модели: подобранные под железо, с переопределениями.
+    processes — сколько процессов-исполнителей загружают модель одновременно: потоки делятся
+    между ними, а память под KV-кэш и extra_bytes нужна каждому (веса общие через mmap)."""
+    try:
+        signature = _file_signature(model_path)
+    except OSError:
+        params = tune_parameters(ModelInfo(0), detect_hardware(), extra_bytes, processes)
+        return apply_overrides(_share_threads(params, processes))
+    key = (str(get_local_tuning_store().path), os.path.abspath(model_path), signature["file_size"], signature["mtime_ns"], extra_bytes, processes)
+    with _resolved_lock:
+        entry = _resolved.get(key)
+    if entry is None:
+        entry = tune_model(model_path, extra_bytes, processes=processes)
+        with _resolved_lock:
+            _resolved[key] = entry
+    return apply_overrides(_share_threads(entry["params"], processes), entry.get("overrides"))
+
+
+# --- Калибровка ---
+
+CALIBRATION_PROMPT = (
+    "Старый смотритель маяка каждую ночь записывал в журнал, какие корабли прошли мимо острова, "
+    "какая была погода и что он видел на горизонте. "
+) * 8
+CALIBRATION_GENERATED_TOKENS = 32
+
+
+def calibrate_model(
+    model_path: str, loader: Callable[..., Any], chat_format: str = "chatml", extra_bytes: int = 0, processes: int = 1,
+) -> Dict[str, Any]:
+    """Короткий замер скорости prefill и генерации (токенов в секунду) с текущими параметрами.
+    Результат сохраняется в запись модели; extra_bytes и processes — те же, что при работе
+    приложения, иначе запись подберется заново и замер потеряется."""
+    params = get_local_params(model_path, extra_bytes, processes)
+    llm = loader(model_path=model_path, chat_format=chat_format, verbose=False, **params)
+    try:
+        prompt_tokens = len(llm.tokenize(CALIBRATION_PROMPT.encode("utf-8")))
+        llm.reset()
+        started = time.perf_counter()
+        llm.create_completion(CALIBRATION_PROMPT, max_tokens=1, temperature=0.0)
+        prefill_seconds = time.perf_counter() - started
+        llm.reset()
+        started = time.perf_counter()
+        output = llm.create_completion(CALIBRATION_PROMPT, max_tokens=CALIBRATION_GENERATED_TOKENS, temperature=0.0)
+        total_seconds = time.perf_counter() - started
+    finally:
+        close = getattr(llm, "close", None)
+        if callable(close):
+            close()
+    generated = output.get("usage", {}).get("completion_tokens", CALIBRATION_GENERATED_TOKENS)
+    generation_seconds = max(total_seconds - prefill_seconds, 1e-6)
+    calibration = {
+        "prompt_tokens_per_sec": round(prompt_tokens / max(prefill_seconds, 1e-6), 1),
+        "generation_tokens_per_sec": round(max(generated - 1, 1) / generation_seconds, 1),
+        "params": params,
+        "calibrated_at": time.time(),
+    }
+    store = get_local_tuning_store()
+    model_name = os.path.basename(model_path)
+    entry = store.get(model_name) or tune_model(model_path, extra_bytes, processes=processes)
+    entry["calibration"] = calibration
+    store.put(model_name, entry)
+    return calibration
@@ -0,0 +1,387 @@
+import atexit
+import importlib
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from multiprocessing.connection import Connection
+from typing import Any, Callable, Dict, List, Optional
+
+from .cancellation import CancelToken, GenerationCancelled
+from .model_registry import LocalModelRegistry, default_ram_budget_bytes
+
+logger = logging.getLogger(__name__)
+
+# Загрузчик модели в процессе-исполнителе ("модуль:функция": импортируется заново после spawn)
+DEFAULT_LOADER = "app.services.local_workers:load_llama"
+
+DEFAULT_HEALTH_INTERVAL = 30.0
+DEFAULT_PING_TIMEOUT = 5.0
+# Сколько ждать подтверждения отмены, прежде чем перезапустить процесс
+CANCEL_TIMEOUT = 5.0
+
+
+class LocalWorkerError(RuntimeError):
+    """Процесс локальной модели завершился аварийно или перестал отвечать."""
+
+
+def load_llama(prompt_cache_bytes: int = 0, **llama_kwargs: Any) -> Any:
+    """Загрузчик по умолчанию: модель llama.cpp (веса через mmap — страницы общие для процессов)
+    с кэшем состояний промптов, как и в основном процессе."""
+    from llama_cpp import Llama, LlamaRAMCache  # type: ignore[reportMissingImports]
+
+    llm = Llama(**llama_kwargs)
+    if prompt_cache_bytes > 0:
+        llm.set_cache(LlamaRAMCache(capacity_bytes=prompt_cache_bytes))
+    return llm
+
+
+def _import_loader(path: str) -> Callable[..., Any]:
+    module_name, _, attr = path.partition(":")
+    return getattr(importlib.import_module(module_name), attr)
+
+
+# --- Процесс-исполнитель ---
+
+def _serve_chat(conn: Connection, registry: LocalModelRegistry, loader: Callable[..., Any], request_id: int, request: Dict[str, Any]) -> None:
+    """Выполняет один запрос; в потоковом режиме между токенами отвечает на ping и отмену."""
+    try:
+        with registry.lease(request["model_path"], loader=loader, **request["load_kwargs"]) as llm:
+            if not request["stream"]:
+                response = llm.create_chat_completion(messages=request["messages"], stream=False, **request["options"])
+            else:
+                parts = []
+                finish_reason = None
+                for chunk in llm.create_chat_completion(messages=request["messages"], stream=True, **request["options"]):
+                    while conn.poll():
+                        message = conn.recv()
+                        if message[0] == "ping":
+                            conn.send(("pong", message[1]))
+                        elif message[0] == "cancel" and message[1] == request_id:
+                            conn.send(("cancelled", request_id))
+                            return
+                    text = chunk["choices"][0].get("delta", {}).get("content")
+                    finish_reason = chunk["choices"][0].get("finish_reason") or finish_reason
+                    if text:
+                        parts.append(text)
+                        conn.send(("delta", request_id, text))
+                response = {"choices": [{"message": {"content": "".join(parts)}, "finish_reason": finish_reason}]}
+        conn.send(("done", request_id, response))
+    except Exception as e:
+        conn.send(("error", request_id, type(e).__name__, str(e)))
+
+
+def _worker_main(conn: Connection, loader_path: str, ram_budget_bytes: Optional[int] = None, processes: int = 1) -> None:
+    """Цикл процесса-исполнителя: модели резидентны в его собственном реестре с долей общего бюджета RAM."""
+    loader = _import_loader(loader_path)
+    registry = LocalModelRegistry(ram_budget_bytes=ram_budget_bytes, shared_by=processes)
+    try:
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                break  # основной процесс завершился
+            op = message[0]
+            if op == "stop":
+                break
+            if op == "ping":
+                conn.send(("pong", message[1]))
+            elif op == "chat":
+                _serve_chat(conn, registry, loader, message[1], message[2])
+            elif op == "unload":
+                conn.send(("unloaded", message[1], registry.unload_path(message[2])))
+            # "cancel" уже завершенного запроса игнорируется
+    finally:
+        registry.shutdown()
+
+
+# --- Пул в основном процессе ---
+
+class _Worker:
+    def __init__(self, index: int):
+        self.index = index
+        self.process: Optional[multiprocessing.process.BaseProcess] = None
+        self.conn: Optional[Connection] = None
+        self.requests = 0
+        self.restarts = 0
+        self.busy = False
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+
+class LocalWorkerPool:
+    """Пул процессов-исполнителей локальной модели.
+
+    Генерация идет вне процесса Flask: она не держит его GIL, аварийное завершение llama.cpp
+    не роняет приложение, а несколько генераций идут параллельно — по одной на процесс.
+    Запросы передаются по каналу (multiprocessing.Pipe). Упавший или не ответивший на ping
+    процесс перезапускается; очередь запросов, ждущих свободный процесс, видна в stats().
+    Общий бюджет RAM (LOCAL_MODEL_RAM_BUDGET_MB или ~70% памяти) делится между процессами поровну;
+    веса загружаются через mmap и общие для всех процессов, поэтому каждый учитывает в своей доле
+    только 1/size файла модели, а KV-кэш и кэш промптов — целиком.
+    """
+
+    def __init__(
+        self, size: int, loader: str = DEFAULT_LOADER,
+        health_interval: float = DEFAULT_HEALTH_INTERVAL, ping_timeout: float = DEFAULT_PING_TIMEOUT,
+        ram_budget_bytes: Optional[int] = None,
+    ):
+        self.size = max(1, size)
+        total_budget = ram_budget_bytes if ram_budget_bytes is not None else default_ram_budget_bytes()
+        self.worker_ram_budget_bytes = total_budget // self.size if total_budget is not None else None
+        self.loader = loader
+        self.health_interval = health_interval
+        self.ping_timeout = ping_timeout
+        # spawn, а не fork: основной процесс многопоточный
+        self._context = multiprocessing.get_context("spawn")
+        self._workers = [_Worker(index) for index in range(self.size)]
+        self._cond = threading.Condition()
+        self._waiting = 0
+        self._request_ids = itertools.count(1)
+        self._closed = False
+        self._stop_event = threading.Event()
+        self._monitor: Optional[threading.Thread] = None
+
+    def _start(self, worker: _Worker) -> None:
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(
+            target=_worker_main, args=(child_conn, self.loader, self.worker_ram_budget_bytes, self.size), name=f"plotix-local-{worker.index}", daemon=True,
+        )
+        process.start()
+        child_conn.close()
+        worker.process, worker.conn = process, parent_conn
+
+    def _stop(self, worker: _Worker, graceful: bool = True) -> None:
+        if worker.conn is not None:
+            if graceful and worker.alive:
+                try:
+                    worker.conn.send(("stop",))
+                except (OSError, ValueError):
+                    pass
+            worker.conn.close()
+        if worker.process is not None:
+            worker.process.join(timeout=2.0 if graceful else 0)
+            if worker.process.is_alive():
+                worker.process.kill()
+                worker.process.join(timeout=2.0)
+        worker.process, worker.conn = None, None
+
+    def _restart(self, worker: _Worker, reason: str) -> None:
+        logger.warning(f"Перезапуск процесса локальной модели #{worker.index}: {reason}")
+        self._stop(worker, graceful=False)
+        worker.restarts += 1
+        if not self._closed:
+            self._start(worker)
+
+    def _acquire(self) -> _Worker:
+        with self._cond:
+            if self._closed:
+                raise LocalWorkerError("Пул процессов локальной модели остановлен.")
+            self._waiting += 1
+            try:
+                while True:
+                    worker = next((w for w in self._workers if not w.busy), None)
+                    if worker is not None:
+                        break
+                    self._cond.wait()
+                worker.busy = True
+            finally:
+                self._waiting -= 1
+        if not worker.alive:
+            try:
+                if worker.process is not None:
+                    self._restart(worker, "процесс завершился")
+                else:
+                    self._start(worker)
+            except Exception:
+                self._release(worker)
+                raise
+            self._ensure_monitor()
+        return worker
+
+    def _release(self, worker: _Worker) -> None:
+        with self._cond:
+            worker.busy = False
+            self._cond.notify()
+
+    def chat_completion(
+        self, model_path: str, load_kwargs: Dict[str, Any], messages: List[Dict[str, str]], options: Dict[str, Any],
+        on_delta: Optional[Callable[[str], None]] = None, cancel_token: Optional[CancelToken] = None,
+    ) -> Dict[str, Any]:
+        """Ответ модели в формате create_chat_completion llama.cpp. Блокирует поток до ответа."""
+        worker = self._acquire()
+        try:
+            return self._run(worker, model_path, load_kwargs, messages, options, on_delta, cancel_token)
+        finally:
+            self._release(worker)
+
+    def _run(
+        self, worker: _Worker, model_path: str, load_kwargs: Dict[str, Any], messages: List[Dict[str, str]],
+        options: Dict[str, Any], on_delta: Optional[Callable[[str], None]], cancel_token: Optional[CancelToken],
+    ) -> Dict[str, Any]:
+        assert worker.conn is not None
+        request_id = next(self._request_ids)
+        stream = on_delta is not None or cancel_token is not None
+        worker.requests += 1
+        worker.conn.send(("chat", request_id, {
+            "model_path": model_path, "load_kwargs": load_kwargs, "messages": messages, "options": options, "stream": stream,
+        }))
+        cancel_sent_at: Optional[float] = None
+        while True:
+            if cancel_token is not None and cancel_token.cancelled and cancel_sent_at is None:
+                worker.conn.send(("cancel", request_id))
+                cancel_sent_at = time.monotonic()
+            if cancel_sent_at is not None and time.monotonic() - cancel_sent_at > CANCEL_TIMEOUT:
+                self._restart(worker, "не подтвердил отмену")
+                raise GenerationCancelled()
+            try:
+                if not worker.conn.poll(0.1):
+                    if not worker.alive:
+                        self._restart(worker, "аварийное завершение")
+                        raise LocalWorkerError("Процесс локальной модели завершился аварийно.")
+                    continue
+                message = worker.conn.recv()
+            except (EOFError, OSError) as e:
+                self._restart(worker, f"канал закрыт ({e})")
+                raise LocalWorkerError("Процесс локальной модели завершился аварийно.") from e
+            kind = message[0]
+            if message[1] != request_id:
+                continue  # ответ на проверку здоровья или запоздалое сообщение прерванного запроса
+            if kind == "delta":
+                if on_delta is not None:
+                    on_delta(message[2])
+            elif kind == "done":
+                return message[2]
+            elif kind == "cancelled":
+                raise GenerationCancelled()
+            elif kind == "error":
+                error_type, error_message = message[2], message[3]
+                if error_type == "FileNotFoundError":
+                    raise FileNotFoundError(error_message)
+                if error_type == "ImportError":
+                    raise ImportError(error_message)
+                raise LocalWorkerError(f"{error_type}: {error_message}")
+
+    def _idle_workers(self) -> List[_Worker]:
+        """Занимает все свободные запущенные процессы (их нужно вернуть через _release)."""
+        with self._cond:
+            workers = [worker for worker in self._workers if not worker.busy and worker.process is not None]
+            for worker in workers:
+                worker.busy = True
+        return workers
+
+    def _exchange(self, worker: _Worker, message: tuple, reply: str, timeout: float) -> Optional[tuple]:
+        """Отправляет служебное сообщение свободному процессу и ждет ответ с тем же номером."""
+        if not worker.alive or worker.conn is not None and worker.conn.closed:
+            return None
+        assert worker.conn is not None
+        try:
+            worker.conn.send(message)
+            deadline = time.monotonic() + timeout
+            while worker.conn.poll(max(0.0, deadline - time.monotonic())):
+                answer = worker.conn.recv()
+                if answer[0] == reply and answer[1] == message[1]:
+                    return answer
+        except (EOFError, OSError):
+            pass
+        return None
+
+    def unload_path(self, model_path: str) -> int:
+        """Выгружает модель из свободных процессов (например, перед удалением файла)."""
+        unloaded = 0
+        for worker in self._idle_workers():
+            try:
+                answer = self._exchange(worker, ("unload", next(self._request_ids), model_path), "unloaded", self.ping_timeout)
+                unloaded += answer[2] if answer is not None else 0
+            finally:
+                self._release(worker)
+        return unloaded
+
+    def check_health(self) -> int:
+        """Проверяет свободные процессы ping'ом и перезапускает упавшие и зависшие. Возвращает число перезапусков."""
+        restarted = 0
+        for worker in self._idle_workers():
+            try:
+                if self._exchange(worker, ("ping", next(self._request_ids)), "pong", self.ping_timeout) is None:
+                    self._restart(worker, "не отвечает на проверку здоровья")
+                    restarted += 1
+            finally:
+                self._release(worker)
+        return restarted
+
+    def _ensure_monitor(self) -> None:
+        if self.health_interval <= 0 or (self._monitor is not None and self._monitor.is_alive()):
+            return
+        self._monitor = threading.Thread(target=self._monitor_loop, name="local-workers-health", daemon=True)
+        self._monitor.start()
+
+    def _monitor_loop(self) -> None:
+        while not self._stop_event.wait(self.health_interval):
+            self.check_health()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "size": self.size,
+                "worker_ram_budget_bytes": self.worker_ram_budget_bytes,
+                "queue_depth": self._waiting,
+                "busy": sum(1 for worker in self._workers if worker.busy),
+                "workers": [
+                    {
+                        "index": worker.index, "pid": worker.process.pid if worker.process is not None else None,
+                        "alive": worker.alive, "busy": worker.busy, "requests": worker.requests, "restarts": worker.restarts,
+                    }
+                    for worker in self._workers
+                ],
+            }
+
+    def shutdown(self) -> None:
+        self._stop_event.set()
+        with self._cond:
+            self._closed = True
+        for worker in self._workers:
+            self._stop(worker)
+
+
+def get_local_workers_count() -> int:
+    """Число процессов-исполнителей (LOCAL_WORKERS); 0 — локальная модель работает в основном процессе."""
+    try:
+        return max(0, int(os.getenv("LOCAL_WORKERS", "0")))
+    except ValueError:
+        logger.warning("Некорректное значение LOCAL_WORKERS, локальная модель работает в основном процессе.")
+        return 0
+
+
+_pool: Optional[LocalWorkerPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_local_worker_pool() -> Optional[LocalWorkerPool]:
+    """Общий на процесс пул, если LOCAL_WORKERS > 0, иначе None."""
+    global _pool
+    size = get_local_workers_count()
+    if size == 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            try:
+                interval = float(os.getenv("LOCAL_WORKERS_HEALTH_INTERVAL", str(DEFAULT_HEALTH_INTERVAL)))
+            except ValueError:
+                interval = DEFAULT_HEALTH_INTERVAL
+            _pool = LocalWorkerPool(size, health_interval=interval)
+        return _pool
+
+
+def shutdown_local_worker_pool() -> None:
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown()
+
+
+atexit.register(shutdown_local_worker_pool)
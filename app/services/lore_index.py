@@ -0,0 +1,112 @@
+import logging
+import os
+import re
+from typing import Dict, List
+
+import numpy as np
+
+from .token_budget import split_by_tokens
+
+logger = logging.getLogger(__name__)
+
+# Размер фрагмента сеттинга и число фрагментов, которые получает промпт сцены
+DEFAULT_LORE_CHUNK_TOKENS = 300
+DEFAULT_LORE_TOP_K = 4
+
+# Параметры BM25
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# Предельная длина основы слова: вместе с отбрасыванием окончаний это грубый стемминг,
+# при котором "крепость", "крепости" и "крепостью" совпадают
+STEM_LENGTH = 6
+
+_WORD_RE = re.compile(r"\w+")
+_ENDING_RE = re.compile(r"(?:ами|ями|ого|его|ому|ему|ыми|ими|ой|ей|ий|ый|ая|яя|ое|ее|ую|юю|ом|ем|ам|ям|ах|ях|ов|ев|ью|[аяоеыиуюь])$")
+
+
+def _get_int_env(name: str, default: int) -> int:
+    try:
+        return max(1, int(os.getenv(name, str(default))))
+    except ValueError:
+        logger.warning(f"Некорректное {name}, используется {default}.")
+        return default
+
+
+def get_lore_chunk_tokens() -> int:
+    return _get_int_env("LORE_CHUNK_TOKENS", DEFAULT_LORE_CHUNK_TOKENS)
+
+
+def get_lore_top_k() -> int:
+    return _get_int_env("LORE_TOP_K", DEFAULT_LORE_TOP_K)
+
+
+def _stem(word: str) -> str:
+    ending = _ENDING_RE.search(word)
+    if ending is not None and ending.start() >= 3:
+        word = word[:ending.start()]
+    return word[:STEM_LENGTH]
+
+
+def _terms(text: str) -> List[str]:
+    return [_stem(word) for word in _WORD_RE.findall(text.lower()) if len(word) > 2 and not word.isdigit()]
+
+
+class LoreIndex:
+    """BM25-индекс фрагментов сеттинга в памяти процесса, без внешних сервисов.
+
+    Постинги хранятся в массивах NumPy, отсортированных по термину (как CSC-матрица
+    термин x фрагмент), с заранее посчитанным весом BM25 каждой пары, поэтому поиск —
+    это сложение срезов весов по терминам запроса.
+    """
+
+    def __init__(self, chunks: List[str]) -> None:
+        self.chunks = chunks
+        self._vocabulary: Dict[str, int] = {}
+        chunk_count = max(1, len(chunks))
+        doc_ids: List[int] = []
+        term_ids: List[int] = []
+        lengths = np.zeros(chunk_count, dtype=np.float64)
+        for doc, chunk in enumerate(chunks):
+            terms = [self._vocabulary.setdefault(term, len(self._vocabulary)) for term in _terms(chunk)]
+            lengths[doc] = len(terms)
+            term_ids.extend(terms)
+            doc_ids.extend([doc] * len(terms))
+
+        # Пары (термин, фрагмент) с частотой термина во фрагменте, отсортированные по термину
+        keys, tf = np.unique(np.asarray(term_ids, dtype=np.int64) * chunk_count + np.asarray(doc_ids, dtype=np.int64), return_counts=True)
+        posting_terms = keys // chunk_count
+        self._posting_docs = keys % chunk_count
+        df = np.bincount(posting_terms, minlength=len(self._vocabulary))
+        self._offsets = np.concatenate(([0], np.cumsum(df)))
+        idf = np.log1p((chunk_count - df + 0.5) / (df + 0.5))
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths / max(lengths.mean(), 1.0))
+        self._weights = (idf[posting_terms] * tf * (BM25_K1 + 1) / (tf + norm[self._posting_docs])).astype(np.float32)
+
+    @classmethod
+    def from_text(cls, text: str, chunk_tokens: int = DEFAULT_LORE_CHUNK_TOKENS) -> "LoreIndex":
+        """Делит сеттинг на фрагменты по абзацам и индексирует их."""
+        return cls([chunk.strip() for chunk in split_by_tokens(text, chunk_tokens) if chunk.strip()])
+
+    def scores(self, query: str) -> np.ndarray:
+        scores = np.zeros(max(1, len(self.chunks)), dtype=np.float32)
+        for term in set(_terms(query)):
+            term_id = self._vocabulary.get(term)
+            if term_id is not None:
+                start, end = self._offsets[term_id], self._offsets[term_id + 1]
+                scores[self._posting_docs[start:end]] += self._weights[start:end]
+        return scores
+
+    def search(self, query: str, top_k: int = DEFAULT_LORE_TOP_K) -> List[int]:
+        """Индексы самых релевантных запросу фрагментов по убыванию оценки (без нулевых)."""
+        if not self.chunks or top_k <= 0:
+            return []
+        scores = self.scores(query)
+        k = min(top_k, len(self.chunks))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best], kind="stable")]
+        return [int(i) for i in best if scores[i] > 0]
+
+    def retrieve(self, query: str, top_k: int = DEFAULT_LORE_TOP_K) -> List[str]:
+        """Релевантные фрагменты в порядке их следования в сеттинге."""
+        return [self.chunks[i] for i in sorted(self.search(query, top_k))]
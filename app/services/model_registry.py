@@ -0,0 +1,248 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Ключ резидентной модели: (абсолютный путь к GGUF, n_ctx, chat_format, хэш остальных параметров загрузки)
+ModelKey = Tuple[str, int, str, str]
+
+
+def default_ram_budget_bytes() -> Optional[int]:
+    """Бюджет RAM для моделей: LOCAL_MODEL_RAM_BUDGET_MB или ~70% физической памяти."""
+    budget_mb = os.getenv("LOCAL_MODEL_RAM_BUDGET_MB")
+    if budget_mb:
+        try:
+            return int(float(budget_mb) * 1024 * 1024)
+        except ValueError:
+            logger.warning(f"Некорректное значение LOCAL_MODEL_RAM_BUDGET_MB: {budget_mb}")
+    try:
+        total = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+        return int(total * 0.7)
+    except (AttributeError, ValueError, OSError):
+        return None  # Неизвестно (например, Windows) — без ограничения
+
+
+def _default_idle_timeout() -> float:
+    try:
+        return float(os.getenv("LOCAL_MODEL_IDLE_TIMEOUT", "600"))
+    except ValueError:
+        return 600.0
+
+
+class _ResidentModel:
+    """Загруженный экземпляр модели и его служебное состояние."""
+
+    def __init__(self, llm: Any, size_bytes: int):
+        self.llm = llm
+        self.size_bytes = size_bytes
+        self.last_used = time.monotonic()
+        self.in_use = 0
+        # Экземпляр Llama не потокобезопасен: одновременно им пользуется один поток.
+        self.lock = threading.Lock()
+
+
+class LocalModelRegistry:
+    """Процессный реестр загруженных GGUF-моделей.
+
+    Держит экземпляры Llama в памяти между вызовами, вытесняет их по LRU при
+    превышении бюджета RAM и выгружает после простоя дольше idle_timeout секунд.
+    shared_by — сколько процессов загружают те же файлы моделей: страницы mmap у них общие,
+    поэтому реестр одного процесса учитывает свою долю файла, а extra_bytes — целиком.
+    """
+
+    def __init__(
+        self,
+        ram_budget_bytes: Optional[int] = None,
+        idle_timeout: Optional[float] = None,
+        shared_by: int = 1,
+    ):
+        self.ram_budget_bytes = ram_budget_bytes if ram_budget_bytes is not None else default_ram_budget_bytes()
+        self.idle_timeout = idle_timeout if idle_timeout is not None else _default_idle_timeout()
+        self.shared_by = max(1, shared_by)
+        self._models: "OrderedDict[ModelKey, _ResidentModel]" = OrderedDict()
+        self._load_locks: Dict[ModelKey, threading.Lock] = {}
+        self._lock = threading.RLock()
+        self._reaper: Optional[threading.Thread] = None
+        self._stop_event = threading.Event()
+
+    @staticmethod
+    def make_key(
+        model_path: str, n_ctx: int, chat_format: str, llama_kwargs: Optional[Dict[str, Any]] = None, extra_bytes: int = 0,
+    ) -> ModelKey:
+        # Потоки, слои на GPU, mmap, емкость кэша промптов и т.п. тоже входят в ключ: после
+        # перенастройки параметров модель загружается заново, а не берется прежний экземпляр
+        params = json.dumps({**(llama_kwargs or {}), "extra_bytes": extra_bytes}, sort_keys=True, default=repr)
+        return (os.path.abspath(model_path), int(n_ctx), chat_format, hashlib.sha1(params.encode("utf-8")).hexdigest()[:16])
+
+    @contextmanager
+    def lease(
+        self,
+        model_path: str,
+        loader: Callable[..., Any],
+        n_ctx: int = 4096,
+        chat_format: str = "chatml",
+        extra_bytes: int = 0,
+        **llama_kwargs: Any,
+    ) -> Iterator[Any]:
+        """Выдает резидентную модель в монопольное пользование на время блока `with`.
+
+        extra_bytes — память сверх размера файла модели (например, кэш состояний промптов),
+        которая тоже учитывается в бюджете RAM.
+        """
+        key = self.make_key(model_path, n_ctx, chat_format, llama_kwargs, extra_bytes)
+        entry = self._get_or_load(key, loader, llama_kwargs, extra_bytes)
+        with entry.lock:
+            try:
+                yield entry.llm
+            finally:
+                with self._lock:
+                    entry.in_use -= 1
+                    entry.last_used = time.monotonic()
+
+    def _get_or_load(
+        self, key: ModelKey, loader: Callable[..., Any], llama_kwargs: Dict[str, Any], extra_bytes: int = 0,
+    ) -> _ResidentModel:
+        self.evict_idle()
+        with self._lock:
+            entry = self._models.get(key)
+            if entry is not None:
+                self._models.move_to_end(key)
+                entry.in_use += 1
+                return entry
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+
+        # Загрузка идет вне общей блокировки, чтобы не задерживать другие модели;
+        # параллельные запросы той же модели ждут на load_lock и получают готовый экземпляр.
+        with load_lock:
+            with self._lock:
+                entry = self._models.get(key)
+                if entry is not None:
+                    self._models.move_to_end(key)
+                    entry.in_use += 1
+                    return entry
+                try:
+                    file_bytes = os.path.getsize(key[0])
+                except OSError:
+                    file_bytes = 0
+                # Без mmap каждый процесс держит свою копию весов
+                shared_by = self.shared_by if llama_kwargs.get("use_mmap", True) else 1
+                size_bytes = file_bytes // shared_by + extra_bytes
+                self._unload_stale(key)
+                self._make_room(size_bytes)
+
+            model_path, n_ctx, chat_format, _ = key
+            logger.info(f"Загрузка локальной модели в память: {model_path} (n_ctx={n_ctx})")
+            started = time.perf_counter()
+            llm = loader(model_path=model_path, n_ctx=n_ctx, chat_format=chat_format, **llama_kwargs)
+            logger.info(f"Модель {os.path.basename(model_path)} загружена за {time.perf_counter() - started:.1f} сек.")
+
+            with self._lock:
+                entry = _ResidentModel(llm, size_bytes)
+                entry.in_use = 1
+                self._models[key] = entry
+                self._load_locks.pop(key, None)
+                self._ensure_reaper()
+                return entry
+
+    def _unload_stale(self, key: ModelKey) -> None:
+        """Выгружает свободные экземпляры той же модели, загруженные с прежними параметрами."""
+        for stale in [k for k, entry in self._models.items() if k[:3] == key[:3] and entry.in_use == 0]:
+            logger.info(f"Параметры загрузки изменились, выгрузка прежнего экземпляра: {stale[0]}")
+            self._unload(stale)
+
+    def _make_room(self, incoming_bytes: int) -> None:
+        """Вытесняет неиспользуемые модели по LRU, пока новая не уместится в бюджет."""
+        if self.ram_budget_bytes is None:
+            return
+        for key in list(self._models.keys()):
+            if self._resident_bytes() + incoming_bytes <= self.ram_budget_bytes:
+                return
+            if self._models[key].in_use == 0:
+                logger.info(f"Вытеснение модели из памяти (бюджет RAM): {key[0]}")
+                self._unload(key)
+        if self._resident_bytes() + incoming_bytes > self.ram_budget_bytes:
+            logger.warning("Бюджет RAM для локальных моделей превышен: все резидентные модели сейчас заняты.")
+
+    def _resident_bytes(self) -> int:
+        return sum(entry.size_bytes for entry in self._models.values())
+
+    def _unload(self, key: ModelKey) -> None:
+        entry = self._models.pop(key)
+        close = getattr(entry.llm, "close", None)
+        if callable(close):
+            try:
+                close()
+            except Exception as e:
+                logger.warning(f"Ошибка при выгрузке модели {key[0]}: {e}")
+
+    def evict_idle(self) -> int:
+        """Выгружает модели, простаивающие дольше idle_timeout. Возвращает число выгруженных."""
+        if self.idle_timeout <= 0:
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            expired = [
+                key for key, entry in self._models.items()
+                if entry.in_use == 0 and now - entry.last_used >= self.idle_timeout
+            ]
+            for key in expired:
+                logger.info(f"Выгрузка простаивающей модели: {key[0]}")
+                self._unload(key)
+        return len(expired)
+
+    def unload_path(self, model_path: str) -> int:
+        """Выгружает все свободные экземпляры модели по пути (например, перед удалением файла)."""
+        target = os.path.abspath(model_path)
+        with self._lock:
+            keys = [key for key, entry in self._models.items() if key[0] == target and entry.in_use == 0]
+            for key in keys:
+                self._unload(key)
+        return len(keys)
+
+    def clear(self) -> None:
+        with self._lock:
+            for key in [key for key, entry in self._models.items() if entry.in_use == 0]:
+                self._unload(key)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "resident_models": [
+                    {"path": key[0], "n_ctx": key[1], "chat_format": key[2], "size": entry.size_bytes, "in_use": entry.in_use}
+                    for key, entry in self._models.items()
+                ],
+                "resident_bytes": self._resident_bytes(),
+                "ram_budget_bytes": self.ram_budget_bytes,
+                "idle_timeout": self.idle_timeout,
+            }
+
+    def _ensure_reaper(self) -> None:
+        if self.idle_timeout <= 0 or (self._reaper is not None and self._reaper.is_alive()):
+            return
+        self._stop_event.clear()
+        self._reaper = threading.Thread(target=self._reap_loop, name="local-model-reaper", daemon=True)
+        self._reaper.start()
+
+    def _reap_loop(self) -> None:
+        interval = max(1.0, min(self.idle_timeout / 2, 60.0))
+        while not self._stop_event.wait(interval):
+            self.evict_idle()
+            with self._lock:
+                if not self._models:
+                    self._reaper = None
+                    return
+
+    def shutdown(self) -> None:
+        self._stop_event.set()
+        self.clear()
+
+
+# Единый реестр на процесс
+local_model_registry = LocalModelRegistry()
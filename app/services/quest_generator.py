@@ -1,30 +1,62 @@
+import asyncio
+import copy
+import inspect
 import json
 import logging
 import os
 import re
 import time
-import requests
 from pathlib import Path
-from typing import Any, Dict, List, Iterator, Set
+from typing import Any, AsyncIterator, Callable, Dict, List, Iterator, NamedTuple, Optional, Set, Tuple, Union
 
-import google.generativeai as genai
+import httpx
 import openai
-from groq import Groq, APIStatusError
+from groq import APIConnectionError, APIStatusError
 
 try:
-    from llama_cpp import Llama  # type: ignore[reportMissingImports]
+    from llama_cpp import Llama, LlamaRAMCache  # type: ignore[reportMissingImports]
 except ImportError:
     Llama = None
+    LlamaRAMCache = None
+
+from .async_bridge import iterate_sync, run_sync
+from .cancellation import CancelToken, GenerationCancelled, cancel_registry, current_cancel_token
+from .circuit_breaker import CircuitOpenError, get_circuit_breaker
+from .json_stream import JsonStringFieldStreamer
+from .llm_cache import get_llm_cache
+from .llm_clients import get_async_client, get_client
+from .local_tuning import get_local_params
+from .local_workers import LocalWorkerError, get_local_worker_pool, get_local_workers_count
+from .lore_index import LoreIndex, get_lore_chunk_tokens, get_lore_top_k
+from .model_registry import local_model_registry
+from .quest_graph import QuestGraph
+from .quest_repair import repair_quest_graph
+from .rate_limiter import get_rate_limiter, parse_reset_duration
+from .run_store import RunNotFoundError, get_run_store
+from .script_detector import scan_quest
+from .structured_output import (
+    gemini_generation_config,
+    llama_response_format,
+    normalize_json_response,
+    openai_response_format,
+)
+from .token_budget import (
+    StageBudget,
+    StageTokenUsage,
+    count_tokens,
+    estimate_tokens,
+    get_previous_scene_tokens,
+    get_setting_tokens,
+    get_stage_budget,
+    split_by_tokens,
+    truncate_to_tokens,
+)
 
 logger = logging.getLogger(__name__)
 
 
-# ЭТАП 1: ПРОМПТ ДЛЯ "ГЕЙМДИЗАЙНЕРА"
-def _get_plot_concept_prompt(
-    setting_text: str, scene_count: int, tone: str, pacing: str, narrative_elements: list[str]
-) -> str:
-    """Генерирует высокоуровневый концепт сюжета с учетом параметров от 'Режиссера'."""
-    
+def _narrative_requirements(narrative_elements: list[str]) -> Tuple[str, str]:
+    """Строки промпта с обязательными нарративными техниками и событиями пользователя."""
     narrative_elements_map = {
         "moral_dilemma": "Моральная дилемма (сложный выбор без очевидно правильного ответа)",
         "unreliable_npc": "Ненадежный NPC (персонаж, который лжет или имеет скрытые мотивы)",
@@ -48,7 +80,15 @@ def _get_plot_concept_prompt(
     custom_part = ""
     if custom_elements_text:
         custom_part = f"- **Обязательные уникальные события (заданы пользователем):** {'; '.join(custom_elements_text)}."
+    return known_part, custom_part
+
 
+# ЭТАП 1: ПРОМПТ ДЛЯ "ГЕЙМДИЗАЙНЕРА"
+def _get_plot_concept_prompt(
+    setting_text: str, scene_count: int, tone: str, pacing: str, narrative_elements: list[str]
+) -> str:
+    """Генерирует высокоуровневый концепт сюжета с учетом параметров от 'Режиссера'."""
+    known_part, custom_part = _narrative_requirements(narrative_elements)
     return f"""
             Ты — эксперт-геймдизайнер, известный своими глубокими и нелинейными сюжетами. Твоя задача — написать краткий, но увлекательный концепт для квеста, строго следуя заданным параметрам. Опиши его как связный рассказ.
 
@@ -124,21 +164,18 @@ def _get_graph_from_scenes_prompt(scene_list_json: str) -> str:
 
 
 # ЭТАП 4: ПРОМПТ ДЛЯ "СЦЕНАРИСТА"
+# Общая для всех сцен часть (инструкции и сеттинг) стоит в начале промпта, а данные сцены — после нее:
+# локальная модель восстанавливает KV-состояние общего начала из кэша, а не вычисляет его заново.
 def _get_scene_detail_prompt(
-    setting_text: str, scene_summary: str, history_choice: str, previous_scene_text: str
+    setting_text: str, scene_summary: str, history_choice: str, previous_scene_text: str,
+    lore_excerpts: Optional[List[str]] = None,
 ) -> str:
     previous_scene_block = (f'ПРЕДЫДУЩАЯ СИТУАЦИЯ (ПОЛНЫЙ ТЕКСТ):\n---\n{previous_scene_text}\n---\n' if previous_scene_text else "Это стартовая ситуация квеста.")
+    lore_block = ("ФРАГМЕНТЫ СЕТТИНГА, ОТНОСЯЩИЕСЯ К СИТУАЦИИ:\n---\n" + "\n\n".join(lore_excerpts) + "\n---\n") if lore_excerpts else ""
     return f"""
 Ты — талантливый сценарист интерактивных историй. Твоя задача — описать игровую ситуацию для ИГРОКА, продолжая повествование.
-ОБЩИЙ СЕТТИНГ КВЕСТА:
-{setting_text}
-{previous_scene_block}
-КОНТЕКСТ ПЕРЕХОДА (ДЕЙСТВИЕ ИГРОКА, КОТОРОЕ ПРИВЕЛО СЮДА):
-{history_choice}
-КРАТКОЕ ОПИСАНИЕ ТЕКУЩЕЙ ИГРОВОЙ СИТУАЦИИ:
-"{scene_summary}"
 ТВОЯ ЗАДАЧА:
-Напиши текст для этой ситуации (`text`) и варианты выбора (`choices_text`) с точки зрения ИГРОКА.
+Напиши текст для текущей ситуации (`text`) и варианты выбора (`choices_text`) с точки зрения ИГРОКА.
 КЛЮЧЕВЫЕ ПРАВИЛА:
 1.  **ПРАВИЛО ИГРОКА-ПРОТАГОНИСТА:** Пиши так, чтобы игрок чувствовал себя главным героем. Используй обороты "Вы видите...", "Вам предстоит решить...".
 2.  **ДИНАМИКА:** Сосредоточься на действиях, диалогах и доступных игроку возможностях.
@@ -148,6 +185,13 @@ def _get_scene_detail_prompt(
       "text": "Полное описание ситуации с точки зрения игрока.",
       "choices_text": ["Текст первого действия, доступного игроку.", "Текст второго действия, доступного игроку."]
     }}
+ОБЩИЙ СЕТТИНГ КВЕСТА:
+{setting_text}
+{lore_block}{previous_scene_block}
+КОНТЕКСТ ПЕРЕХОДА (ДЕЙСТВИЕ ИГРОКА, КОТОРОЕ ПРИВЕЛО СЮДА):
+{history_choice}
+КРАТКОЕ ОПИСАНИЕ ТЕКУЩЕЙ ИГРОВОЙ СИТУАЦИИ:
+"{scene_summary}"
 Теперь, основываясь на всем контексте, сгенерируй JSON с детализацией для ТЕКУЩЕЙ игровой ситуации.
 """
 
@@ -172,52 +216,391 @@ def _get_correction_prompt(quest_json_str: str) -> str:
 """
 
 
-def _call_llm(prompt: str, api_provider: str, api_key: str, model: str, force_text_response: bool = False) -> str:
+# ЭТАП 0: ПРОМПТ ДЛЯ СЖАТИЯ ДЛИННОГО СЕТТИНГА (СКОЛЬЗЯЩИЙ ПЕРЕСКАЗ)
+def _get_setting_digest_prompt(setting_part: str, digest_so_far: str, target_tokens: int) -> str:
+    """Дополняет выжимку сеттинга очередной частью исходного текста."""
+    digest_block = f"**ВЫЖИМКА ПРЕДЫДУЩИХ ЧАСТЕЙ:**\n---\n{digest_so_far}\n---\n" if digest_so_far else ""
+    return f"""
+Ты — редактор сеттингов. Сеттинг квеста слишком длинный для сценаристов: сожми его в связную выжимку.
+{digest_block}**ОЧЕРЕДНАЯ ЧАСТЬ СЕТТИНГА:**
+---
+{setting_part}
+---
+Верни обновленную выжимку всего прочитанного (не длиннее {target_tokens * 3} символов) обычным текстом на русском языке.
+Сохрани имена, места, правила мира, конфликты и цели героя; опусти повторы и второстепенные описания.
+"""
+
+
+# БЫСТРЫЙ РЕЖИМ, ВЫЗОВ 1: КОНЦЕПТ И СПИСОК СЦЕН
+def _get_fast_outline_prompt(
+    setting_text: str, scene_count: int, tone: str, pacing: str, narrative_elements: list[str]
+) -> str:
+    """Концепт и список сцен одним JSON (заменяет этапы 1 и 2)."""
+    known_part, custom_part = _narrative_requirements(narrative_elements)
+    return f"""
+Ты — ведущий геймдизайнер нелинейных квестов. Придумай концепт квеста по сеттингу и сразу разбей его на ключевые игровые ситуации.
+
+**ПАРАМЕТРЫ:**
+- **Количество сцен:** примерно {scene_count}.
+- **Тон:** {tone if tone else 'Нейтральный'}.
+- **Темп повествования:** {pacing if pacing else 'Средний'}.
+{known_part}
+{custom_part}
+
+**Сеттинг для квеста:**
+---
+{setting_text}
+---
+
+Верни ТОЛЬКО ОДИН JSON-объект на русском языке:
+{{
+  "concept": "Связный концепт: завязка, ключевые этапы, персонажи и их мотивы.",
+  "scenes": ["Краткое описание первой игровой ситуации.", "Краткое описание второй игровой ситуации."]
+}}
+"""
+
+
+# БЫСТРЫЙ РЕЖИМ, ВЫЗОВ 2: ГРАФ И ТЕКСТЫ СЦЕН
+def _get_fast_quest_prompt(setting_text: str, plot_concept: str, scene_list_json: str) -> str:
+    """Граф квеста вместе с текстами сцен одним JSON (заменяет этапы 3 и 4 для небольших квестов)."""
+    return f"""
+Ты — автор интерактивных квестов. По концепту и списку ситуаций напиши готовый квест: свяжи сцены выборами и напиши текст каждой сцены.
+
+**ОБЩИЙ СЕТТИНГ:**
+{setting_text}
+
+**КОНЦЕПТ:**
+---
+{plot_concept}
+---
+
+**СПИСОК СЦЕН:**
+---
+{scene_list_json}
+---
+
+**ПРАВИЛА:**
+1.  Используй РОВНО эти `scene_id`, по одному объекту на каждую сцену списка.
+2.  `text` — описание ситуации для ИГРОКА ("Вы видите...", "Вам предстоит решить..."), СТРОГО на РУССКОМ ЯЗЫКЕ.
+3.  `choices` — 2-3 действия игрока (`text`) со ссылкой на следующую сцену (`next_scene`); у финальных сцен выборов нет.
+4.  Граф строго ациклический: сюжет всегда движется ВПЕРЕД, хотя бы одна развилка.
+
+Верни ТОЛЬКО ОДИН JSON-объект:
+{{
+  "start_scene": "scene_1",
+  "scenes": [
+    {{"scene_id": "scene_1", "text": "Текст сцены.", "choices": [{{"text": "Действие игрока.", "next_scene": "scene_2"}}]}}
+  ]
+}}
+"""
+
+
+def _estimate_tokens(text: str) -> int:
+    """Оценка числа токенов без токенизатора (см. token_budget.estimate_tokens)."""
+    return estimate_tokens(text)
+
+
+# Резерв токенов под ответ модели при планировании лимитов, если предел ответа не задан
+EXPECTED_COMPLETION_TOKENS = 1024
+
+LLM_TEMPERATURE = 0.7
+
+# Емкость кэша KV-состояний промптов локальной модели в RAM (0 — без кэша)
+DEFAULT_LOCAL_PROMPT_CACHE_MB = 1024
+
+
+def _get_local_prompt_cache_bytes() -> int:
+    value = os.getenv("LOCAL_PROMPT_CACHE_MB", str(DEFAULT_LOCAL_PROMPT_CACHE_MB))
+    try:
+        return max(0, int(float(value) * 1024 * 1024))
+    except ValueError:
+        logger.warning(f"Некорректное значение LOCAL_PROMPT_CACHE_MB: {value}")
+        return DEFAULT_LOCAL_PROMPT_CACHE_MB * 1024 * 1024
+
+
+def _local_model_path(model: str) -> str:
+    return os.path.join(os.getenv("LOCAL_MODEL_PATH", "quest-generator/models"), model)
+
+
+def _get_local_tuning_args() -> Dict[str, int]:
+    """Память под кэш промптов и число процессов-исполнителей, под которые подбираются параметры модели."""
+    pool = get_local_worker_pool()
+    return {
+        "extra_bytes": _get_local_prompt_cache_bytes() if LlamaRAMCache is not None else 0,
+        "processes": pool.size if pool is not None else 1,
+    }
+
+
+def _get_local_load_params(model_path: str) -> Dict[str, Any]:
+    """Параметры загрузки локальной модели. Их же берут бюджеты токенов и корректор, поэтому
+    контекст у всех подобран с учетом кэша промптов и процессов-исполнителей, как и при загрузке."""
+    return get_local_params(model_path, **_get_local_tuning_args())
+
+
+def _load_local_llama(prompt_cache_bytes: int = 0, **llama_kwargs: Any) -> Any:
+    """Загружает модель llama.cpp и подключает к ней кэш состояний промптов в RAM.
+
+    После каждого вызова кэш сохраняет KV-состояние промпта, а следующий промпт с тем же
+    началом (инструкции и сеттинг сцен этапа 4) восстанавливает его вместо повторного prefill.
+    """
+    llm = Llama(**llama_kwargs)
+    if prompt_cache_bytes > 0 and LlamaRAMCache is not None and hasattr(llm, "set_cache"):
+        llm.set_cache(LlamaRAMCache(capacity_bytes=prompt_cache_bytes))
+    return llm
+
+
+def _local_chat_completion(
+    prompt: str, model: str, response_format_option: Dict[str, str], on_delta: Optional[Callable[[str], None]] = None,
+    max_tokens: Optional[int] = None,
+) -> Dict[str, Any]:
+    """Синхронный вызов llama.cpp; выполняется в пуле потоков, чтобы не блокировать цикл событий.
+
+    С on_delta модель генерирует потоком, а куски текста передаются в колбэк из этого же потока.
+    Внутри отменяемой генерации (current_cancel_token) ответ тоже читается потоком, чтобы
+    прервать его между токенами и сразу освободить модель.
+    При LOCAL_WORKERS > 0 запрос выполняет процесс-исполнитель из пула (см. local_workers).
+    """
+    if Llama is None: raise ImportError("Модуль llama_cpp не установлен.")
+    model_path = _local_model_path(model)
+    if not os.path.exists(model_path): raise FileNotFoundError(f"Локальная модель не найдена по пути: {model_path}")
+    # Модель остается резидентной между вызовами (см. model_registry), параметры загрузки
+    # подобраны под железо и метаданные модели (см. local_tuning)
+    cancel_token = current_cancel_token.get()
+    cache_bytes = _get_local_prompt_cache_bytes() if LlamaRAMCache is not None else 0
+    messages = [{"role": "user", "content": prompt}]
+    options: Dict[str, Any] = {"temperature": LLM_TEMPERATURE, "response_format": response_format_option}
+    if max_tokens is not None:
+        options["max_tokens"] = max_tokens
+    pool = get_local_worker_pool()
+    params = _get_local_load_params(model_path)
+    if pool is not None:
+        load_kwargs = {
+            "n_ctx": params.pop("n_ctx"), "chat_format": "chatml", "extra_bytes": cache_bytes,
+            "prompt_cache_bytes": cache_bytes, "verbose": False, **params,
+        }
+        return pool.chat_completion(model_path, load_kwargs, messages, options, on_delta, cancel_token)
+    with local_model_registry.lease(
+        model_path, loader=_load_local_llama, n_ctx=params.pop("n_ctx"), chat_format="chatml", extra_bytes=cache_bytes,
+        prompt_cache_bytes=cache_bytes, verbose=False, **params,
+    ) as llm:
+        if on_delta is None and cancel_token is None:
+            return llm.create_chat_completion(messages=messages, stream=False, **options)
+        parts = []
+        finish_reason = None
+        for chunk in llm.create_chat_completion(messages=messages, stream=True, **options):
+            if cancel_token is not None:
+                cancel_token.raise_if_cancelled()
+            text = chunk["choices"][0].get("delta", {}).get("content")
+            finish_reason = chunk["choices"][0].get("finish_reason") or finish_reason
+            if text:
+                parts.append(text)
+                if on_delta is not None:
+                    on_delta(text)
+        return {"choices": [{"message": {"content": "".join(parts)}, "finish_reason": finish_reason}]}
+
+
+async def _astream_chat_completion(
+    client: Any, api_provider: str, request: Dict[str, Any], limiter: Any, on_delta: Callable[[str], None]
+) -> Tuple[str, Optional[int], Optional[str]]:
+    """Потоковый запрос к Groq/OpenAI. Возвращает полный текст, израсходованные токены и причину остановки."""
+    if api_provider == "groq":
+        # JSON mode у Groq не работает вместе со stream: формат ответа задает сам промпт
+        request.pop("response_format", None)
+    else:
+        request["stream_options"] = {"include_usage": True}
+    raw_response = await client.chat.completions.with_raw_response.create(stream=True, **request)
+    limiter.update_from_headers(raw_response.headers)
+    stream = await raw_response.parse()
+    parts: List[str] = []
+    used_tokens = None
+    finish_reason = None
+    try:
+        async for chunk in stream:
+            usage = getattr(chunk, "usage", None) or getattr(getattr(chunk, "x_groq", None), "usage", None)
+            if usage is not None and isinstance(getattr(usage, "total_tokens", None), int):
+                used_tokens = usage.total_tokens
+            if not chunk.choices:
+                continue
+            text = chunk.choices[0].delta.content
+            finish_reason = getattr(chunk.choices[0], "finish_reason", None) or finish_reason
+            if text:
+                parts.append(text)
+                on_delta(text)
+    finally:
+        # При отмене соединение возвращается в пул сразу, а не при сборке мусора
+        await _aclose_stream(stream)
+    return "".join(parts), used_tokens, finish_reason
+
+
+async def _aclose_stream(stream: Any) -> None:
+    close = getattr(stream, "close", None)
+    if callable(close):
+        result = close()
+        if inspect.isawaitable(result):
+            await result
+
+
+async def _astream_gemini(
+    gemini_model: Any, prompt: str, on_delta: Callable[[str], None], generation_config: Optional[Dict[str, Any]] = None,
+) -> Tuple[str, Optional[str]]:
+    """Потоковый запрос к Gemini. Возвращает полный текст и причину остановки."""
+    response = await gemini_model.generate_content_async(prompt, stream=True, **({"generation_config": generation_config} if generation_config else {}))
+    parts: List[str] = []
+    finish_reason = None
+    async for chunk in response:
+        finish_reason = _gemini_finish_reason(chunk) or finish_reason
+        try:
+            text = chunk.text
+        except ValueError:
+            continue  # кусок без текста (например, только метаданные безопасности)
+        if text:
+            parts.append(text)
+            on_delta(text)
+    return "".join(parts), finish_reason
+
+
+def _gemini_finish_reason(response: Any) -> Optional[str]:
+    candidates = getattr(response, "candidates", None)
+    reason = getattr(candidates[0], "finish_reason", None) if candidates else None
+    return getattr(reason, "name", reason) if reason else None
+
+
+# Причины остановки, при которых ответ обрезан пределом max_tokens: такие ответы не кэшируются
+TRUNCATED_FINISH_REASONS = ("length", "MAX_TOKENS")
+
+
+# Модели, отклонившие structured outputs (старые модели OpenAI): для них остается JSON mode
+_schema_unsupported: Set[Tuple[str, str]] = set()
+
+
+async def _acall_llm(
+    prompt: str, api_provider: str, api_key: str, model: str, force_text_response: bool = False, use_cache: bool = True,
+    on_delta: Optional[Callable[[str], None]] = None, max_wait: Optional[float] = None, schema: Optional[str] = None,
+    max_tokens: Optional[int] = None,
+) -> str:
+    """Запрос к LLM с повторами и лимитами. С on_delta ответ запрашивается потоком и
+    передается в колбэк по кускам; возвращаемый результат тот же, что и без потока.
+
+    Ответы 5xx/429 и сетевые сбои учитываются автоматом защиты провайдера. max_wait —
+    предельная пауза перед повтором: если провайдер просит ждать дольше, ошибка
+    возвращается сразу (вызывающий переключится на резервного провайдера).
+    schema — имя схемы ответа из structured_output.RESPONSE_SCHEMAS: OpenAI, Gemini и llama.cpp
+    получают ее как ограничение генерации. JSON-ответ, который модель все же испортила,
+    восстанавливается снисходительным разбором. max_tokens — предел длины ответа.
+    """
+    # Кэш ответов: use_cache=False пропускает чтение, но свежий ответ все равно сохраняется
+    cache = get_llm_cache()
+    cache_key = None
+    if cache is not None:
+        response_kind = "text" if force_text_response else (f"json_schema:{schema}" if schema else "json_object")
+        cache_key = cache.make_key(api_provider, model, prompt, response_kind, LLM_TEMPERATURE, max_tokens)
+        if use_cache:
+            cached = cache.get(cache_key)
+            if cached is not None:
+                logger.info(f"Ответ LLM взят из кэша ({api_provider}/{model}).")
+                if on_delta is not None:
+                    on_delta(cached)
+                return cached
+
     max_retries = 3
     delay = 1.0  # начальная задержка в секундах
+    limiter = get_rate_limiter(api_provider, api_key)
+    breaker = get_circuit_breaker(api_provider, api_key)
+    estimated_tokens = count_tokens(prompt, api_provider, model) + (max_tokens or EXPECTED_COMPLETION_TOKENS)
 
     for attempt in range(max_retries):
         try:
+            native_schema = schema is not None and not force_text_response and (api_provider, model) not in _schema_unsupported
+            # Общий для процесса лимитер: ждем ровно столько, сколько требуют лимиты провайдера
+            await limiter.acquire_async(estimated_tokens)
             response_content = None
+            used_tokens = None
+            finish_reason = None
+            streamed = False
             response_format_option = {"type": "text"} if force_text_response else {"type": "json_object"}
-            if api_provider == "groq":
-                client = Groq(api_key=api_key)
-                chat_completion = client.chat.completions.create(messages=[{"role": "user", "content": prompt}], model=model, temperature=0.7, response_format=response_format_option)
-                response_content = chat_completion.choices[0].message.content
-            elif api_provider == "openai":
-                client = openai.OpenAI(api_key=api_key)
-                chat_completion = client.chat.completions.create(messages=[{"role": "user", "content": prompt}], model=model, temperature=0.7, response_format=response_format_option)
-                response_content = chat_completion.choices[0].message.content
+            if api_provider in ("groq", "openai"):
+                client = get_async_client(api_provider, api_key)
+                request = {"messages": [{"role": "user", "content": prompt}], "model": model, "temperature": LLM_TEMPERATURE, "response_format": response_format_option}
+                if native_schema and api_provider == "openai":
+                    request["response_format"] = openai_response_format(schema)
+                if max_tokens is not None:
+                    request["max_completion_tokens" if api_provider == "openai" else "max_tokens"] = max_tokens
+                if on_delta is not None:
+                    response_content, used_tokens, finish_reason = await _astream_chat_completion(client, api_provider, request, limiter, on_delta)
+                    streamed = True
+                else:
+                    raw_response = await client.chat.completions.with_raw_response.create(**request)
+                    limiter.update_from_headers(raw_response.headers)
+                    chat_completion = await raw_response.parse()
+                    response_content = chat_completion.choices[0].message.content
+                    finish_reason = getattr(chat_completion.choices[0], "finish_reason", None)
+                    used_tokens = getattr(getattr(chat_completion, "usage", None), "total_tokens", None)
             elif api_provider == "gemini":
-                genai.configure(api_key=api_key)
-                gemini_model = genai.GenerativeModel(model)
-                response = gemini_model.generate_content(prompt)
-                response_content = response.text
+                gemini_model = get_async_client("gemini", api_key).async_generative_model(model)
+                generation_config = None if force_text_response else gemini_generation_config(schema if native_schema else None)
+                if max_tokens is not None:
+                    generation_config = {**(generation_config or {}), "max_output_tokens": max_tokens}
+                if on_delta is not None:
+                    response_content, finish_reason = await _astream_gemini(gemini_model, prompt, on_delta, generation_config)
+                    streamed = True
+                else:
+                    response = await gemini_model.generate_content_async(prompt, **({"generation_config": generation_config} if generation_config else {}))
+                    response_content = response.text
+                    finish_reason = _gemini_finish_reason(response)
             elif api_provider == "local":
-                if Llama is None: raise ImportError("Модуль llama_cpp не установлен.")
-                model_dir, model_path = os.getenv("LOCAL_MODEL_PATH", "quest-generator/models"), os.path.join(model_dir, model)
-                if not os.path.exists(model_path): raise FileNotFoundError(f"Локальная модель не найдена по пути: {model_path}")
-                llm = Llama(model_path=model_path, n_ctx=4096, n_gpu_layers=-1, verbose=False, chat_format="chatml")
-                chat_completion = llm.create_chat_completion(messages=[{"role": "user", "content": prompt}], temperature=0.7, response_format=response_format_option, stream=False)
+                thread_delta = None
+                if on_delta is not None:
+                    loop = asyncio.get_running_loop()
+                    thread_delta = lambda text: loop.call_soon_threadsafe(on_delta, text)  # noqa: E731
+                    streamed = True
+                if not force_text_response:
+                    # Со схемой llama.cpp ограничивает генерацию грамматикой, построенной по ней
+                    response_format_option = llama_response_format(schema if native_schema else None)
+                chat_completion = await asyncio.to_thread(_local_chat_completion, prompt, model, response_format_option, thread_delta, max_tokens)
                 response_content = chat_completion["choices"][0]["message"]["content"]
+                finish_reason = chat_completion["choices"][0].get("finish_reason")
             elif api_provider == "vps_proxy":
                 proxy_url = "http://91.184.253.216:5001/proxy/generate"
-                payload = {"prompt": prompt, "model": model}
+                payload: Dict[str, Any] = {"prompt": prompt, "model": model}
+                if max_tokens is not None:
+                    payload["max_tokens"] = max_tokens
                 logger.info(f"Отправка запроса на VPS прокси: {proxy_url}")
-                response = requests.post(proxy_url, json=payload, timeout=120)
+                response = await get_async_client("vps_proxy").post(proxy_url, json=payload, timeout=120)
+                limiter.update_from_headers(response.headers)
                 response.raise_for_status()
                 response_content = response.text
             else:
                 raise ValueError(f"Unknown API provider: {api_provider}")
 
+            if isinstance(used_tokens, int):
+                limiter.record_usage(estimated_tokens, used_tokens)
             if response_content is None: raise ValueError("LLM returned no content.")
+            if on_delta is not None and not streamed:
+                on_delta(response_content)  # провайдер без потоковой выдачи: весь ответ одним куском
             json_match = re.search(r"```(?:json)?\s*([\s\S]*?)\s*```", response_content)
-            return json_match.group(1) if json_match else response_content
+            result = json_match.group(1) if json_match else response_content
+            if not force_text_response:
+                result = normalize_json_response(result)
+            if finish_reason in TRUNCATED_FINISH_REASONS:
+                logger.warning(f"Ответ {api_provider}/{model} обрезан пределом max_tokens={max_tokens}.")
+            elif cache is not None and cache_key is not None and _is_cacheable(result, force_text_response):
+                cache.set(cache_key, result)
+            breaker.record_success()
+            return result
 
-        except (APIStatusError, openai.APIStatusError, requests.exceptions.HTTPError) as e:
+        except (APIStatusError, openai.APIStatusError, httpx.HTTPStatusError) as e:
             status_code = getattr(e, 'status_code', None) or getattr(e.response, 'status_code', -1)
 
+            if status_code == 400 and native_schema and api_provider == "openai" and attempt < max_retries - 1:
+                # Модель не поддерживает structured outputs: повторяем тот же запрос в JSON mode
+                logger.warning(f"{api_provider}/{model} отклонил схему ответа, используется JSON mode: {e}")
+                _schema_unsupported.add((api_provider, model))
+                continue
             is_retryable = status_code == 429 or status_code >= 500
+            if is_retryable:
+                breaker.record_failure(f"HTTP {status_code}")
+                if breaker.is_open:
+                    raise CircuitOpenError(f"Провайдер {api_provider} временно недоступен (ошибка {status_code}).") from e
 
             if is_retryable and attempt < max_retries - 1:
                 wait_time = delay
@@ -226,47 +609,557 @@ def _call_llm(prompt: str, api_provider: str, api_key: str, model: str, force_te
                     f"(Попытка {attempt + 1}/{max_retries})"
                 )
 
-                # Специальная обработка для Groq Rate Limit с извлечением времени ожидания
-                if api_provider == "groq" and status_code == 429:
-                    error_str = str(e)
-                    match = re.search(r"try again in (?:(\d+)m)?\s*(?:([\d.]+)s)?", error_str)
-                    if match:
-                        minutes = float(match.group(1)) if match.group(1) else 0
-                        seconds = float(match.group(2)) if match.group(2) else 0
-                        wait_time = minutes * 60 + seconds + 1  # Добавляем 1 секунду буфера
-                        log_message = (
-                            f"Groq API rate limit. Ожидание {wait_time:.1f} сек "
-                            f"(извлечено из ответа API)... (Попытка {attempt + 1}/{max_retries})"
-                        )
-
-                logger.warning(log_message)
-                time.sleep(wait_time)
-                delay *= 2  # Увеличиваем задержку для следующей возможной не-Groq ошибки
+                if status_code == 429:
+                    # Время ожидания берем из заголовков ответа, а для Groq — из текста ошибки
+                    response_headers = getattr(getattr(e, "response", None), "headers", None)
+                    retry_after = parse_reset_duration(response_headers.get("retry-after")) if response_headers is not None else None
+                    if retry_after:
+                        wait_time = retry_after
+                        log_message = f"{api_provider}: rate limit, ожидание {wait_time:.1f} сек (retry-after)... (Попытка {attempt + 1}/{max_retries})"
+                    elif api_provider == "groq":
+                        error_str = str(e)
+                        match = re.search(r"try again in (?:(\d+)m)?\s*(?:([\d.]+)s)?", error_str)
+                        if match:
+                            minutes = float(match.group(1)) if match.group(1) else 0
+                            seconds = float(match.group(2)) if match.group(2) else 0
+                            wait_time = minutes * 60 + seconds + 1  # Добавляем 1 секунду буфера
+                            log_message = (
+                                f"Groq API rate limit. Ожидание {wait_time:.1f} сек "
+                                f"(извлечено из ответа API)... (Попытка {attempt + 1}/{max_retries})"
+                            )
+                    # Пауза распространяется на все генерации, использующие этот ключ
+                    limiter.update_from_headers(response_headers)
+                    limiter.penalize(wait_time)
+                    logger.warning(log_message)
+                else:
+                    logger.warning(log_message)
+                if max_wait is not None and wait_time > max_wait:
+                    raise e  # ждать дольше max_wait не нужно: у вызывающего есть резервный провайдер
+                if status_code != 429:
+                    await asyncio.sleep(wait_time)
+                delay *= 2  # Увеличиваем задержку для следующей возможной ошибки
                 continue
             else:
                 logger.error(f"Не удалось выполнить запрос к API после {attempt + 1} попыток или ошибка не является временной.")
                 raise e  # Перевыбрасываем исключение, если все попытки исчерпаны
+        except (APIConnectionError, openai.APIConnectionError, httpx.TransportError, LocalWorkerError) as e:
+            breaker.record_failure(f"{type(e).__name__}: {e}")
+            logger.error(f"Сетевая ошибка при обращении к {api_provider}: {e}")
+            raise e
         except Exception as e:
              logger.error(f"Произошла непредвиденная ошибка при вызове LLM: {e}")
              raise e
+    raise RuntimeError("LLM call failed after retries.")  # недостижимо: последняя попытка либо возвращает, либо бросает
+
+
+def _is_cacheable(result: str, force_text_response: bool) -> bool:
+    """Невалидный JSON не кэшируем, чтобы повторный запуск мог получить исправленный ответ."""
+    if force_text_response:
+        return bool(result.strip())
+    try:
+        json.loads(result)
+        return True
+    except json.JSONDecodeError:
+        return False
+
+
+def _call_llm(
+    prompt: str, api_provider: str, api_key: str, model: str, force_text_response: bool = False, use_cache: bool = True,
+    on_delta: Optional[Callable[[str], None]] = None, schema: Optional[str] = None,
+) -> str:
+    """Синхронная обертка над _acall_llm для кода вне цикла событий (on_delta вызывается из потока цикла)."""
+    return run_sync(_acall_llm(prompt, api_provider, api_key, model, force_text_response, use_cache, on_delta, schema=schema))
+
+
+# Этапы конвейера: ключи для резервных цепочек провайдеров (LLM_FALLBACK_CHAIN_<STAGE>)
+PIPELINE_STAGES = ("concept", "architect", "director", "writer", "corrector")
+
+# Дольше этого паузу лимитов основного провайдера не ждем, если есть резервный (FAILOVER_MAX_WAIT)
+DEFAULT_FAILOVER_MAX_WAIT = 10.0
+
+# Резервные провайдеры: список целей {"api_provider", "model", "api_key"?} для всех этапов
+# или словарь {этап или "default": список}
+Fallbacks = Union[List[Dict[str, str]], Dict[str, List[Dict[str, str]]]]
+# Маршрутизация этапов: {этап: {"api_provider", "model", "api_key"?}}
+StageModels = Dict[str, Dict[str, str]]
+
+
+class LLMTarget(NamedTuple):
+    api_provider: str
+    api_key: str
+    model: str
+
+
+def _get_target_budget(stage: str, target: LLMTarget) -> StageBudget:
+    """Бюджет этапа для провайдера цепочки; локальной модели — по ее подобранному контексту."""
+    n_ctx = None
+    if target.api_provider == "local":
+        n_ctx = _get_local_load_params(_local_model_path(target.model))["n_ctx"]
+    return get_stage_budget(stage, target.api_provider, n_ctx)
+
+
+def _parse_fallback_env(value: str) -> List[Dict[str, str]]:
+    """'openai:gpt-4o-mini,local:model.gguf' -> список целей; ключи берутся из <PROVIDER>_API_KEY."""
+    targets = []
+    for item in value.split(","):
+        provider, _, model = item.strip().partition(":")
+        if provider and model:
+            targets.append({"api_provider": provider.strip(), "model": model.strip()})
+        elif item.strip():
+            logger.warning(f"Некорректный элемент цепочки провайдеров: {item!r} (ожидается provider:model)")
+    return targets
+
+
+def _target_from_item(item: Any, api_provider: str, api_key: str) -> Optional[LLMTarget]:
+    """Цель из {"api_provider", "model", "api_key"?}. Без ключа берется ключ запроса для того же
+    провайдера, иначе <PROVIDER>_API_KEY из окружения."""
+    if not isinstance(item, dict) or not item.get("api_provider") or not item.get("model"):
+        return None
+    provider = item["api_provider"]
+    key = item.get("api_key") or (api_key if provider == api_provider else os.getenv(f"{provider.upper()}_API_KEY", ""))
+    return LLMTarget(provider, key, item["model"])
+
+
+def _resolve_stage_route(
+    api_provider: str, api_key: str, stage_models: Optional[StageModels], stage: str
+) -> Optional[LLMTarget]:
+    """Модель этапа из stage_models запроса или из STAGE_MODEL_<STAGE> ('provider:model')."""
+    item = (stage_models or {}).get(stage)
+    if item is None:
+        env_targets = _parse_fallback_env(os.getenv(f"STAGE_MODEL_{stage.upper()}", ""))
+        item = env_targets[0] if env_targets else None
+    return _target_from_item(item, api_provider, api_key)
+
+
+def _build_llm_chain(
+    api_provider: str, api_key: str, model: str, fallbacks: Optional[Fallbacks], stage: str,
+    stage_models: Optional[StageModels] = None,
+) -> List[LLMTarget]:
+    """Цепочка провайдеров этапа: модель этапа (stage_models), резервные, затем основная модель
+    запроса. Без fallbacks резервные берутся из LLM_FALLBACK_CHAIN_<STAGE> или LLM_FALLBACK_CHAIN."""
+    if fallbacks is None:
+        env_value = os.getenv(f"LLM_FALLBACK_CHAIN_{stage.upper()}") or os.getenv("LLM_FALLBACK_CHAIN", "")
+        items = _parse_fallback_env(env_value)
+    elif isinstance(fallbacks, dict):
+        items = fallbacks.get(stage, fallbacks.get("default", []))
+    else:
+        items = fallbacks
+    main_target = LLMTarget(api_provider, api_key, model)
+    route = _resolve_stage_route(api_provider, api_key, stage_models, stage)
+    chain = [route or main_target]
+    for target in [_target_from_item(item, api_provider, api_key) for item in items] + [main_target]:
+        if target is not None and target not in chain:
+            chain.append(target)
+    return chain
+
+
+# Списки моделей провайдеров для проверки маршрутов: (провайдер, ключ) -> (время, модели)
+_model_list_cache: Dict[Tuple[str, str], Tuple[float, Set[str]]] = {}
+MODEL_LIST_TTL = 300.0
+
+
+def _strip_model_date(name: str) -> str:
+    return re.sub(r"-\d{4}$", "", re.sub(r"-\d{4}-\d{2}-\d{2}$", "", name))
+
+
+def validate_stage_models(api_provider: str, api_key: str, stage_models: Optional[StageModels]) -> Optional[str]:
+    """Проверяет маршруты этапов (из запроса и STAGE_MODEL_<STAGE>) по get_available_models.
+    Возвращает текст ошибки или None. Списки моделей кэшируются на MODEL_LIST_TTL секунд."""
+    if stage_models is not None and not isinstance(stage_models, dict):
+        return "stage_models должен быть объектом {этап: {api_provider, model}}."
+    unknown = set(stage_models or {}) - set(PIPELINE_STAGES)
+    if unknown:
+        return f"Неизвестные этапы в stage_models: {', '.join(sorted(unknown))}. Допустимы: {', '.join(PIPELINE_STAGES)}."
+    for stage in PIPELINE_STAGES:
+        if stage_models and stage in stage_models and _target_from_item(stage_models[stage], api_provider, api_key) is None:
+            return f"Для этапа {stage} нужны api_provider и model."
+        target = _resolve_stage_route(api_provider, api_key, stage_models, stage)
+        if target is None or target.api_provider == "vps_proxy":
+            continue  # у прокси нет списка моделей
+        cache_key = (target.api_provider, target.api_key)
+        cached = _model_list_cache.get(cache_key)
+        if cached is None or time.monotonic() - cached[0] > MODEL_LIST_TTL:
+            result = get_available_models(target.api_provider, target.api_key)
+            if "error" in result:
+                return f"Не удалось получить модели {target.api_provider} для этапа {stage}: {result['error']}"
+            if "models" in result:
+                names = {m["name"] for m in result["models"]}
+            else:
+                names = set(result.get("free", [])) | set(result.get("paid", []))
+            cached = (time.monotonic(), names)
+            _model_list_cache[cache_key] = cached
+        if target.model not in cached[1] and _strip_model_date(target.model) not in {_strip_model_date(n) for n in cached[1]}:
+            return f"Модель {target.model} недоступна у провайдера {target.api_provider} (этап {stage})."
+    return None
+
+
+def _get_failover_max_wait() -> float:
+    try:
+        return float(os.getenv("FAILOVER_MAX_WAIT", str(DEFAULT_FAILOVER_MAX_WAIT)))
+    except ValueError:
+        return DEFAULT_FAILOVER_MAX_WAIT
+
+
+async def _acall_llm_failover(
+    prompt: str, chain: List[LLMTarget], force_text_response: bool = False, use_cache: bool = True,
+    on_delta: Optional[Callable[[str], None]] = None, on_switch: Optional[Callable[[LLMTarget], None]] = None,
+    on_served: Optional[Callable[[LLMTarget, str, str], None]] = None, schema: Optional[str] = None,
+    budget_stage: Optional[str] = None,
+) -> str:
+    """_acall_llm по цепочке провайдеров: следующий берется, если предыдущий упал, отключен
+    автоматом защиты или стоит в долгой паузе лимитов. on_switch вызывается перед каждым
+    резервным провайдером (например, чтобы сбросить уже показанный кусок потока),
+    on_served — с провайдером, который ответил, промптом и ответом.
+    budget_stage — вид вызова в token_budget: задает предел ответа для каждого провайдера.
+    """
+    max_wait = _get_failover_max_wait()
+    last_error: Optional[Exception] = None
+    for position, target in enumerate(chain):
+        has_next = position < len(chain) - 1
+        breaker = get_circuit_breaker(target.api_provider, target.api_key)
+        if has_next and get_rate_limiter(target.api_provider, target.api_key).blocked_for() > max_wait:
+            logger.warning(f"{target.api_provider}: пауза лимитов дольше {max_wait:.0f} сек, переключение на резервного провайдера.")
+            continue
+        if not breaker.allow():
+            last_error = CircuitOpenError(f"Провайдер {target.api_provider} временно недоступен (автомат защиты открыт).")
+            logger.warning(str(last_error))
+            continue
+        if position > 0 and on_switch is not None:
+            on_switch(target)
+        try:
+            kwargs: Dict[str, Any] = {"max_wait": max_wait} if has_next else {}
+            if budget_stage is not None:
+                budget = _get_target_budget(budget_stage, target)
+                prompt_tokens = count_tokens(prompt, target.api_provider, target.model)
+                if prompt_tokens > budget.input_tokens:
+                    logger.warning(f"Промпт этапа {budget_stage} ({prompt_tokens} токенов) больше бюджета {budget.input_tokens}.")
+                kwargs["max_tokens"] = budget.output_tokens
+            result = await _acall_llm(
+                prompt, target.api_provider, target.api_key, target.model, force_text_response, use_cache, on_delta, schema=schema, **kwargs,
+            )
+        except GenerationCancelled:
+            breaker.release_probe()
+            raise
+        except Exception as e:
+            breaker.release_probe()
+            if not has_next:
+                raise
+            logger.warning(f"{target.api_provider}/{target.model} не ответил ({e}), переключение на резервного провайдера.")
+            last_error = e
+            continue
+        breaker.release_probe()
+        if on_served is not None:
+            on_served(target, prompt, result)
+        return result
+    raise last_error or CircuitOpenError("Все провайдеры цепочки временно недоступны.")
+
+
+# Сколько сцен этапа 4 детализируются одновременно (переопределяется LLM_CONCURRENCY_<PROVIDER>)
+DEFAULT_PROVIDER_CONCURRENCY = {"groq": 4, "openai": 8, "gemini": 4, "local": 1, "vps_proxy": 2}
+
+
+def _get_provider_concurrency(api_provider: str) -> int:
+    env_value = os.getenv(f"LLM_CONCURRENCY_{api_provider.upper()}")
+    if env_value:
+        try:
+            return max(1, int(env_value))
+        except ValueError:
+            logger.warning(f"Некорректное значение LLM_CONCURRENCY_{api_provider.upper()}: {env_value}")
+    if api_provider == "local" and get_local_workers_count() > 0:
+        return get_local_workers_count()  # по сцене на процесс-исполнитель
+    return DEFAULT_PROVIDER_CONCURRENCY.get(api_provider, 1)
+
+
+def _apply_scene_detail(scene: Dict[str, Any], detailed_json: Dict[str, Any]) -> None:
+    scene["text"] = detailed_json.get("text", "Описание не было сгенерировано.")
+    detailed_choices_text = detailed_json.get("choices_text", [])
+    for choice_idx, choice in enumerate(scene.get("choices", [])):
+        choice["text"] = detailed_choices_text[choice_idx] if choice_idx < len(detailed_choices_text) else choice.get("choice_summary", "...")
+        choice.pop("choice_summary", None)
+
+
+async def _detail_scenes_dataflow(
+    scenes: List[Dict[str, Any]], graph: QuestGraph, setting_text: str,
+    api_provider: str, api_key: str, model: str, max_workers: int, use_cache: bool = True,
+    restored: Optional[Dict[int, Dict[str, Any]]] = None,
+    on_scene_done: Optional[Callable[[int, Dict[str, Any]], None]] = None,
+    cancel_token: Optional[CancelToken] = None, chain: Optional[List[LLMTarget]] = None,
+    on_served: Optional[Callable[[LLMTarget, str, str], None]] = None,
+    lore_index: Optional[LoreIndex] = None,
+) -> AsyncIterator[str]:
+    """Детализирует сцены параллельно: сцена стартует, как только готов текст ее родителя.
+
+    Время этапа определяется глубиной графа, а не числом сцен. Порядок сцен в
+    квесте не меняется — результаты записываются в исходные объекты сцен.
+    restored — уже готовые ответы сценариста по индексам сцен (продолжение запуска),
+    on_scene_done вызывается с ответом для каждой новой сцены (контрольная точка).
+    chain — цепочка провайдеров этапа (по умолчанию строится из api_provider/model).
+    lore_index — индекс полного сеттинга: промпт сцены получает фрагменты, относящиеся к ней.
+    """
+    cancel_token = cancel_token or CancelToken()
+    chain = chain or _build_llm_chain(api_provider, api_key, model, None, "writer")
+    parent_links = graph.parent_links()
+    # Краткое описание выбора, ведущего в сцену; запоминаем заранее — детализация родителя его удаляет
+    choice_summaries = [
+        scenes[link[0]]["choices"][link[1]].get("choice_summary", "...") if link is not None else None
+        for link in parent_links
+    ]
+    pending = list(range(len(scenes)))
+    finished = [False] * len(scenes)
+    for i, saved_detail in sorted((restored or {}).items()):
+        if 0 <= i < len(scenes):
+            _apply_scene_detail(scenes[i], saved_detail)
+            finished[i] = True
+            pending.remove(i)
+            yield json.dumps({"status": "scene_ready", "scene": scenes[i]}, ensure_ascii=False)
+
+    def is_ready(i: int) -> bool:
+        link = parent_links[i]
+        return link is None or link[0] == i or finished[link[0]]
+
+    def build_prompt(i: int) -> str:
+        scene = scenes[i]
+        summary = scene.get("summary", "Нет описания.")
+        history_choice, previous_scene_text = f"Это стартовая ситуация: '{summary}'.", ""
+        link = parent_links[i]
+        if link is not None:
+            # Из длинного текста родителя сценаристу нужен прежде всего конец — к нему примыкает сцена
+            previous_scene_text = truncate_to_tokens(scenes[link[0]].get("text", ""), get_previous_scene_tokens(), keep_tail=True)
+            history_choice = f"Вы решили: '{choice_summaries[i]}'. Это привело вас к следующей ситуации: '{summary}'."
+        lore_excerpts = None
+        if lore_index is not None:
+            lore_excerpts = lore_index.retrieve(f"{summary} {choice_summaries[i] or ''}", get_lore_top_k())
+        return _get_scene_detail_prompt(setting_text, summary, history_choice, previous_scene_text, lore_excerpts)
+
+    # Задачи сцен сообщают о кусках текста и о завершении через общую очередь
+    events: "asyncio.Queue[Tuple[str, int, Any]]" = asyncio.Queue()
+
+    async def detail(i: int) -> None:
+        streamer = JsonStringFieldStreamer("text")
+
+        def on_delta(chunk: str) -> None:
+            text = streamer.feed(chunk)
+            if text:
+                events.put_nowait(("delta", i, text))
+
+        def on_switch(target: LLMTarget) -> None:
+            # Резервный провайдер пишет сцену заново: черновик прежнего больше не нужен
+            nonlocal streamer
+            streamer = JsonStringFieldStreamer("text")
+            events.put_nowait(("reset", i, None))
+
+        try:
+            result = await cancel_token.guard(_acall_llm_failover(
+                build_prompt(i), chain, False, use_cache, on_delta, on_switch, on_served, schema="scene_detail", budget_stage="writer",
+            ))
+        except Exception as e:
+            events.put_nowait(("error", i, e))
+        else:
+            events.put_nowait(("done", i, result))
+
+    running: Dict[int, "asyncio.Task[None]"] = {}
+    try:
+        while pending or running:
+            cancel_token.raise_if_cancelled()
+            ready = [i for i in pending if is_ready(i)]
+            if not ready and not running:
+                # Цикл в графе: родитель не может быть готов раньше сцены. Запускаем
+                # первую ожидающую сцену без текста родителя, чтобы не зависнуть.
+                ready = pending[:1]
+            for i in ready[: max_workers - len(running)]:
+                pending.remove(i)
+                yield json.dumps({"status": "detailing_scene", "scene_id": scenes[i]["scene_id"], "message": f"4/6: Сценарист пишет текст для сцены {i + 1}/{len(scenes)}..."})
+                running[i] = asyncio.ensure_future(detail(i))
+
+            batch = [await events.get()]
+            while not events.empty():
+                batch.append(events.get_nowait())
+            # Накопившиеся куски одной сцены отправляем одной строкой NDJSON
+            deltas: Dict[int, List[str]] = {}
+            resets: Set[int] = set()
+            completed: List[Tuple[int, str]] = []
+            errors: List[Exception] = []
+            for kind, i, payload in batch:
+                if kind == "delta":
+                    deltas.setdefault(i, []).append(payload)
+                    continue
+                if kind == "reset":
+                    deltas[i] = []
+                    resets.add(i)
+                    continue
+                running.pop(i, None)
+                if kind == "done":
+                    completed.append((i, payload))
+                else:
+                    errors.append(payload)
+            for i, parts in deltas.items():
+                delta_event = {"status": "scene_delta", "scene_id": scenes[i]["scene_id"], "delta": "".join(parts)}
+                if i in resets:
+                    delta_event["reset"] = True  # черновик сцены начинается заново
+                yield json.dumps(delta_event, ensure_ascii=False)
+            if errors:
+                raise errors[0]
+            for i, result in completed:
+                detailed_json = json.loads(result)
+                _apply_scene_detail(scenes[i], detailed_json)
+                finished[i] = True
+                if on_scene_done is not None:
+                    on_scene_done(i, detailed_json)
+                yield json.dumps({"status": "scene_ready", "scene": scenes[i]}, ensure_ascii=False)
+    finally:
+        # Ошибка или закрытие генератора: незавершенные запросы больше не нужны
+        for task in running.values():
+            task.cancel()
+        if running:
+            await asyncio.gather(*running.values(), return_exceptions=True)
+
+
+def _diff_quests(before: Dict[str, Any], after: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Отличия квеста after от before в виде операций над сценами и полями верхнего уровня.
+
+    Операции: {"op": "set_scene", "scene_id", "scene"} (сцена изменена или добавлена),
+    {"op": "remove_scene", "scene_id"}, {"op": "set", "key", "value"}, {"op": "unset", "key"}.
+    """
+    changes: List[Dict[str, Any]] = []
+    for key in after:
+        if key != "scenes" and (key not in before or before[key] != after[key]):
+            changes.append({"op": "set", "key": key, "value": after[key]})
+    for key in before:
+        if key != "scenes" and key not in after:
+            changes.append({"op": "unset", "key": key})
+
+    before_scenes = {scene.get("scene_id"): scene for scene in before.get("scenes", [])}
+    after_ids = set()
+    for scene in after.get("scenes", []):
+        scene_id = scene.get("scene_id")
+        after_ids.add(scene_id)
+        if before_scenes.get(scene_id) != scene:
+            changes.append({"op": "set_scene", "scene_id": scene_id, "scene": scene})
+    for scene_id in before_scenes:
+        if scene_id not in after_ids:
+            changes.append({"op": "remove_scene", "scene_id": scene_id})
+    return changes
+
+
+# Размер куска для корректора в токенах (переопределяется CORRECTION_CHUNK_TOKENS)
+DEFAULT_CORRECTION_CHUNK_TOKENS = 1500
+
+
+def _get_correction_chunk_tokens(chain: List[LLMTarget]) -> int:
+    """Размер куска для цепочки корректора: кусок должен подойти любой ее локальной модели."""
+    env_value = os.getenv("CORRECTION_CHUNK_TOKENS")
+    if env_value:
+        try:
+            return max(1, int(env_value))
+        except ValueError:
+            logger.warning(f"Некорректное значение CORRECTION_CHUNK_TOKENS: {env_value}")
+    chunk_tokens = DEFAULT_CORRECTION_CHUNK_TOKENS
+    for target in chain:
+        if target.api_provider == "local":
+            # В подобранный контекст модели должны поместиться инструкция, кусок и почти такой же по длине ответ
+            n_ctx = _get_local_load_params(_local_model_path(target.model))["n_ctx"]
+            overhead = _estimate_tokens(_get_correction_prompt(""))
+            chunk_tokens = min(chunk_tokens, max(256, (n_ctx - overhead) // 2 - 128))
+    return chunk_tokens
+
+
+def _split_for_correction(scenes: List[Dict[str, Any]], max_tokens: int) -> List[List[Dict[str, Any]]]:
+    """Режет тексты сцен на куски не больше max_tokens. Корректору уходят только тексты,
+    поэтому структура квеста (переходы, id) не может быть им испорчена."""
+    chunks: List[List[Dict[str, Any]]] = []
+    current: List[Dict[str, Any]] = []
+    current_tokens = 0
+    for scene in scenes:
+        payload = {
+            "scene_id": scene["scene_id"],
+            "text": scene.get("text", ""),
+            "choices": [{"text": choice.get("text", "")} for choice in scene.get("choices", [])],
+        }
+        tokens = _estimate_tokens(json.dumps(payload, ensure_ascii=False))
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append(current)
+            current, current_tokens = [], 0
+        current.append(payload)
+        current_tokens += tokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _merge_corrected_chunk(scenes_by_id: Dict[str, Dict[str, Any]], corrected: Any) -> int:
+    """Переносит исправленные тексты в сцены по scene_id. Возвращает число обновленных сцен."""
+    items = corrected.get("scenes") if isinstance(corrected, dict) else corrected
+    if not isinstance(items, list):
+        return 0
+    updated = 0
+    for item in items:
+        if not isinstance(item, dict) or item.get("scene_id") not in scenes_by_id:
+            continue
+        scene = scenes_by_id[item["scene_id"]]
+        if isinstance(item.get("text"), str) and item["text"].strip():
+            scene["text"] = item["text"]
+        corrected_choices = item.get("choices")
+        if isinstance(corrected_choices, list) and len(corrected_choices) == len(scene.get("choices", [])):
+            for choice, corrected_choice in zip(scene["choices"], corrected_choices):
+                text = corrected_choice.get("text") if isinstance(corrected_choice, dict) else None
+                if isinstance(text, str) and text.strip():
+                    choice["text"] = text
+        updated += 1
+    return updated
+
+
+async def _correct_quest_chunked(
+    quest: Dict[str, Any], api_provider: str, api_key: str, model: str, use_cache: bool = True,
+    scene_ids: Optional[Set[str]] = None, cancel_token: Optional[CancelToken] = None,
+    chain: Optional[List[LLMTarget]] = None, on_served: Optional[Callable[[LLMTarget, str, str], None]] = None,
+) -> AsyncIterator[str]:
+    """Вычитывает тексты квеста параллельными кусками и записывает исправления в quest на месте.
+
+    scene_ids ограничивает вычитку указанными сценами (None — все сцены).
+    """
+    cancel_token = cancel_token or CancelToken()
+    chain = chain or _build_llm_chain(api_provider, api_key, model, None, "corrector")
+    scenes_by_id = {scene["scene_id"]: scene for scene in quest.get("scenes", [])}
+    scenes = [scene for scene in quest.get("scenes", []) if scene_ids is None or scene["scene_id"] in scene_ids]
+    chunks = _split_for_correction(scenes, _get_correction_chunk_tokens(chain))
+    semaphore = asyncio.Semaphore(_get_provider_concurrency(api_provider))
+
+    async def correct(chunk: List[Dict[str, Any]]) -> str:
+        async with semaphore:
+            prompt = _get_correction_prompt(json.dumps({"scenes": chunk}, ensure_ascii=False))
+            return await cancel_token.guard(_acall_llm_failover(
+                prompt, chain, force_text_response=False, use_cache=use_cache, on_served=on_served, schema="corrected_chunk",
+                budget_stage="corrector",
+            ))
+
+    tasks = [asyncio.ensure_future(correct(chunk)) for chunk in chunks]
+    try:
+        for done_count, future in enumerate(asyncio.as_completed(tasks), 1):
+            corrected_str = await future
+            try:
+                corrected = json.loads(corrected_str)
+            except json.JSONDecodeError:
+                # Вычитка косметическая: невалидный ответ оставляет исходные тексты куска
+                logger.warning("Корректор вернул невалидный JSON, часть текста оставлена без вычитки.")
+                corrected = None
+            _merge_corrected_chunk(scenes_by_id, corrected)
+            yield json.dumps({"status": "correcting", "message": f"6/6: Корректор вычитал часть {done_count}/{len(chunks)}..."})
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
 
 # ЭТАП 5: "ЦЕНЗОР" (ФИНАЛЬНАЯ ВАЛИДАЦИЯ)
-def _validate_and_clean_quest(quest_json: Dict[str, Any]) -> Dict[str, Any]:
+def _validate_and_clean_quest(quest_json: Dict[str, Any], graph: Optional[QuestGraph] = None) -> Dict[str, Any]:
+    """Удаляет сцены, недостижимые из стартовой, и переходы в них (линейно по размеру графа).
+
+    graph — уже построенный граф этого квеста, если структура с тех пор не менялась.
+    """
     if "scenes" not in quest_json or not quest_json["scenes"]: return quest_json
-    all_scene_ids = {scene["scene_id"] for scene in quest_json["scenes"]}
-    reachable_ids: Set[str] = set()
-    queue = [quest_json.get("start_scene")]
-    while queue:
-        current_id = queue.pop(0)
-        if current_id and current_id in all_scene_ids and current_id not in reachable_ids:
-            reachable_ids.add(current_id)
-            current_scene = next((s for s in quest_json["scenes"] if s["scene_id"] == current_id), None)
-            if current_scene:
-                for choice in current_scene.get("choices", []):
-                    next_id = choice.get("next_scene")
-                    if next_id: queue.append(next_id)
-    unreachable_ids = all_scene_ids - reachable_ids
+    graph = graph or QuestGraph(quest_json)
+    reachable_ids = graph.reachable_ids()
+    unreachable_ids = set(graph.index) - reachable_ids
     if unreachable_ids:
         logger.warning(f"Обнаружены и будут удалены недостижимые сцены: {unreachable_ids}")
         quest_json["scenes"] = [scene for scene in quest_json["scenes"] if scene["scene_id"] in reachable_ids]
@@ -276,95 +1169,391 @@ def _validate_and_clean_quest(quest_json: Dict[str, Any]) -> Dict[str, Any]:
     return quest_json
 
 
+async def _adigest_setting(
+    setting_text: str, chain: List[LLMTarget], use_cache: bool, cancel_token: CancelToken,
+    on_served: Optional[Callable[[LLMTarget, str, str], None]] = None,
+) -> str:
+    """Сжимает сеттинг до SETTING_MAX_TOKENS скользящим пересказом: части, которые умещаются
+    в бюджет промпта, по очереди дописываются в выжимку."""
+    target_tokens = get_setting_tokens()
+    budget = StageBudget(
+        min(_get_target_budget("setting_digest", t).input_tokens for t in chain),
+        min(_get_target_budget("setting_digest", t).output_tokens for t in chain),
+    )
+    target_tokens = min(target_tokens, budget.output_tokens)
+    overhead = estimate_tokens(_get_setting_digest_prompt("", "", target_tokens))
+    part_tokens = max(256, budget.input_tokens - overhead - target_tokens)
+    digest = ""
+    for part in split_by_tokens(setting_text, part_tokens):
+        digest = await cancel_token.guard(_acall_llm_failover(
+            _get_setting_digest_prompt(part, digest, target_tokens), chain, force_text_response=True, use_cache=use_cache,
+            on_served=on_served, budget_stage="setting_digest",
+        ))
+        digest = truncate_to_tokens(digest.strip(), target_tokens)
+    return digest
+
+
+def _parse_scene_list(scene_list_text: str) -> List[Dict[str, str]]:
+    """Нумерованный список архитектора -> сцены с простыми ID (scene_1, scene_2, ...)."""
+    scenes_for_graph = []
+    for i, line in enumerate(scene_list_text.strip().split('\n')):
+        clean_line = re.sub(r'^\d+\.\s*', '', line).strip()
+        if clean_line:
+            # Генерируем простой ID, чтобы избежать ошибок LLM
+            scene_id = f"scene_{i+1}"
+            scenes_for_graph.append({"scene_id": scene_id, "summary": clean_line})
+    if not scenes_for_graph:
+        raise ValueError("Архитектор не смог извлечь ни одной сцены из концепта.")
+    return scenes_for_graph
+
+
+class _ServedModels:
+    """Цепочки провайдеров этапов, модели, которые на них фактически ответили, и расход токенов."""
+
+    def __init__(self, chains: Dict[str, List[LLMTarget]]):
+        self.chains = chains
+        self.models: Dict[str, List[str]] = {stage: [] for stage in chains}
+        self.usage: Dict[str, StageTokenUsage] = {stage: StageTokenUsage() for stage in chains}
+
+    def recorder(self, stage: str) -> Callable[[LLMTarget, str, str], None]:
+        def record(target: LLMTarget, prompt: str, result: str) -> None:
+            name = f"{target.api_provider}/{target.model}"
+            if name not in self.models[stage]:
+                self.models[stage].append(name)
+            self.usage[stage].record(prompt, result, target.api_provider, target.model)
+        return record
+
+    def planned(self, stage: str) -> str:
+        return f"{self.chains[stage][0].api_provider}/{self.chains[stage][0].model}"
+
+    def event(self, stage: str) -> str:
+        return json.dumps({"status": "stage_model", "stage": stage, "models": self.models[stage], "tokens": self.usage[stage].snapshot()})
+
+
+# Режимы конвейера: full — этапы по отдельности, fast — объединенные этапы (меньше вызовов LLM)
+PIPELINE_MODES = ("full", "fast")
+
+# Быстрый режим пишет граф и тексты сцен одним вызовом только для квестов до стольких сцен
+DEFAULT_FAST_MODE_MAX_SCENES = 10
+
+
+class FusedOutputError(ValueError):
+    """Объединенный ответ быстрого режима не прошел проверку."""
+
+
+def _get_pipeline_mode(pipeline_mode: Optional[str]) -> str:
+    mode = pipeline_mode or os.getenv("PIPELINE_MODE", "full")
+    if mode not in PIPELINE_MODES:
+        raise ValueError(f"Неизвестный режим конвейера: {mode}. Допустимы: {', '.join(PIPELINE_MODES)}.")
+    return mode
+
+
+def _get_fast_mode_max_scenes() -> int:
+    try:
+        return int(os.getenv("FAST_MODE_MAX_SCENES", str(DEFAULT_FAST_MODE_MAX_SCENES)))
+    except ValueError:
+        logger.warning(f"Некорректное FAST_MODE_MAX_SCENES, используется {DEFAULT_FAST_MODE_MAX_SCENES}.")
+        return DEFAULT_FAST_MODE_MAX_SCENES
+
+
+def _load_fused_json(result: str) -> Dict[str, Any]:
+    try:
+        data = json.loads(result)
+    except json.JSONDecodeError as e:
+        raise FusedOutputError(f"ответ не является JSON ({e})") from None
+    if not isinstance(data, dict):
+        raise FusedOutputError("ответ не является JSON-объектом")
+    return data
+
+
+def _parse_fast_outline(result: str) -> Tuple[str, List[str]]:
+    """Концепт и описания сцен из ответа _get_fast_outline_prompt."""
+    data = _load_fused_json(result)
+    concept, summaries = data.get("concept"), data.get("scenes")
+    if not isinstance(concept, str) or not concept.strip():
+        raise FusedOutputError("нет концепта")
+    if not isinstance(summaries, list) or len(summaries) < 2 or not all(isinstance(x, str) and x.strip() for x in summaries):
+        raise FusedOutputError("список сцен пуст или содержит не строки")
+    return concept.strip(), [x.strip() for x in summaries]
+
+
+def _parse_fast_quest(result: str, scenes_for_graph: List[Dict[str, str]]) -> Tuple[Dict[str, Any], Dict[int, Dict[str, Any]]]:
+    """Скелет (как у режиссёра) и ответы сценариста по индексам сцен из ответа _get_fast_quest_prompt."""
+    data = _load_fused_json(result)
+    scenes = data.get("scenes")
+    if not isinstance(scenes, list):
+        raise FusedOutputError("нет списка сцен")
+    by_id: Dict[str, Dict[str, Any]] = {}
+    for scene in scenes:
+        if not isinstance(scene, dict) or not isinstance(scene.get("scene_id"), str):
+            raise FusedOutputError("сцена без scene_id")
+        if not isinstance(scene.get("text"), str) or not scene["text"].strip():
+            raise FusedOutputError(f"у сцены {scene['scene_id']} нет текста")
+        choices = scene.get("choices", [])
+        if not isinstance(choices, list) or not all(
+            isinstance(c, dict) and isinstance(c.get("text"), str) and isinstance(c.get("next_scene"), str) for c in choices
+        ):
+            raise FusedOutputError(f"некорректные выборы в сцене {scene['scene_id']}")
+        by_id[scene["scene_id"]] = scene
+    expected = [scene["scene_id"] for scene in scenes_for_graph]
+    if len(scenes) != len(expected) or set(by_id) != set(expected):
+        raise FusedOutputError("сцены не совпадают со списком архитектора")
+    skeleton = {
+        "start_scene": data.get("start_scene"),
+        "scenes": [
+            {
+                "scene_id": scene["scene_id"], "summary": scene["summary"],
+                # Текст выбора уже готов: сценарист возьмет его вместо choice_summary
+                "choices": [{"choice_summary": c["text"], "next_scene": c["next_scene"]} for c in by_id[scene["scene_id"]]["choices"]],
+            }
+            for scene in scenes_for_graph
+        ],
+    }
+    details = {i: {"text": by_id[scene["scene_id"]]["text"], "choices_text": []} for i, scene in enumerate(scenes_for_graph)}
+    return skeleton, details
+
+
+async def _afast_draft(
+    store: Any, run_id: str, setting_text: str, scene_count: int, tone: str, pacing: str, narrative_elements: List[str],
+    served: _ServedModels, use_cache: bool, cancel_token: CancelToken,
+) -> AsyncIterator[str]:
+    """Быстрый режим: концепт со списком сцен одним вызовом, а для небольших квестов — граф
+    с текстами сцен вторым. Результаты сохраняются как контрольные точки этапов 1-4, и
+    обычный конвейер пропускает готовые этапы. Если объединенный ответ не прошел проверку,
+    недостающие этапы выполнит обычный конвейер.
+    """
+    if store.load_stage(run_id, "concept") is None:
+        cancel_token.raise_if_cancelled()
+        yield json.dumps({"status": "concept", "message": "1/6: Быстрый режим: концепт и список сцен одним запросом...", "model": served.planned("concept")})
+        result = await cancel_token.guard(_acall_llm_failover(
+            _get_fast_outline_prompt(setting_text, scene_count, tone, pacing, narrative_elements),
+            served.chains["concept"], force_text_response=False, use_cache=use_cache, on_served=served.recorder("concept"),
+            schema="fast_outline", budget_stage="fast_outline",
+        ))
+        yield served.event("concept")
+        try:
+            plot_concept, summaries = _parse_fast_outline(result)
+        except FusedOutputError as e:
+            yield _fast_fallback_event("concept", e)
+            return
+        store.save_stage(run_id, "concept", plot_concept)
+        store.save_stage(run_id, "scene_list", "\n".join(f"{i}. {summary}" for i, summary in enumerate(summaries, start=1)))
+
+    plot_concept, scene_list_text = store.load_stage(run_id, "concept"), store.load_stage(run_id, "scene_list")
+    if scene_list_text is None or store.load_stage(run_id, "skeleton") is not None:
+        return
+    scenes_for_graph = _parse_scene_list(scene_list_text)
+    if len(scenes_for_graph) > _get_fast_mode_max_scenes():
+        return  # большой квест не поместится в один ответ: граф и сцены пишут обычные этапы
+    cancel_token.raise_if_cancelled()
+    yield json.dumps({"status": "director", "message": "3/6: Быстрый режим: граф и тексты сцен одним запросом...", "model": served.planned("writer")})
+    result = await cancel_token.guard(_acall_llm_failover(
+        _get_fast_quest_prompt(setting_text, plot_concept, json.dumps(scenes_for_graph, ensure_ascii=False, indent=2)),
+        served.chains["writer"], force_text_response=False, use_cache=use_cache, on_served=served.recorder("writer"),
+        schema="fast_quest", budget_stage="fast_quest",
+    ))
+    try:
+        skeleton_json, details = _parse_fast_quest(result, scenes_for_graph)
+    except FusedOutputError as e:
+        yield _fast_fallback_event("director", e)
+        return
+    repair_report = repair_quest_graph(skeleton_json)
+    if repair_report["changed"]:
+        yield json.dumps({"status": "graph_repair", "message": "3/6: Структура графа исправлена автоматически.", "report": repair_report}, ensure_ascii=False)
+    store.save_stage(run_id, "skeleton", skeleton_json)
+    for index, detail in details.items():
+        store.save_scene(run_id, index, detail)
+
+
+def _fast_fallback_event(stage: str, error: Exception) -> str:
+    logger.warning(f"Быстрый режим: ответ этапа {stage} не прошел проверку ({error}), продолжаем обычным конвейером.")
+    return json.dumps({
+        "status": "fast_fallback", "stage": stage, "reason": str(error),
+        "message": "Быстрый режим: ответ не прошел проверку, продолжаем обычным конвейером...",
+    }, ensure_ascii=False)
+
+
 # ГЛАВНАЯ ФУНКЦИЯ-ОРКЕСТРАТОР
-def create_quest_from_setting(
+async def acreate_quest_from_setting(
     setting_text: str, api_key: str, api_provider: str, model: str,
-    scene_count: int, tone: str, pacing: str, narrative_elements: List[str]
-) -> Iterator[str]:
-    """Генерирует квест, управляя многоэтапным конвейером 'Студия Разработки'."""
+    scene_count: int, tone: str, pacing: str, narrative_elements: List[str],
+    use_cache: bool = True, run_id: Optional[str] = None, fallbacks: Optional[Fallbacks] = None,
+    stage_models: Optional[StageModels] = None, pipeline_mode: Optional[str] = None,
+) -> AsyncIterator[str]:
+    """Генерирует квест, управляя многоэтапным конвейером 'Студия Разработки'.
+
+    Результат каждого этапа и каждой сцены сохраняется в запись запуска (run_store).
+    С run_id конвейер продолжает сохраненный запуск с последней завершенной точки.
+    fallbacks — резервные провайдеры, stage_models — модели отдельных этапов
+    (см. _build_llm_chain); их ключи тоже не сохраняются.
+    После каждого этапа с вызовами LLM отправляется событие stage_model с моделями, которые ответили.
+    pipeline_mode — "full" или "fast" (см. _afast_draft); по умолчанию PIPELINE_MODE.
+    """
+    store = get_run_store()
+    resumed = run_id is not None
+    cancel_token = CancelToken()
+    served = _ServedModels({
+        stage: _build_llm_chain(api_provider, api_key, model, fallbacks, stage, stage_models) for stage in PIPELINE_STAGES
+    })
     try:
+        mode = _get_pipeline_mode(pipeline_mode)
+        if run_id is None:
+            run_id = store.create({
+                "setting_text": setting_text, "api_provider": api_provider, "model": model, "scene_count": scene_count,
+                "tone": tone, "pacing": pacing, "narrative_elements": narrative_elements, "pipeline_mode": mode,
+            })
+        else:
+            store.set_status(run_id, "running")
+        cancel_token = cancel_registry.register(run_id)
+        yield json.dumps({"status": "run", "run_id": run_id, "resumed": resumed})
+
+        final_saved = store.load_stage(run_id, "final")
+        if final_saved is not None:
+            store.set_status(run_id, "done")
+            yield json.dumps({"status": "done", "quest": final_saved})
+            return
+
+        # Длинный сеттинг сжимается один раз за запуск: промпты всех этапов получают выжимку
+        prompt_setting = setting_text
+        if estimate_tokens(setting_text) > get_setting_tokens():
+            prompt_setting = store.load_stage(run_id, "setting_digest")
+            if prompt_setting is None:
+                cancel_token.raise_if_cancelled()
+                yield json.dumps({"status": "setting_digest", "message": "0/6: Сеттинг длинный, сжимаем его для промптов...", "model": served.planned("concept")})
+                prompt_setting = await _adigest_setting(setting_text, served.chains["concept"], use_cache, cancel_token, served.recorder("concept"))
+                store.save_stage(run_id, "setting_digest", prompt_setting)
+
+        if mode == "fast":
+            async for event in _afast_draft(
+                store, run_id, prompt_setting, scene_count, tone, pacing, narrative_elements, served, use_cache, cancel_token,
+            ):
+                yield event
+
         # Этап 1: Геймдизайнер
-        yield json.dumps({"status": "concept", "message": "1/6: Геймдизайнер придумывает концепт..."})
-        concept_prompt = _get_plot_concept_prompt(
-            setting_text, scene_count, tone, pacing, narrative_elements
-        )
-        plot_concept = _call_llm(concept_prompt, api_provider, api_key, model, force_text_response=True)
-        time.sleep(1) # Пауза между запросами
+        cancel_token.raise_if_cancelled()
+        yield json.dumps({"status": "concept", "message": "1/6: Геймдизайнер придумывает концепт...", "model": served.planned("concept")})
+        plot_concept = store.load_stage(run_id, "concept")
+        if plot_concept is None:
+            concept_prompt = _get_plot_concept_prompt(
+                prompt_setting, scene_count, tone, pacing, narrative_elements
+            )
+            plot_concept = await cancel_token.guard(_acall_llm_failover(
+                concept_prompt, served.chains["concept"], force_text_response=True, use_cache=use_cache,
+                on_served=served.recorder("concept"), budget_stage="concept",
+            ))
+            yield served.event("concept")
+            store.save_stage(run_id, "concept", plot_concept)
 
         # Этап 2: Архитектор
-        yield json.dumps({"status": "architect", "message": "2/6: Архитектор извлекает ключевые сцены..."})
-        scene_list_prompt = _get_scene_list_from_concept_prompt(plot_concept)
-        scene_list_text = _call_llm(scene_list_prompt, api_provider, api_key, model, force_text_response=True)
-        time.sleep(1) # Пауза между запросами
+        cancel_token.raise_if_cancelled()
+        yield json.dumps({"status": "architect", "message": "2/6: Архитектор извлекает ключевые сцены...", "model": served.planned("architect")})
+        scene_list_text = store.load_stage(run_id, "scene_list")
+        if scene_list_text is None:
+            scene_list_prompt = _get_scene_list_from_concept_prompt(plot_concept)
+            scene_list_text = await cancel_token.guard(_acall_llm_failover(
+                scene_list_prompt, served.chains["architect"], force_text_response=True, use_cache=use_cache,
+                on_served=served.recorder("architect"), budget_stage="architect",
+            ))
+            yield served.event("architect")
+            store.save_stage(run_id, "scene_list", scene_list_text)
         
         # ЭТАП 2.5: Python-парсер
-        scenes_for_graph = []
-        for i, line in enumerate(scene_list_text.strip().split('\n')):
-            clean_line = re.sub(r'^\d+\.\s*', '', line).strip()
-            if clean_line:
-                # Генерируем простой ID, чтобы избежать ошибок LLM
-                scene_id = f"scene_{i+1}"
-                scenes_for_graph.append({"scene_id": scene_id, "summary": clean_line})
-        if not scenes_for_graph:
-            raise ValueError("Архитектор не смог извлечь ни одной сцены из концепта.")
+        scenes_for_graph = _parse_scene_list(scene_list_text)
         scene_list_json = json.dumps(scenes_for_graph, ensure_ascii=False, indent=2)
 
         # Этап 3: Режиссёр
-        yield json.dumps({"status": "director", "message": "3/6: Режиссёр выстраивает связи и выборы..."})
-        graph_prompt = _get_graph_from_scenes_prompt(scene_list_json)
-        skeleton_str = _call_llm(graph_prompt, api_provider, api_key, model, force_text_response=False)
-        time.sleep(1) # Пауза между запросами
-        skeleton_json = json.loads(skeleton_str)
-        if "scenes" not in skeleton_json or "start_scene" not in skeleton_json:
-            raise ValueError("Режиссёр не смог создать корректную структуру из списка сцен.")
-
-        # Этап 4: Сценарист
+        cancel_token.raise_if_cancelled()
+        yield json.dumps({"status": "director", "message": "3/6: Режиссёр выстраивает связи и выборы...", "model": served.planned("director")})
+        skeleton_json = store.load_stage(run_id, "skeleton")
+        if skeleton_json is None:
+            graph_prompt = _get_graph_from_scenes_prompt(scene_list_json)
+            skeleton_str = await cancel_token.guard(_acall_llm_failover(
+                graph_prompt, served.chains["director"], force_text_response=False, use_cache=use_cache,
+                on_served=served.recorder("director"), schema="skeleton", budget_stage="director",
+            ))
+            yield served.event("director")
+            skeleton_json = json.loads(skeleton_str)
+            if "scenes" not in skeleton_json or "start_scene" not in skeleton_json:
+                raise ValueError("Режиссёр не смог создать корректную структуру из списка сцен.")
+            # Ацикличность и связность проверяем сами, а не доверяем промпту режиссёра
+            repair_report = repair_quest_graph(skeleton_json)
+            if not skeleton_json["scenes"]:
+                raise ValueError("Режиссёр не вернул ни одной сцены-объекта.")
+            if repair_report["changed"]:
+                yield json.dumps({"status": "graph_repair", "message": "3/6: Структура графа исправлена автоматически.", "report": repair_report}, ensure_ascii=False)
+            store.save_stage(run_id, "skeleton", skeleton_json)
+        # Скелет графа отдаем сразу: клиент может рисовать граф, пока пишутся тексты сцен
+        yield json.dumps({"status": "skeleton", "quest": skeleton_json}, ensure_ascii=False)
+
+        # Этап 4: Сценарист. Граф строится один раз: этап 4 меняет только тексты, не переходы
         final_quest = skeleton_json.copy()
-        # ИСПРАВЛЕНИЕ: Исправлен отступ для этого и последующих блоков кода
-        scene_map, parent_map = {s['scene_id']: s for s in final_quest['scenes']}, {}
-        for scene in final_quest['scenes']:
-            for choice in scene.get('choices', []):
-                if 'next_scene' in choice: 
-                    parent_map[choice['next_scene']] = { 
-                        "parent_id": scene['scene_id'], 
-                        "choice_summary": choice.get('choice_summary', '...')
-                    }
-        for i, scene_to_detail in enumerate(final_quest["scenes"]):
-            scene_id, summary = scene_to_detail["scene_id"], scene_to_detail.get("summary", "Нет описания.")
-            yield json.dumps({ "status": "detailing_scene", "message": f'4/6: Сценарист пишет текст для сцены {i + 1}/{len(final_quest["scenes"])}...'})
-            history_choice, previous_scene_text = f"Это стартовая ситуация: '{summary}'.", ""
-            parent_info = parent_map.get(scene_id)
-            if parent_info:
-                parent_id, choice_summary = parent_info['parent_id'], parent_info['choice_summary']
-                parent_scene_data = scene_map.get(parent_id)
-                if parent_scene_data and 'text' in parent_scene_data: 
-                    previous_scene_text = parent_scene_data['text']
-                history_choice = f"Вы решили: '{choice_summary}'. Это привело вас к следующей ситуации: '{summary}'."
-            detail_prompt = _get_scene_detail_prompt(setting_text, summary, history_choice, previous_scene_text)
-            detailed_str = _call_llm(detail_prompt, api_provider, api_key, model, force_text_response=False)
-            if i < len(final_quest["scenes"]) -1: 
-                time.sleep(1) # Пауза между запросами
-            detailed_json = json.loads(detailed_str)
-            scene_to_detail["text"] = detailed_json.get("text", "Описание не было сгенерировано.")
-            scene_map[scene_id]["text"] = scene_to_detail["text"]
-            detailed_choices_text = detailed_json.get("choices_text", [])
-            for choice_idx, choice in enumerate(scene_to_detail.get("choices", [])):
-                choice["text"] = detailed_choices_text[choice_idx] if choice_idx < len(detailed_choices_text) else choice.get("choice_summary", "...")
-                choice.pop("choice_summary", None)
+        graph = QuestGraph(final_quest)
+        # Вместо полного сеттинга сцена получает выжимку и найденные по ней фрагменты оригинала
+        lore_index = None
+        if prompt_setting is not setting_text:
+            lore_index = await asyncio.to_thread(LoreIndex.from_text, setting_text, get_lore_chunk_tokens())
+        async for event in _detail_scenes_dataflow(
+            final_quest["scenes"], graph, prompt_setting, api_provider, api_key, model,
+            max_workers=_get_provider_concurrency(served.chains["writer"][0].api_provider), use_cache=use_cache,
+            restored=store.load_scenes(run_id),
+            on_scene_done=lambda index, detail: store.save_scene(run_id, index, detail),
+            cancel_token=cancel_token, chain=served.chains["writer"], on_served=served.recorder("writer"),
+            lore_index=lore_index,
+        ):
+            yield event
+        if served.models["writer"]:
+            yield served.event("writer")
+        # Квест в том виде, в каком его собрал клиент из skeleton и scene_ready (цензор меняет его на месте)
+        streamed_quest = copy.deepcopy(final_quest)
 
         # Этап 5: Цензор
         yield json.dumps({"status": "validating", "message": "5/6: Цензор проверяет структуру..."})
-        cleaned_quest = _validate_and_clean_quest(final_quest)
+        cleaned_quest = _validate_and_clean_quest(final_quest, graph)
         
-        # Этап 6: Корректор
-        yield json.dumps({"status": "correcting", "message": "6/6: Корректор вычитывает текст..."})
-        quest_to_correct_str = json.dumps(cleaned_quest, ensure_ascii=False, indent=2)
-        correction_prompt = _get_correction_prompt(quest_to_correct_str)
-        corrected_quest_str = _call_llm(correction_prompt, api_provider, api_key, model, force_text_response=False)
-        final_quest_json = json.loads(corrected_quest_str)
+        # Этап 6: Корректор. Локальная проверка письменностей решает, каким сценам нужна вычитка
+        final_quest_json = copy.deepcopy(cleaned_quest)
+        contamination = scan_quest(final_quest_json)
+        yield json.dumps({
+            "status": "script_check",
+            "message": f"6/6: Посторонние символы найдены в {len(contamination)} из {len(final_quest_json.get('scenes', []))} сцен.",
+            "scenes": contamination,
+        })
+        force_full = os.getenv("CORRECTION_FORCE_FULL", "false").lower() == "true"
+        # В быстром режиме вычитка необязательна (FAST_MODE_CORRECTION=true включает ее)
+        correction_enabled = mode == "full" or os.getenv("FAST_MODE_CORRECTION", "false").lower() == "true"
+        cancel_token.raise_if_cancelled()
+        if not correction_enabled:
+            yield json.dumps({"status": "correcting", "message": "6/6: Быстрый режим: вычитка пропущена."})
+        elif contamination or force_full:
+            yield json.dumps({"status": "correcting", "message": "6/6: Корректор вычитывает текст...", "model": served.planned("corrector")})
+            async for event in _correct_quest_chunked(
+                final_quest_json, served.chains["corrector"][0].api_provider, api_key, model, use_cache=use_cache,
+                scene_ids=None if force_full else set(contamination), cancel_token=cancel_token,
+                chain=served.chains["corrector"], on_served=served.recorder("corrector"),
+            ):
+                yield event
+            if served.models["corrector"]:
+                yield served.event("corrector")
+        else:
+            yield json.dumps({"status": "correcting", "message": "6/6: Текст чистый, вычитка не требуется."})
+        # Клиент уже собрал квест из skeleton и scene_ready — досылаем только отличия
+        yield json.dumps({"status": "corrected", "changes": _diff_quests(streamed_quest, final_quest_json)}, ensure_ascii=False)
 
+        store.save_stage(run_id, "final", final_quest_json)
+        store.set_status(run_id, "done")
         yield json.dumps({"status": "done", "quest": final_quest_json})
 
+    except RunNotFoundError:
+        yield json.dumps({"status": "error", "message": f"Запуск {run_id} не найден или устарел."})
+    except GenerationCancelled:
+        logger.info(f"Генерация {run_id} отменена.")
+        _mark_cancelled(store, run_id)
+        yield json.dumps({"status": "cancelled", "message": "Генерация отменена.", "run_id": run_id})
+    except GeneratorExit:
+        # Клиент отключился (генератор закрыт): сохраненный запуск можно продолжить позже
+        logger.info(f"Клиент отключился, генерация {run_id} остановлена.")
+        _mark_cancelled(store, run_id)
+        raise
     except Exception as e:
         logger.error(f"Ошибка в многоэтапной генерации: {e}", exc_info=True)
         error_message_lower = str(e).lower()
@@ -374,20 +1563,85 @@ def create_quest_from_setting(
                 error_payload = {"error": msg}; break
         else:
             error_payload = {"error": f"Произошла ошибка на сервере: {str(e)}"}
-        yield json.dumps({"status": "error", "message": error_payload["error"]})
+        if run_id is not None:
+            try:
+                store.set_status(run_id, "failed", error_payload["error"])
+            except (RunNotFoundError, OSError):
+                pass
+        # run_id в ошибке позволяет продолжить запуск через /generate/resume
+        yield json.dumps({"status": "error", "message": error_payload["error"], "run_id": run_id})
+    finally:
+        # Останавливаем все, что еще выполняется от имени этой генерации (вызовы LLM, поток llama.cpp)
+        cancel_token.cancel()
+        if run_id is not None:
+            cancel_registry.unregister(run_id, cancel_token)
+
+
+def _mark_cancelled(store: Any, run_id: Optional[str]) -> None:
+    if run_id is None:
+        return
+    try:
+        store.set_status(run_id, "cancelled")
+    except (RunNotFoundError, OSError):
+        pass
+
+
+def cancel_generation(run_id: str) -> bool:
+    """Отменяет активную генерацию по run_id. False — такой генерации в этом процессе нет."""
+    return cancel_registry.cancel(run_id)
+
+
+def create_quest_from_setting(
+    setting_text: str, api_key: str, api_provider: str, model: str,
+    scene_count: int, tone: str, pacing: str, narrative_elements: List[str],
+    use_cache: bool = True, run_id: Optional[str] = None, fallbacks: Optional[Fallbacks] = None,
+    stage_models: Optional[StageModels] = None, pipeline_mode: Optional[str] = None,
+) -> Iterator[str]:
+    """Синхронный адаптер acreate_quest_from_setting (Flask, CLI): те же события прогресса."""
+    yield from iterate_sync(acreate_quest_from_setting(
+        setting_text, api_key, api_provider, model, scene_count, tone, pacing, narrative_elements,
+        use_cache=use_cache, run_id=run_id, fallbacks=fallbacks, stage_models=stage_models, pipeline_mode=pipeline_mode,
+    ))
+
+
+async def aresume_quest_run(
+    run_id: str, api_key: str, api_provider: Optional[str] = None, model: Optional[str] = None, use_cache: bool = True,
+    fallbacks: Optional[Fallbacks] = None, stage_models: Optional[StageModels] = None, pipeline_mode: Optional[str] = None,
+) -> AsyncIterator[str]:
+    """Продолжает сохраненный запуск. Ключ API не хранится и передается заново;
+    провайдера, модель и режим конвейера можно сменить (например, если прежний провайдер недоступен)."""
+    try:
+        params = get_run_store().get(run_id)["params"]
+    except RunNotFoundError:
+        yield json.dumps({"status": "error", "message": f"Запуск {run_id} не найден или устарел."})
+        return
+    async for event in acreate_quest_from_setting(
+        params["setting_text"], api_key, api_provider or params["api_provider"], model or params["model"],
+        params["scene_count"], params["tone"], params["pacing"], params["narrative_elements"],
+        use_cache=use_cache, run_id=run_id, fallbacks=fallbacks, stage_models=stage_models,
+        pipeline_mode=pipeline_mode or params.get("pipeline_mode", "full"),
+    ):
+        yield event
+
+
+def resume_quest_run(
+    run_id: str, api_key: str, api_provider: Optional[str] = None, model: Optional[str] = None, use_cache: bool = True,
+    fallbacks: Optional[Fallbacks] = None, stage_models: Optional[StageModels] = None, pipeline_mode: Optional[str] = None,
+) -> Iterator[str]:
+    """Синхронный адаптер aresume_quest_run."""
+    yield from iterate_sync(aresume_quest_run(run_id, api_key, api_provider, model, use_cache, fallbacks, stage_models, pipeline_mode))
 
 
 def validate_api_key(api_provider: str, api_key: str) -> Dict[str, Any]:
     try:
         if api_provider == "groq":
-            client = Groq(api_key=api_key); client.models.list()
+            get_client("groq", api_key).models.list()
             return {"status": "ok"}
         elif api_provider == "openai":
-            client = openai.OpenAI(api_key=api_key); client.models.list()
+            get_client("openai", api_key).models.list()
             return {"status": "ok"}
         elif api_provider == "gemini":
-            genai.configure(api_key=api_key)
-            models = [m for m in genai.list_models() if "generateContent" in m.supported_generation_methods]
+            models = [m for m in get_client("gemini", api_key).list_models() if "generateContent" in m.supported_generation_methods]
             if not models: raise ValueError("No generative models found for this API key.")
             return {"status": "ok"}
         elif api_provider == "local":
@@ -417,16 +1671,13 @@ def get_available_models(api_provider: str, api_key: str) -> Dict[str, Any]:
 
         models_list = []
         if api_provider == "groq":
-            client = Groq(api_key=api_key)
-            models = client.models.list().data
+            models = get_client("groq", api_key).models.list().data
             models_list = [model.id for model in models]
         elif api_provider == "openai":
-            client = openai.OpenAI(api_key=api_key)
-            models = client.models.list().data
+            models = get_client("openai", api_key).models.list().data
             models_list = [model.id for model in models if "gpt" in model.id.lower() or "text" in model.id.lower()]
         elif api_provider == "gemini":
-            genai.configure(api_key=api_key)
-            models = [m.name for m in genai.list_models() if "generateContent" in m.supported_generation_methods]
+            models = [m.name for m in get_client("gemini", api_key).list_models() if "generateContent" in m.supported_generation_methods]
             models_list = [m.replace("models/", "") for m in models]
         else:
             return {"error": f"Unknown API provider: {api_provider}"}
@@ -466,6 +1717,10 @@ def delete_local_models(filenames: List[str]) -> Dict[str, Any]:
         file_path = model_dir / filename
         try:
             if file_path.is_file():
+                local_model_registry.unload_path(str(file_path))
+                pool = get_local_worker_pool()
+                if pool is not None:
+                    pool.unload_path(str(file_path))
                 file_path.unlink()
                 deleted_files.append(filename)
                 logger.info(f"Successfully deleted local model: {filename}")
@@ -0,0 +1,155 @@
+from collections import deque
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+# Переход: (индекс сцены, индекс выбора в сцене, индекс следующей сцены)
+Edge = Tuple[int, int, int]
+
+
+class QuestGraph:
+    """Индексированный граф квеста, строится один раз за O(V + E).
+
+    Сцены пронумерованы по порядку в quest["scenes"], переходы хранятся списками
+    индексов, поэтому обходы, порядок и отчеты работают за линейное время.
+    Граф описывает структуру на момент построения и не следит за изменениями квеста:
+    добавленные позже переходы передаются через add_edge.
+    """
+
+    def __init__(self, quest: Dict[str, Any]):
+        scenes = quest.get("scenes") or []
+        self.scene_ids: List[str] = [scene.get("scene_id") for scene in scenes]
+        self.index: Dict[str, int] = {}
+        self.duplicate_ids: List[str] = []
+        for i, scene_id in enumerate(self.scene_ids):
+            if scene_id in self.index:
+                self.duplicate_ids.append(scene_id)
+            else:
+                self.index[scene_id] = i
+
+        self.successors: List[List[int]] = [[] for _ in scenes]
+        self.predecessors: List[List[int]] = [[] for _ in scenes]
+        self.edges: List[Edge] = []
+        # Переходы в несуществующие сцены: (scene_id, индекс выбора, next_scene)
+        self.dangling: List[Tuple[str, int, str]] = []
+        for i, scene in enumerate(scenes):
+            for choice_idx, choice in enumerate(scene.get("choices") or []):
+                next_id = choice.get("next_scene") if isinstance(choice, dict) else None
+                if not next_id:
+                    continue
+                target = self.index.get(next_id)
+                if target is None:
+                    self.dangling.append((self.scene_ids[i], choice_idx, next_id))
+                    continue
+                self.successors[i].append(target)
+                self.predecessors[target].append(i)
+                self.edges.append((i, choice_idx, target))
+
+        self.start_scene: Optional[str] = quest.get("start_scene")
+        self.start: Optional[int] = self.index.get(self.start_scene) if self.start_scene else None
+
+    def __len__(self) -> int:
+        return len(self.scene_ids)
+
+    def add_edge(self, source: int, choice_idx: int, target: int) -> None:
+        """Учитывает переход, добавленный в квест после построения графа, за O(1)."""
+        self.successors[source].append(target)
+        self.predecessors[target].append(source)
+        self.edges.append((source, choice_idx, target))
+
+    def in_degree(self) -> List[int]:
+        return [len(parents) for parents in self.predecessors]
+
+    def reachable(self, start: Optional[int] = None) -> List[bool]:
+        """Флаги достижимости сцен из start (по умолчанию — из стартовой сцены), BFS."""
+        start = self.start if start is None else start
+        seen = [False] * len(self)
+        if start is None:
+            return seen
+        seen[start] = True
+        queue = deque([start])
+        while queue:
+            current = queue.popleft()
+            for target in self.successors[current]:
+                if not seen[target]:
+                    seen[target] = True
+                    queue.append(target)
+        return seen
+
+    def reachable_ids(self) -> Set[str]:
+        return {self.scene_ids[i] for i, flag in enumerate(self.reachable()) if flag}
+
+    def topological_order(self) -> Tuple[List[int], bool]:
+        """Порядок Кана: родители раньше детей. Возвращает (порядок, есть_ли_цикл).
+
+        При цикле в порядок попадают только сцены, не зависящие от цикла.
+        """
+        degree = self.in_degree()
+        queue = deque(i for i, value in enumerate(degree) if value == 0)
+        order: List[int] = []
+        while queue:
+            current = queue.popleft()
+            order.append(current)
+            for target in self.successors[current]:
+                degree[target] -= 1
+                if degree[target] == 0:
+                    queue.append(target)
+        return order, len(order) < len(self)
+
+    def has_cycle(self) -> bool:
+        return self.topological_order()[1]
+
+    def back_edges(self) -> List[Edge]:
+        """Переходы, замыкающие циклы при обходе в глубину (сначала от стартовой сцены).
+
+        Удаление всех этих переходов делает граф ациклическим.
+        """
+        white, gray, black = 0, 1, 2
+        color = [white] * len(self)
+        outgoing: List[List[Edge]] = [[] for _ in range(len(self))]
+        for edge in self.edges:
+            outgoing[edge[0]].append(edge)
+        result: List[Edge] = []
+        roots = ([self.start] if self.start is not None else []) + list(range(len(self)))
+        for root in roots:
+            if color[root] != white:
+                continue
+            color[root] = gray
+            stack = [(root, 0)]
+            while stack:
+                node, position = stack[-1]
+                if position == len(outgoing[node]):
+                    color[node] = black
+                    stack.pop()
+                    continue
+                stack[-1] = (node, position + 1)
+                edge = outgoing[node][position]
+                target = edge[2]
+                if color[target] == gray:
+                    result.append(edge)
+                elif color[target] == white:
+                    color[target] = gray
+                    stack.append((target, 0))
+        return result
+
+    def parent_links(self) -> List[Optional[Tuple[int, int]]]:
+        """Для каждой сцены — (родитель, индекс выбора) по последнему входящему переходу."""
+        links: List[Optional[Tuple[int, int]]] = [None] * len(self)
+        for source, choice_idx, target in self.edges:
+            links[target] = (source, choice_idx)
+        return links
+
+    def report(self) -> Dict[str, Any]:
+        """Сводка о структуре: недостижимые сцены, висячие переходы, дубликаты, циклы."""
+        reachable = self.reachable()
+        degree = self.in_degree()
+        return {
+            "scenes": len(self),
+            "edges": len(self.edges),
+            "start_scene": self.start_scene,
+            "start_scene_found": self.start is not None,
+            "unreachable": [self.scene_ids[i] for i, flag in enumerate(reachable) if not flag],
+            "dangling": [{"scene_id": s, "choice_index": c, "next_scene": n} for s, c, n in self.dangling],
+            "duplicate_ids": list(self.duplicate_ids),
+            "has_cycle": self.has_cycle(),
+            "orphans": [self.scene_ids[i] for i, value in enumerate(degree) if value == 0 and i != self.start],
+            "endings": [self.scene_ids[i] for i, targets in enumerate(self.successors) if not targets],
+        }
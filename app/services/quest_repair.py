@@ -0,0 +1,147 @@
+import itertools
+import logging
+from collections import deque
+from typing import Any, Dict, List, Set
+
+from .quest_graph import QuestGraph
+
+logger = logging.getLogger(__name__)
+
+
+def _descendants(graph: QuestGraph, root: int) -> Set[int]:
+    seen = {root}
+    queue = deque([root])
+    while queue:
+        for target in graph.successors[queue.popleft()]:
+            if target not in seen:
+                seen.add(target)
+                queue.append(target)
+    return seen
+
+
+def repair_quest_graph(quest: Dict[str, Any]) -> Dict[str, Any]:
+    """Приводит скелет квеста к связному ациклическому графу без вызовов LLM.
+
+    Исправляет квест на месте и возвращает отчет об изменениях. Порядок действий:
+    удаление сцен, которые не являются объектами -> уникальные scene_id -> удаление пустых, висячих, повторных переходов и петель ->
+    стартовая сцена -> разрыв циклов -> присоединение недостижимых сцен -> концовка.
+    Результат детерминирован: зависит только от входного JSON.
+    """
+    report: Dict[str, Any] = {
+        "removed_scenes": [],
+        "renamed_scenes": [],
+        "removed_choices": [],
+        "start_scene": None,
+        "reattached_scenes": [],
+        "forced_endings": [],
+    }
+    scenes = quest.get("scenes")
+    if not isinstance(scenes, list) or not scenes:
+        report["changed"] = False
+        return report
+
+    # 0. Сцены, которые не являются объектами (модель без строгой схемы ответа вернула строку и т.п.)
+    if not all(isinstance(scene, dict) for scene in scenes):
+        report["removed_scenes"] = [
+            {"position": position, "value": str(scene)[:100], "reason": "not_object"}
+            for position, scene in enumerate(scenes) if not isinstance(scene, dict)
+        ]
+        scenes = quest["scenes"] = [scene for scene in scenes if isinstance(scene, dict)]
+        if not scenes:
+            report["changed"] = True
+            return report
+
+    # 1. Уникальные идентификаторы сцен
+    used: Set[str] = set()
+    for position, scene in enumerate(scenes):
+        scene_id = scene.get("scene_id")
+        if isinstance(scene_id, str) and scene_id and scene_id not in used:
+            used.add(scene_id)
+            continue
+        base = scene_id if isinstance(scene_id, str) and scene_id else f"scene_{position + 1}"
+        new_id, suffix = base, 2
+        while new_id in used:
+            new_id, suffix = f"{base}_{suffix}", suffix + 1
+        scene["scene_id"] = new_id
+        used.add(new_id)
+        report["renamed_scenes"].append({"from": scene_id, "to": new_id})
+
+    # 2. Переходы: без цели, в неизвестную сцену, в себя и повторы в одну сцену
+    def remove_choice(scene_id: str, next_scene: Any, reason: str) -> None:
+        report["removed_choices"].append({"scene_id": scene_id, "next_scene": next_scene, "reason": reason})
+
+    for scene in scenes:
+        choices = scene.get("choices")
+        kept: List[Dict[str, Any]] = []
+        targets: Set[str] = set()
+        for choice in choices if isinstance(choices, list) else []:
+            next_scene = choice.get("next_scene") if isinstance(choice, dict) else None
+            if not next_scene:
+                remove_choice(scene["scene_id"], next_scene, "empty")
+            elif next_scene not in used:
+                remove_choice(scene["scene_id"], next_scene, "unknown_scene")
+            elif next_scene == scene["scene_id"]:
+                remove_choice(scene["scene_id"], next_scene, "self_loop")
+            elif next_scene in targets:
+                remove_choice(scene["scene_id"], next_scene, "duplicate")
+            else:
+                targets.add(next_scene)
+                kept.append(choice)
+        scene["choices"] = kept
+
+    # 3. Стартовая сцена: первая сцена без входящих переходов, иначе первая по порядку
+    graph = QuestGraph(quest)
+    if graph.start is None:
+        degree = graph.in_degree()
+        start = next((i for i, value in enumerate(degree) if value == 0), 0)
+        report["start_scene"] = {"from": quest.get("start_scene"), "to": graph.scene_ids[start]}
+        quest["start_scene"] = graph.scene_ids[start]
+        graph = QuestGraph(quest)
+
+    # 4. Разрыв циклов: удаляем обратные переходы обхода в глубину от стартовой сцены
+    back_edges = graph.back_edges()
+    if back_edges:
+        removed = {(source, choice_idx) for source, choice_idx, _ in back_edges}
+        for source, choice_idx, target in back_edges:
+            remove_choice(graph.scene_ids[source], graph.scene_ids[target], "cycle")
+        for i in {source for source, _ in removed}:
+            scenes[i]["choices"] = [c for idx, c in enumerate(scenes[i]["choices"]) if (i, idx) not in removed]
+        graph = QuestGraph(quest)
+
+    # 5. Недостижимые сцены: корень каждой такой ветки получает переход от ближайшей
+    #    предыдущей по списку достижимой сцены, которая не является его потомком.
+    #    Граф и достижимость обновляются на месте: присоединенная ветка целиком становится достижимой
+    reachable = graph.reachable()
+    for root in range(len(graph)):
+        if reachable[root] or graph.predecessors[root]:
+            continue
+        blocked = _descendants(graph, root)
+        candidates = itertools.chain(range(root - 1, -1, -1), range(root + 1, len(graph)))
+        parent = next((i for i in candidates if reachable[i] and i not in blocked), None)
+        if parent is None:
+            continue
+        root_scene = scenes[root]
+        scenes[parent]["choices"].append({
+            "choice_summary": root_scene.get("summary") or "Продолжить путь",
+            "next_scene": root_scene["scene_id"],
+        })
+        report["reattached_scenes"].append({"scene_id": root_scene["scene_id"], "parent_id": scenes[parent]["scene_id"]})
+        graph.add_edge(parent, len(scenes[parent]["choices"]) - 1, root)
+        for i in blocked:
+            reachable[i] = True
+
+    # 6. Хотя бы одна концовка среди достижимых сцен (в ациклическом графе она всегда есть,
+    #    проверка страхует от ошибок на предыдущих шагах)
+    if not any(reachable[i] and not graph.successors[i] for i in range(len(graph))):
+        order, _ = graph.topological_order()
+        last = next((i for i in reversed(order) if reachable[i]), graph.start)
+        if last is not None:
+            for choice in scenes[last]["choices"]:
+                remove_choice(scenes[last]["scene_id"], choice.get("next_scene"), "forced_ending")
+            scenes[last]["choices"] = []
+            report["forced_endings"].append(scenes[last]["scene_id"])
+
+    report["changed"] = any(report[key] for key in ("removed_scenes", "renamed_scenes", "removed_choices", "start_scene", "reattached_scenes", "forced_endings"))
+    if report["changed"]:
+        logger.info(f"Скелет квеста исправлен: {report}")
+    return report
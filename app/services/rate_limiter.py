@@ -0,0 +1,217 @@
+import asyncio
+import logging
+import os
+import re
+import threading
+import time
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Лимиты по умолчанию (запросов/мин, токенов/мин); None — без ограничения.
+# Переопределяются переменными LLM_RPM_<PROVIDER> и LLM_TPM_<PROVIDER> (0 — без ограничения).
+# Лимит токенов для Groq/OpenAI дополнительно узнается из заголовков x-ratelimit-*.
+DEFAULT_RATE_LIMITS: Dict[str, Tuple[Optional[float], Optional[float]]] = {
+    "groq": (30, None),
+    "openai": (None, None),
+    "gemini": (15, None),
+    "local": (None, None),
+    "vps_proxy": (None, None),
+}
+
+_DURATION_PART_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+
+
+def parse_reset_duration(value: Any) -> Optional[float]:
+    """Разбирает длительность из заголовков лимитов: '6s', '1m30.5s', '120ms', '2' (секунды)."""
+    if not isinstance(value, str) or not value.strip():
+        return None
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_PART_RE.findall(value)
+    if not parts:
+        return None
+    multipliers = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+    return sum(float(number) * multipliers[unit] for number, unit in parts)
+
+
+def _parse_int(value: Any) -> Optional[int]:
+    if not isinstance(value, str):
+        return None
+    try:
+        return int(float(value))
+    except ValueError:
+        return None
+
+
+class TokenBucket:
+    """Классическое «ведро токенов» с резервированием.
+
+    Резерв может увести баланс в минус: тогда вызывающему возвращается время
+    ожидания, а следующие резервы встают в очередь за ним (честный порядок).
+    """
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = float(per_minute) / 60.0
+        self.available = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float, now: float) -> float:
+        self._refill(now)
+        # Запрос больше емкости ведра все равно должен пройти, иначе он не пройдет никогда
+        amount = min(amount, self.capacity)
+        self.available -= amount
+        return 0.0 if self.available >= 0 else -self.available / self.rate
+
+    def give_back(self, amount: float, now: float) -> None:
+        self._refill(now)
+        self.available = min(self.capacity, self.available + amount)
+
+    def cap_available(self, remaining: float, now: float) -> None:
+        self._refill(now)
+        self.available = min(self.available, remaining)
+
+
+class ProviderRateLimiter:
+    """Лимитер запросов и токенов для одной пары (провайдер, api_key)."""
+
+    def __init__(self, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None):
+        self._lock = threading.Lock()
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.tokens_learned = False
+        self.blocked_until = 0.0
+
+    def reserve(self, estimated_tokens: int = 0) -> float:
+        """Резервирует один запрос и estimated_tokens токенов. Возвращает, сколько секунд ждать."""
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0.0, self.blocked_until - now)
+            if self.requests is not None:
+                wait = max(wait, self.requests.reserve(1, now))
+            if self.tokens is not None and estimated_tokens > 0:
+                wait = max(wait, self.tokens.reserve(estimated_tokens, now))
+            return wait
+
+    def acquire(self, estimated_tokens: int = 0) -> float:
+        """Блокирует поток, пока лимиты не позволят выполнить запрос. Возвращает время ожидания."""
+        wait = self.reserve(estimated_tokens)
+        if wait > 0:
+            logger.info(f"Ограничение частоты запросов: ожидание {wait:.1f} сек.")
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self, estimated_tokens: int = 0) -> float:
+        """Асинхронный вариант acquire: ожидание не занимает поток."""
+        wait = self.reserve(estimated_tokens)
+        if wait > 0:
+            logger.info(f"Ограничение частоты запросов: ожидание {wait:.1f} сек.")
+            await asyncio.sleep(wait)
+        return wait
+
+    def record_usage(self, estimated_tokens: int, actual_tokens: Optional[int]) -> None:
+        """Корректирует ведро токенов по фактическому расходу из ответа провайдера."""
+        if self.tokens is None or actual_tokens is None:
+            return
+        with self._lock:
+            now = time.monotonic()
+            delta = estimated_tokens - actual_tokens
+            if delta > 0:
+                self.tokens.give_back(delta, now)
+            elif delta < 0:
+                self.tokens.reserve(-delta, now)
+
+    def penalize(self, seconds: float) -> None:
+        """Останавливает все запросы по этому ключу на seconds секунд (например, после 429)."""
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def blocked_for(self) -> float:
+        """Сколько секунд еще действует пауза после 429 или исчерпанного окна лимитов."""
+        with self._lock:
+            return max(0.0, self.blocked_until - time.monotonic())
+
+    def update_from_headers(self, headers: Optional[Mapping[str, Any]]) -> None:
+        """Учитывает заголовки лимитов (x-ratelimit-*, retry-after), если провайдер их прислал."""
+        if headers is None:
+            return
+        try:
+            get = headers.get
+        except AttributeError:
+            return
+        retry_after = parse_reset_duration(get("retry-after"))
+        limit_tokens = _parse_int(get("x-ratelimit-limit-tokens"))
+        remaining_tokens = _parse_int(get("x-ratelimit-remaining-tokens"))
+        reset_tokens = parse_reset_duration(get("x-ratelimit-reset-tokens"))
+        remaining_requests = _parse_int(get("x-ratelimit-remaining-requests"))
+        reset_requests = parse_reset_duration(get("x-ratelimit-reset-requests"))
+
+        with self._lock:
+            now = time.monotonic()
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, now + retry_after)
+            # Лимит токенов в минуту у Groq и OpenAI приходит в заголовке; явная настройка важнее.
+            if limit_tokens and (self.tokens is None or self.tokens_learned) and (
+                self.tokens is None or self.tokens.capacity != limit_tokens
+            ):
+                self.tokens = TokenBucket(limit_tokens)
+                self.tokens_learned = True
+            if self.tokens is not None and remaining_tokens is not None:
+                self.tokens.cap_available(remaining_tokens, now)
+            if remaining_requests == 0 and reset_requests:
+                self.blocked_until = max(self.blocked_until, now + reset_requests)
+            if remaining_tokens == 0 and reset_tokens:
+                self.blocked_until = max(self.blocked_until, now + reset_tokens)
+
+
+def _limit_from_env(name: str, default: Optional[float]) -> Optional[float]:
+    value = os.getenv(name)
+    if value is None or value == "":
+        return default
+    try:
+        parsed = float(value)
+    except ValueError:
+        logger.warning(f"Некорректное значение {name}: {value}")
+        return default
+    return parsed if parsed > 0 else None
+
+
+class RateLimiterRegistry:
+    """Общие на процесс лимитеры: все одновременные генерации с одним ключом делят их."""
+
+    def __init__(self):
+        self._limiters: Dict[Tuple[str, str], ProviderRateLimiter] = {}
+        self._lock = threading.Lock()
+
+    def get(self, api_provider: str, api_key: str = "") -> ProviderRateLimiter:
+        key = (api_provider, api_key or "")
+        with self._lock:
+            limiter = self._limiters.get(key)
+            if limiter is None:
+                default_rpm, default_tpm = DEFAULT_RATE_LIMITS.get(api_provider, (None, None))
+                suffix = api_provider.upper()
+                limiter = ProviderRateLimiter(
+                    requests_per_minute=_limit_from_env(f"LLM_RPM_{suffix}", default_rpm),
+                    tokens_per_minute=_limit_from_env(f"LLM_TPM_{suffix}", default_tpm),
+                )
+                self._limiters[key] = limiter
+            return limiter
+
+    def clear(self) -> None:
+        with self._lock:
+            self._limiters.clear()
+
+
+rate_limiters = RateLimiterRegistry()
+
+
+def get_rate_limiter(api_provider: str, api_key: str = "") -> ProviderRateLimiter:
+    return rate_limiters.get(api_provider, api_key)
@@ -0,0 +1,123 @@
+import json
+import logging
+import os
+import re
+import shutil
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from .data_dir import get_data_dir
+
+logger = logging.getLogger(__name__)
+
+# Сколько хранить записи запусков (переопределяется RUNS_TTL_DAYS)
+DEFAULT_RUNS_TTL_DAYS = 7.0
+
+_RUN_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+
+class RunNotFoundError(KeyError):
+    pass
+
+
+class RunStore:
+    """Контрольные точки генерации в plotix_data/runs/<run_id>.
+
+    run.json — параметры запуска и статус; <stage>.json — результат этапа;
+    scenes/<index>.json — ответ сценариста для сцены скелета. API-ключи не сохраняются.
+    Файлы пишутся атомарно (временный файл + os.replace), чтобы обрыв процесса
+    не оставил битую контрольную точку.
+    """
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+
+    def _run_dir(self, run_id: str) -> Path:
+        if not _RUN_ID_RE.match(run_id or ""):
+            raise RunNotFoundError(run_id)
+        return self.root / run_id
+
+    @staticmethod
+    def _write_json(path: Path, data: Any) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(path.name + ".tmp")
+        tmp_path.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _read_json(path: Path) -> Optional[Any]:
+        try:
+            return json.loads(path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return None
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning(f"Не удалось прочитать контрольную точку {path}: {e}")
+            return None
+
+    def create(self, params: Dict[str, Any]) -> str:
+        self.cleanup()
+        run_id = uuid.uuid4().hex
+        now = time.time()
+        self._write_json(self._run_dir(run_id) / "run.json", {
+            "run_id": run_id, "params": params, "status": "running", "error": None, "created_at": now, "updated_at": now,
+        })
+        return run_id
+
+    def get(self, run_id: str) -> Dict[str, Any]:
+        record = self._read_json(self._run_dir(run_id) / "run.json")
+        if record is None:
+            raise RunNotFoundError(run_id)
+        return record
+
+    def set_status(self, run_id: str, status: str, error: Optional[str] = None) -> None:
+        record = self.get(run_id)
+        record.update(status=status, error=error, updated_at=time.time())
+        self._write_json(self._run_dir(run_id) / "run.json", record)
+
+    def save_stage(self, run_id: str, stage: str, value: Any) -> None:
+        self._write_json(self._run_dir(run_id) / f"{stage}.json", {"value": value})
+
+    def load_stage(self, run_id: str, stage: str) -> Optional[Any]:
+        data = self._read_json(self._run_dir(run_id) / f"{stage}.json")
+        return data.get("value") if isinstance(data, dict) else None
+
+    def save_scene(self, run_id: str, index: int, detail: Dict[str, Any]) -> None:
+        self._write_json(self._run_dir(run_id) / "scenes" / f"{index}.json", detail)
+
+    def load_scenes(self, run_id: str) -> Dict[int, Dict[str, Any]]:
+        scenes_dir = self._run_dir(run_id) / "scenes"
+        result: Dict[int, Dict[str, Any]] = {}
+        if not scenes_dir.is_dir():
+            return result
+        for path in scenes_dir.glob("*.json"):
+            detail = self._read_json(path)
+            if path.stem.isdigit() and isinstance(detail, dict):
+                result[int(path.stem)] = detail
+        return result
+
+    def cleanup(self, max_age_seconds: Optional[float] = None) -> int:
+        """Удаляет записи запусков старше max_age_seconds (по умолчанию RUNS_TTL_DAYS)."""
+        if max_age_seconds is None:
+            try:
+                max_age_seconds = float(os.getenv("RUNS_TTL_DAYS", str(DEFAULT_RUNS_TTL_DAYS))) * 86400
+            except ValueError:
+                max_age_seconds = DEFAULT_RUNS_TTL_DAYS * 86400
+        if not self.root.is_dir():
+            return 0
+        removed = 0
+        threshold = time.time() - max_age_seconds
+        for run_dir in self.root.iterdir():
+            run_file = run_dir / "run.json"
+            try:
+                if run_dir.is_dir() and run_file.stat().st_mtime < threshold:
+                    shutil.rmtree(run_dir)
+                    removed += 1
+            except OSError:
+                continue
+        return removed
+
+
+def get_run_store() -> RunStore:
+    return RunStore(get_data_dir() / "runs")
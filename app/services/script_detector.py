@@ -0,0 +1,59 @@
+import re
+import unicodedata
+from functools import lru_cache
+from typing import Any, Dict
+
+# Последовательности букв (без цифр и подчеркиваний)
+_WORD_RE = re.compile(r"[^\W\d_]+")
+# Римские цифры латиницей в русском тексте допустимы («Карл XII»)
+_ROMAN_NUMERAL_RE = re.compile(r"^[IVXLCDM]+$")
+_CJK_SCRIPTS = {"CJK", "HIRAGANA", "KATAKANA", "HANGUL", "BOPOMOFO"}
+
+
+@lru_cache(maxsize=4096)
+def _char_script(ch: str) -> str:
+    """Письменность буквы по имени символа Unicode: 'CYRILLIC', 'LATIN', 'CJK', ..."""
+    script = unicodedata.name(ch, "").split(" ", 1)[0]
+    return "CJK" if script in _CJK_SCRIPTS else script
+
+
+def scan_text(text: str) -> Dict[str, int]:
+    """Считает в русском тексте вкрапления чужих письменностей.
+
+    latin_words — слова латиницей, mixed_words — слова со смесью кириллицы и других
+    букв (например, латинская «a» внутри русского слова), cjk_chars — иероглифы и
+    слоговые знаки, other_chars — буквы прочих письменностей.
+    """
+    stats = {"words": 0, "latin_words": 0, "mixed_words": 0, "cjk_chars": 0, "other_chars": 0}
+    if not text:
+        return stats
+    for word in _WORD_RE.findall(text):
+        stats["words"] += 1
+        scripts = {_char_script(ch) for ch in word}
+        if scripts == {"CYRILLIC"}:
+            continue
+        cjk = sum(1 for ch in word if _char_script(ch) == "CJK")
+        stats["cjk_chars"] += cjk
+        stats["other_chars"] += sum(1 for ch in word if _char_script(ch) not in ("CYRILLIC", "LATIN", "CJK"))
+        if "CYRILLIC" in scripts:
+            stats["mixed_words"] += 1
+        elif scripts == {"LATIN"} and not _ROMAN_NUMERAL_RE.match(word):
+            stats["latin_words"] += 1
+    return stats
+
+
+def is_contaminated(stats: Dict[str, int]) -> bool:
+    return any(stats[key] for key in ("latin_words", "mixed_words", "cjk_chars", "other_chars"))
+
+
+def scan_quest(quest: Dict[str, Any]) -> Dict[str, Dict[str, int]]:
+    """Статистика по сценам с посторонними письменностями в text и в текстах выборов."""
+    contaminated: Dict[str, Dict[str, int]] = {}
+    for scene in quest.get("scenes", []):
+        stats = scan_text(scene.get("text", ""))
+        for choice in scene.get("choices", []):
+            for key, value in scan_text(choice.get("text", "")).items():
+                stats[key] += value
+        if is_contaminated(stats):
+            contaminated[scene["scene_id"]] = stats
+    return contaminated
@@ -0,0 +1,157 @@
+import json
+import re
+from typing import Any, Dict, List, Optional
+
+# JSON-схемы ответов этапов. Строгий вид (все поля обязательны, без лишних полей) нужен
+# structured outputs OpenAI; llama.cpp строит по схеме грамматику, Gemini — response_schema.
+
+
+def _object(properties: Dict[str, Any]) -> Dict[str, Any]:
+    return {"type": "object", "properties": properties, "required": list(properties), "additionalProperties": False}
+
+
+def _array(items: Dict[str, Any]) -> Dict[str, Any]:
+    return {"type": "array", "items": items}
+
+
+_STRING = {"type": "string"}
+
+RESPONSE_SCHEMAS: Dict[str, Dict[str, Any]] = {
+    # Этап 3: скелет графа
+    "skeleton": _object({
+        "start_scene": _STRING,
+        "scenes": _array(_object({
+            "scene_id": _STRING,
+            "summary": _STRING,
+            "choices": _array(_object({"choice_summary": _STRING, "next_scene": _STRING})),
+        })),
+    }),
+    # Этап 4: текст сцены
+    "scene_detail": _object({"text": _STRING, "choices_text": _array(_STRING)}),
+    # Этап 6: вычитанный кусок квеста
+    "corrected_chunk": _object({
+        "scenes": _array(_object({"scene_id": _STRING, "text": _STRING, "choices": _array(_object({"text": _STRING}))})),
+    }),
+    # Быстрый режим: концепт со списком сцен и граф с текстами
+    "fast_outline": _object({"concept": _STRING, "scenes": _array(_STRING)}),
+    "fast_quest": _object({
+        "start_scene": _STRING,
+        "scenes": _array(_object({
+            "scene_id": _STRING,
+            "text": _STRING,
+            "choices": _array(_object({"text": _STRING, "next_scene": _STRING})),
+        })),
+    }),
+}
+
+
+def openai_response_format(name: str) -> Dict[str, Any]:
+    """response_format для structured outputs OpenAI (строгое соответствие схеме)."""
+    return {"type": "json_schema", "json_schema": {"name": name, "schema": RESPONSE_SCHEMAS[name], "strict": True}}
+
+
+def _strip_keys(schema: Any, keys: set) -> Any:
+    if isinstance(schema, dict):
+        return {key: _strip_keys(value, keys) for key, value in schema.items() if key not in keys}
+    if isinstance(schema, list):
+        return [_strip_keys(item, keys) for item in schema]
+    return schema
+
+
+def gemini_generation_config(name: Optional[str]) -> Dict[str, Any]:
+    """generation_config Gemini для JSON-ответа; response_schema не поддерживает additionalProperties."""
+    config: Dict[str, Any] = {"response_mime_type": "application/json"}
+    if name is not None:
+        config["response_schema"] = _strip_keys(RESPONSE_SCHEMAS[name], {"additionalProperties"})
+    return config
+
+
+def llama_response_format(name: Optional[str]) -> Dict[str, Any]:
+    """response_format llama.cpp: со схемой генерация ограничивается грамматикой, построенной по ней."""
+    if name is None:
+        return {"type": "json_object"}
+    return {"type": "json_object", "schema": RESPONSE_SCHEMAS[name]}
+
+
+# --- Разбор JSON с ошибками ---
+
+_FENCE_RE = re.compile(r"```(?:json)?\s*([\s\S]*?)\s*```")
+_TRAILING_COMMA_RE = re.compile(r",\s*([}\]])")
+
+
+def _close_truncated(text: str) -> str:
+    """Дописывает незакрытую строку и скобки оборванного ответа."""
+    stack: List[str] = []
+    in_string = escaped = False
+    for ch in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+        elif ch in "}]" and stack:
+            stack.pop()
+    if in_string:
+        text += '"'
+    text = text.rstrip().rstrip(",").rstrip()
+    return text + "".join(reversed(stack))
+
+
+def _loads(text: str) -> Any:
+    # strict=False разрешает переводы строк внутри строк — частая ошибка моделей
+    return json.loads(text, strict=False)
+
+
+def parse_json_lenient(text: str) -> Any:
+    """Разбирает JSON из ответа модели: без обрамления ```json, текста вокруг, висячих запятых,
+    с оборванным концом. ValueError — если восстановить JSON не удалось."""
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        pass
+    fence = _FENCE_RE.search(text)
+    candidate = fence.group(1) if fence else text
+    starts = [pos for pos in (candidate.find("{"), candidate.find("[")) if pos >= 0]
+    if not starts:
+        raise ValueError("В ответе нет JSON-объекта.")
+    candidate = candidate[min(starts):]
+    end = max(candidate.rfind("}"), candidate.rfind("]"))
+    attempts = [candidate[: end + 1]] if end >= 0 else []
+    attempts.append(candidate)
+    for attempt in attempts:
+        for variant in (attempt, _TRAILING_COMMA_RE.sub(r"\1", attempt)):
+            try:
+                return _loads(variant)
+            except json.JSONDecodeError:
+                continue
+    # Оборванный ответ: отступаем к последней запятой, пока закрытый скобками остаток не разберется
+    truncated = _TRAILING_COMMA_RE.sub(r"\1", candidate)
+    for _ in range(50):
+        try:
+            return _loads(_close_truncated(truncated))
+        except json.JSONDecodeError:
+            cut = truncated.rfind(",")
+            if cut <= 0:
+                break
+            truncated = truncated[:cut]
+    raise ValueError("Не удалось восстановить JSON из ответа модели.")
+
+
+def normalize_json_response(text: str) -> str:
+    """Валидный JSON возвращается как есть, исправимый — восстановленным, остальное — без изменений
+    (решение о невалидном ответе принимает вызывающий этап)."""
+    try:
+        json.loads(text)
+        return text
+    except json.JSONDecodeError:
+        pass
+    try:
+        return json.dumps(parse_json_lenient(text), ensure_ascii=False)
+    except ValueError:
+        return text
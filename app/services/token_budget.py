@@ -0,0 +1,167 @@
+import functools
+import logging
+import os
+import re
+from typing import Any, Dict, List, NamedTuple, Optional
+
+try:
+    import tiktoken  # type: ignore[reportMissingImports]
+except ImportError:
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# Размер контекста локальных моделей (llama.cpp)
+LOCAL_N_CTX = 4096
+
+# Запас под служебные токены шаблона чата локальной модели
+LOCAL_CTX_MARGIN = 64
+
+
+class StageBudget(NamedTuple):
+    """Предел токенов промпта и ответа одного вызова LLM этапа."""
+
+    input_tokens: int
+    output_tokens: int
+
+
+# Бюджеты по видам вызовов (переопределяются TOKEN_BUDGET_<STAGE>="вход:выход")
+DEFAULT_STAGE_BUDGETS: Dict[str, StageBudget] = {
+    "setting_digest": StageBudget(3000, 1200),
+    "concept": StageBudget(3000, 1200),
+    "architect": StageBudget(2500, 800),
+    "director": StageBudget(3000, 3000),
+    "writer": StageBudget(3000, 800),
+    "corrector": StageBudget(2500, 2500),
+    "fast_outline": StageBudget(3000, 2000),
+    "fast_quest": StageBudget(3500, 6000),
+}
+
+# Сколько токенов промпта отдается сеттингу и тексту предыдущей сцены
+DEFAULT_SETTING_TOKENS = 1200
+DEFAULT_PREVIOUS_SCENE_TOKENS = 600
+
+_CYRILLIC_RE = re.compile(r"[Ѐ-ӿ]")
+
+
+def estimate_tokens(text: str) -> int:
+    """Оценка без токенизатора: кириллица ~3 символа на токен, латиница и остальное ~4."""
+    cyrillic = len(_CYRILLIC_RE.findall(text))
+    return cyrillic // 3 + (len(text) - cyrillic) // 4 + 1
+
+
+@functools.lru_cache(maxsize=16)
+def _tiktoken_encoding(model: str) -> Any:
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+def count_tokens(text: str, api_provider: Optional[str] = None, model: Optional[str] = None) -> int:
+    """Число токенов: точно через tiktoken для моделей OpenAI (если он установлен), иначе оценка."""
+    if tiktoken is not None and api_provider == "openai" and model:
+        return len(_tiktoken_encoding(model).encode(text, disallowed_special=()))
+    return estimate_tokens(text)
+
+
+def _get_int_env(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except ValueError:
+        logger.warning(f"Некорректное {name}, используется {default}.")
+        return default
+
+
+def get_stage_budget(stage: str, api_provider: Optional[str] = None, n_ctx: Optional[int] = None) -> StageBudget:
+    """Бюджет вызова этапа. Для локальных моделей промпт и ответ вместе умещаются в контекст
+    модели n_ctx (по умолчанию LOCAL_N_CTX)."""
+    budget = DEFAULT_STAGE_BUDGETS.get(stage, StageBudget(3000, 1024))
+    value = os.getenv(f"TOKEN_BUDGET_{stage.upper()}")
+    if value:
+        try:
+            input_tokens, output_tokens = (int(part) for part in value.split(":"))
+            budget = StageBudget(input_tokens, output_tokens)
+        except ValueError:
+            logger.warning(f"Некорректное TOKEN_BUDGET_{stage.upper()}={value!r}, ожидается 'вход:выход'.")
+    if api_provider == "local":
+        n_ctx = n_ctx or LOCAL_N_CTX
+        output_tokens = min(budget.output_tokens, n_ctx // 2)
+        budget = StageBudget(min(budget.input_tokens, n_ctx - output_tokens - LOCAL_CTX_MARGIN), output_tokens)
+    return budget
+
+
+def get_setting_tokens() -> int:
+    return _get_int_env("SETTING_MAX_TOKENS", DEFAULT_SETTING_TOKENS)
+
+
+def get_previous_scene_tokens() -> int:
+    return _get_int_env("PREVIOUS_SCENE_MAX_TOKENS", DEFAULT_PREVIOUS_SCENE_TOKENS)
+
+
+def _fit_length(text: str, max_tokens: int, keep_tail: bool = False) -> int:
+    """Длина самого длинного начала (или конца) текста, которое укладывается в max_tokens."""
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        part = text[-middle:] if keep_tail else text[:middle]
+        if estimate_tokens(part) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def truncate_to_tokens(text: str, max_tokens: int, keep_tail: bool = False) -> str:
+    """Обрезает текст до max_tokens по оценке, по границе предложения, если она рядом.
+    keep_tail оставляет конец текста (например, развязку предыдущей сцены)."""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    length = _fit_length(text, max_tokens - 1, keep_tail)  # токен под многоточие
+    part = text[-length:] if keep_tail and length else text[:length]
+    boundaries = [m.end() for m in re.finditer(r"[.!?…]\s", part)]
+    if keep_tail and boundaries and boundaries[0] < len(part) // 3:
+        part = part[boundaries[0]:]
+    elif not keep_tail and boundaries and boundaries[-1] > len(part) * 2 // 3:
+        part = part[:boundaries[-1]]
+    return "…" + part.lstrip() if keep_tail else part.rstrip() + "…"
+
+
+def split_by_tokens(text: str, max_tokens: int) -> List[str]:
+    """Делит текст на части не больше max_tokens, по абзацам, где это возможно."""
+    parts: List[str] = []
+    current = ""
+    for paragraph in re.split(r"(?<=\n)", text):
+        while estimate_tokens(paragraph) > max_tokens:
+            length = max(1, _fit_length(paragraph, max_tokens))
+            cut = paragraph.rfind(" ", 0, length) + 1  # по границе слова, если она есть
+            head = paragraph[: cut if cut > length // 2 else length]
+            if current:
+                parts.append(current)
+                current = ""
+            parts.append(head)
+            paragraph = paragraph[len(head):]
+        if current and estimate_tokens(current + paragraph) > max_tokens:
+            parts.append(current)
+            current = ""
+        current += paragraph
+    if current.strip():
+        parts.append(current)
+    return parts
+
+
+class StageTokenUsage:
+    """Токены, израсходованные этапом: промпты, ответы и число вызовов."""
+
+    def __init__(self) -> None:
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.calls = 0
+
+    def record(self, prompt: str, completion: str, api_provider: Optional[str] = None, model: Optional[str] = None) -> None:
+        self.prompt_tokens += count_tokens(prompt, api_provider, model)
+        self.completion_tokens += count_tokens(completion, api_provider, model)
+        self.calls += 1
+
+    def snapshot(self) -> Dict[str, int]:
+        return {"prompt": self.prompt_tokens, "completion": self.completion_tokens, "calls": self.calls}
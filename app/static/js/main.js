@@ -747,7 +747,23 @@ window.addEventListener('pywebviewready', async () => {
         }
     });
 
+    // Текущая генерация: повторное нажатие кнопки или закрытие вкладки останавливает ее на сервере
+    let activeGeneration = null;
+    const generateBtnLabel = generateBtn.textContent;
+
+    const cancelActiveGeneration = () => {
+        if (!activeGeneration) return;
+        const runId = activeGeneration.getRunId();
+        activeGeneration.controller.abort();
+        if (runId) fetch(`/generate/${runId}/cancel`, { method: 'POST' }).catch(() => {});
+    };
+    window.addEventListener('pagehide', () => {
+        const runId = activeGeneration && activeGeneration.getRunId();
+        if (runId) navigator.sendBeacon(`/generate/${runId}/cancel`);
+    });
+
     generateBtn.addEventListener('click', async () => {
+        if (activeGeneration) { cancelActiveGeneration(); return; }
         if (!window.activeChatId) createNewChat();
         const setting = settingInput.value.trim();
         const selectedProvider = document.querySelector('input[name="api_provider"]:checked').value;
@@ -757,18 +773,32 @@ window.addEventListener('pywebviewready', async () => {
             alert('Пожалуйста, введите сеттинг, выберите модель и убедитесь, что API ключ добавлен.'); return;
         }
 
+        // Прерванный запуск с тем же сеттингом можно продолжить с последней контрольной точки
+        const activeChat = window.chats[window.activeChatId];
+        const resumeRunId = activeChat.failed_run_id && activeChat.setting === setting
+            && confirm('Предыдущая генерация прервалась. Продолжить с сохраненного места?') ? activeChat.failed_run_id : null;
+        let currentRunId = resumeRunId;
+
         resultBox.textContent = 'Подключение к серверу...';
         graphBox.innerHTML = '<p>Подключение к серверу...</p>';
-        generateBtn.disabled = true;
+        const controller = new AbortController();
+        activeGeneration = { controller, getRunId: () => currentRunId };
+        generateBtn.textContent = 'Остановить генерацию';
         window.chats[window.activeChatId].setting = setting;
         showTab('json'); 
         const generation_settings = window.chats[window.activeChatId].generation_settings;
+        const fastModeInput = document.getElementById('fast-mode-input');
+        let streamClosed = false;
+        let partialGraphTimer = null;
 
         try {
-            const response = await fetch('/generate', {
+            const response = await fetch(resumeRunId ? '/generate/resume' : '/generate', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ setting, api_key: apiKey, api_provider: selectedProvider, model: selectedModel }),
+                body: JSON.stringify(resumeRunId
+                    ? { run_id: resumeRunId, api_key: apiKey, api_provider: selectedProvider, model: selectedModel }
+                    : { setting, api_key: apiKey, api_provider: selectedProvider, model: selectedModel, pipeline_mode: fastModeInput && fastModeInput.checked ? 'fast' : 'full' }),
+                signal: controller.signal,
             });
             
             if (!response.ok) {
@@ -779,37 +809,124 @@ window.addEventListener('pywebviewready', async () => {
             const reader = response.body.getReader();
             const decoder = new TextDecoder();
             let finalQuestData = null;
+            let buffer = '';
+            let statusMessage = '';
+            // Черновики текста сцен, которые приходят потоком (события scene_delta)
+            const sceneDrafts = {};
+            let renderScheduled = false;
+            // Квест, собираемый по ходу генерации из событий skeleton / scene_ready / corrected
+            let partialQuest = null;
+
+            const schedulePartialGraph = () => {
+                clearTimeout(partialGraphTimer);
+                partialGraphTimer = setTimeout(() => {
+                    if (!streamClosed && partialQuest) renderQuestGraph(JSON.stringify(partialQuest));
+                }, 300);
+            };
+            const applyQuestChanges = (changes) => {
+                for (const change of changes) {
+                    if (change.op === 'set') partialQuest[change.key] = change.value;
+                    else if (change.op === 'unset') delete partialQuest[change.key];
+                    else if (change.op === 'remove_scene') partialQuest.scenes = partialQuest.scenes.filter(s => s.scene_id !== change.scene_id);
+                    else if (change.op === 'set_scene') {
+                        const index = partialQuest.scenes.findIndex(s => s.scene_id === change.scene_id);
+                        if (index >= 0) partialQuest.scenes[index] = change.scene; else partialQuest.scenes.push(change.scene);
+                    }
+                }
+            };
+
+            const renderDrafts = () => {
+                renderScheduled = false;
+                if (streamClosed) return;
+                const drafts = Object.entries(sceneDrafts).map(([sceneId, text]) => `[${sceneId}]\n${text}`).join('\n\n');
+                resultBox.textContent = drafts ? `${statusMessage}\n\n${drafts}` : statusMessage;
+            };
+            const scheduleRender = () => {
+                if (!renderScheduled) { renderScheduled = true; requestAnimationFrame(renderDrafts); }
+            };
+
+            const handleLine = (line) => {
+                let progressUpdate;
+                try {
+                    progressUpdate = JSON.parse(line);
+                } catch (e) {
+                    console.error("Ошибка парсинга JSON-строки из потока:", line, e);
+                    return;
+                }
+
+                if (progressUpdate.status === 'cancelled') {
+                    throw new DOMException(progressUpdate.message, 'AbortError');
+                }
+
+                if (progressUpdate.status === 'error') {
+                    if (progressUpdate.run_id) currentRunId = progressUpdate.run_id;
+                    throw new Error(progressUpdate.message);
+                }
+
+                if (progressUpdate.status === 'run') {
+                    currentRunId = progressUpdate.run_id;
+                    return;
+                }
+
+                if (progressUpdate.status === 'scene_delta') {
+                    // reset: сцену заново пишет резервный провайдер
+                    const draft = progressUpdate.reset ? '' : (sceneDrafts[progressUpdate.scene_id] || '');
+                    sceneDrafts[progressUpdate.scene_id] = draft + progressUpdate.delta;
+                    scheduleRender();
+                    return;
+                }
+
+                if (progressUpdate.status === 'skeleton') {
+                    partialQuest = progressUpdate.quest;
+                    schedulePartialGraph();
+                    return;
+                }
+
+                if (progressUpdate.status === 'scene_ready' && partialQuest) {
+                    applyQuestChanges([{ op: 'set_scene', scene_id: progressUpdate.scene.scene_id, scene: progressUpdate.scene }]);
+                    delete sceneDrafts[progressUpdate.scene.scene_id];
+                    schedulePartialGraph();
+                    scheduleRender();
+                    return;
+                }
+
+                if (progressUpdate.status === 'corrected' && partialQuest) {
+                    applyQuestChanges(progressUpdate.changes);
+                    schedulePartialGraph();
+                    return;
+                }
+
+                if (progressUpdate.message) {
+                    statusMessage = progressUpdate.message;
+                    // Пока граф строится по частям, статус показываем только в JSON-вкладке
+                    if (!partialQuest) graphBox.innerHTML = `<p>${progressUpdate.message}</p>`;
+                    scheduleRender();
+                }
+
+                if (progressUpdate.status === 'done' && progressUpdate.quest) {
+                    finalQuestData = progressUpdate.quest;
+                }
+            };
 
             while (true) {
                 const { done, value } = await reader.read();
                 if (done) break;
-                
-                const chunk = decoder.decode(value, { stream: true });
-                const lines = chunk.split('\n').filter(line => line.trim() !== '');
 
+                // Строка NDJSON может прийти разрезанной между кусками — хвост ждет следующего куска
+                buffer += decoder.decode(value, { stream: true });
+                const lines = buffer.split('\n');
+                buffer = lines.pop();
                 for (const line of lines) {
-                    try {
-                        const progressUpdate = JSON.parse(line);
-
-                        if (progressUpdate.status === 'error') {
-                            throw new Error(progressUpdate.message);
-                        }
-
-                        if (progressUpdate.message) {
-                            resultBox.textContent = progressUpdate.message;
-                            graphBox.innerHTML = `<p>${progressUpdate.message}</p>`;
-                        }
-
-                        if (progressUpdate.status === 'done' && progressUpdate.quest) {
-                            finalQuestData = progressUpdate.quest;
-                        }
-                    } catch (e) {
-                        console.error("Ошибка парсинга JSON-строки из потока:", line, e);
-                    }
+                    if (line.trim() !== '') handleLine(line);
                 }
             }
+            buffer += decoder.decode();
+            if (buffer.trim() !== '') handleLine(buffer);
+            streamClosed = true;
+            clearTimeout(partialGraphTimer);
 
             if (finalQuestData) {
+                activeChat.failed_run_id = null;
                 const resultText = JSON.stringify(finalQuestData, null, 2);
                 window.chats[window.activeChatId].result = resultText;
                 resultBox.textContent = resultText;
@@ -820,14 +937,18 @@ window.addEventListener('pywebviewready', async () => {
             }
 
         } catch (error) {
+            streamClosed = true;
+            clearTimeout(partialGraphTimer);
+            activeChat.failed_run_id = currentRunId;
             console.error('Fetch/Stream Error:', error);
-            const errorMsg = `Ошибка: ${error.message}`;
+            const errorMsg = error.name === 'AbortError' ? 'Генерация остановлена.' : `Ошибка: ${error.message}`;
             window.chats[window.activeChatId].result = errorMsg;
             resultBox.textContent = errorMsg;
             graphBox.innerHTML = `<p class="status-error">${errorMsg}</p>`;
             showTab('json');
         } finally {
-            generateBtn.disabled = false;
+            activeGeneration = null;
+            generateBtn.textContent = generateBtnLabel;
             debouncedSaveChats();
         }
     });
@@ -0,0 +1,356 @@
+"""
+Набор микро-бенчмарков производительности конвейера генерации.
+
+Запуск из корня проекта:
+    python scripts/benchmark.py            # все сценарии
+    python scripts/benchmark.py clients    # только выбранные
+    python scripts/benchmark.py pipeline --llm-latency 800
+    python scripts/benchmark.py lore --lore-size 4
+    python scripts/benchmark.py prefix --local-model model.gguf
+"""
+
+import argparse
+import asyncio
+import copy
+import json
+import logging
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Set
+from unittest import mock
+
+import requests
+
+project_root = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(project_root))
+
+from app.services.llm_clients import ClientPool  # noqa: E402
+from app.services.lore_index import LoreIndex  # noqa: E402
+from app.services.model_registry import local_model_registry  # noqa: E402
+from app.services import quest_generator  # noqa: E402
+from app.services.quest_generator import _get_scene_detail_prompt, _validate_and_clean_quest  # noqa: E402
+from app.services.token_budget import estimate_tokens  # noqa: E402
+
+
+class Colors:
+    HEADER = "\033[95m"
+    OKGREEN = "\033[92m"
+    ENDC = "\033[0m"
+
+
+def _timeit(func: Callable[[], object], repeat: int) -> float:
+    """Среднее время одного вызова func в миллисекундах."""
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - started) * 1000 / repeat
+
+
+def _print_rows(rows: Dict[str, float], unit: str = "мс/вызов") -> None:
+    width = max(len(name) for name in rows)
+    for name, value in rows.items():
+        print(f"  {name:<{width}}  {value:10.3f} {unit}")
+
+
+class _EchoHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        body = b'{"text": "ok"}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def bench_clients(repeat: int) -> None:
+    """Накладные расходы на клиента провайдера: создание на каждый вызов против пула."""
+    print(f"\n{Colors.HEADER}--- Клиенты провайдеров ---{Colors.ENDC}")
+    from groq import Groq
+    import openai
+
+    pool = ClientPool()
+    rows = {
+        "Groq(): новый клиент": _timeit(lambda: Groq(api_key="bench"), repeat),
+        "Groq: из пула": _timeit(lambda: pool.get("groq", "bench"), repeat),
+        "OpenAI(): новый клиент": _timeit(lambda: openai.OpenAI(api_key="bench"), repeat),
+        "OpenAI: из пула": _timeit(lambda: pool.get("openai", "bench"), repeat),
+    }
+    _print_rows(rows)
+
+    # HTTP keep-alive: локальный сервер, чтобы измерить стоимость установки соединения
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _EchoHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/proxy/generate"
+    payload = {"prompt": "x" * 2000, "model": "bench"}
+    session = pool.get("vps_proxy")
+    try:
+        rows = {
+            "requests.post: новое соединение": _timeit(lambda: requests.post(url, json=payload, timeout=5), repeat),
+            "Session.post: keep-alive из пула": _timeit(lambda: session.post(url, json=payload, timeout=5), repeat),
+        }
+        _print_rows(rows)
+    finally:
+        server.shutdown()
+    print("  (для HTTPS к реальному провайдеру к новому соединению добавляется TLS-рукопожатие, обычно 50–200 мс)")
+
+
+def _synthetic_quest(scene_count: int, seed: int = 0) -> Dict[str, Any]:
+    """Ветвящийся квест: у каждой сцены есть родитель среди 50 предыдущих, плюс 1% недостижимых сцен."""
+    rng = random.Random(seed)
+    targets: Dict[int, Set[int]] = {i: set() for i in range(scene_count)}
+    for i in range(1, scene_count):
+        targets[rng.randrange(max(0, i - 50), i)].add(i)
+    scenes = [
+        {"scene_id": f"scene_{i}", "text": "...", "choices": [{"text": "...", "next_scene": f"scene_{t}"} for t in sorted(targets[i])]}
+        for i in range(scene_count)
+    ]
+    scenes += [
+        {"scene_id": f"lost_{i}", "text": "...", "choices": [{"text": "...", "next_scene": f"scene_{rng.randrange(scene_count)}"}]}
+        for i in range(scene_count // 100)
+    ]
+    return {"start_scene": "scene_0", "scenes": scenes}
+
+
+def _best_of(func: Callable[[Dict[str, Any]], object], quest: Dict[str, Any], runs: int = 3) -> float:
+    """Лучшее время func(копия квеста) в миллисекундах; копирование не измеряется."""
+    best = float("inf")
+    for _ in range(runs):
+        quest_copy = copy.deepcopy(quest)
+        started = time.perf_counter()
+        func(quest_copy)
+        best = min(best, (time.perf_counter() - started) * 1000)
+    return best
+
+
+def _legacy_validate_and_clean_quest(quest_json: Dict[str, Any]) -> Dict[str, Any]:
+    """Прежняя версия валидатора: BFS на list.pop(0) и поиск сцены перебором."""
+    all_scene_ids = {scene["scene_id"] for scene in quest_json["scenes"]}
+    reachable_ids: Set[str] = set()
+    queue = [quest_json.get("start_scene")]
+    while queue:
+        current_id = queue.pop(0)
+        if current_id and current_id in all_scene_ids and current_id not in reachable_ids:
+            reachable_ids.add(current_id)
+            current_scene = next((s for s in quest_json["scenes"] if s["scene_id"] == current_id), None)
+            if current_scene:
+                for choice in current_scene.get("choices", []):
+                    next_id = choice.get("next_scene")
+                    if next_id:
+                        queue.append(next_id)
+    quest_json["scenes"] = [scene for scene in quest_json["scenes"] if scene["scene_id"] in reachable_ids]
+    for scene in quest_json["scenes"]:
+        scene["choices"] = [c for c in scene.get("choices", []) if c.get("next_scene") in reachable_ids]
+    return quest_json
+
+
+def bench_graph(repeat: int) -> None:
+    """Валидация структуры квеста (этап 5): прежний квадратичный обход против QuestGraph."""
+    print(f"\n{Colors.HEADER}--- Граф квеста: валидация достижимости ---{Colors.ENDC}")
+    logging.getLogger("app.services.quest_generator").setLevel(logging.ERROR)  # без списков удаленных сцен
+    rows = {}
+    for scene_count in (1_000, 10_000, 50_000):
+        quest = _synthetic_quest(scene_count)
+        if scene_count <= 10_000:  # прежняя версия на 50 000 сцен работает минутами
+            rows[f"{scene_count} сцен: прежний валидатор"] = _best_of(_legacy_validate_and_clean_quest, quest, runs=1 if scene_count > 1_000 else 3)
+        rows[f"{scene_count} сцен: QuestGraph"] = _best_of(_validate_and_clean_quest, quest)
+    _print_rows(rows, unit="мс")
+
+
+class _SimulatedLLM:
+    """Отвечает на промпты всех этапов с фиксированной задержкой, как удаленная модель."""
+
+    def __init__(self, latency: float, scene_count: int):
+        self.latency = latency
+        self.scene_ids = [f"scene_{i}" for i in range(1, scene_count + 1)]
+        self.calls = 0
+
+    def _choices(self, index: int) -> List[Dict[str, str]]:
+        # Двоичное дерево: scene_i -> scene_2i, scene_2i+1
+        children = [child for child in (2 * index, 2 * index + 1) if child <= len(self.scene_ids)]
+        return [{"choice_summary": f"Путь {index}->{child}", "next_scene": f"scene_{child}"} for child in children]
+
+    async def __call__(self, prompt: str, *args: Any, **kwargs: Any) -> str:
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        summaries = [f"Ситуация {i}" for i in range(1, len(self.scene_ids) + 1)]
+        if "ведущий геймдизайнер" in prompt:
+            return json.dumps({"concept": "Концепт.", "scenes": summaries}, ensure_ascii=False)
+        if "автор интерактивных квестов" in prompt:
+            return json.dumps({"start_scene": "scene_1", "scenes": [
+                {"scene_id": scene_id, "text": "Текст сцены.", "choices": [
+                    {"text": c["choice_summary"], "next_scene": c["next_scene"]} for c in self._choices(i)
+                ]}
+                for i, scene_id in enumerate(self.scene_ids, start=1)
+            ]}, ensure_ascii=False)
+        if "эксперт-геймдизайнер" in prompt:
+            return "Концепт."
+        if "технический ассистент" in prompt:
+            return "\n".join(f"{i}. {summary}" for i, summary in enumerate(summaries, start=1))
+        if "геймдизайнер-нарративщик" in prompt:
+            return json.dumps({"start_scene": "scene_1", "scenes": [
+                {"scene_id": scene_id, "summary": summaries[i - 1], "choices": self._choices(i)}
+                for i, scene_id in enumerate(self.scene_ids, start=1)
+            ]}, ensure_ascii=False)
+        if "сценарист интерактивных историй" in prompt:
+            return json.dumps({"text": "Текст сцены.", "choices_text": ["Действие 1", "Действие 2"]}, ensure_ascii=False)
+        if "редактор-корректор" in prompt:
+            return re.search(r"JSON для вычитки:\*\*\n---\n([\s\S]*)\n---", prompt).group(1)
+        raise ValueError(f"Неожиданный промпт: {prompt[:60]}")
+
+
+async def _run_pipeline_mode(mode: str, scene_count: int) -> str:
+    status = ""
+    async for line in quest_generator.acreate_quest_from_setting(
+        "Сеттинг", "bench", "openai", "bench", scene_count, "", "", [], use_cache=False, pipeline_mode=mode,
+    ):
+        status = json.loads(line)["status"]
+    return status
+
+
+def bench_pipeline(repeat: int, llm_latency: float = 0.5) -> None:
+    """Полный и быстрый режимы конвейера: число вызовов LLM и время до готового квеста."""
+    print(f"\n{Colors.HEADER}--- Конвейер: полный и быстрый режимы (задержка LLM {llm_latency * 1000:.0f} мс) ---{Colors.ENDC}")
+    logging.getLogger("app.services.quest_generator").setLevel(logging.ERROR)
+    rows: Dict[str, float] = {}
+    with tempfile.TemporaryDirectory() as data_dir, mock.patch.dict(os.environ, {
+        "PLOTIX_DATA_DIR": data_dir, "CORRECTION_FORCE_FULL": "true", "FAST_MODE_CORRECTION": "false",
+    }):
+        for scene_count in (8, 16):
+            for mode in quest_generator.PIPELINE_MODES:
+                llm = _SimulatedLLM(llm_latency, scene_count)
+                with mock.patch.object(quest_generator, "_acall_llm", llm):
+                    started = time.perf_counter()
+                    status = asyncio.run(_run_pipeline_mode(mode, scene_count))
+                    elapsed = time.perf_counter() - started
+                if status != "done":
+                    print(f"  {scene_count} сцен, {mode}: генерация завершилась со статусом {status}")
+                    continue
+                rows[f"{scene_count} сцен, {mode}: вызовов LLM"] = llm.calls
+                rows[f"{scene_count} сцен, {mode}: время"] = elapsed
+    _print_rows(rows, unit="")
+    print("  (время в секундах; быстрый режим пишет граф и тексты одним вызовом до FAST_MODE_MAX_SCENES сцен)")
+
+
+def _synthetic_lore(size_bytes: int) -> str:
+    """Сеттинг из абзацев случайных слов заданного размера в байтах UTF-8."""
+    rng = random.Random(0)
+    words = [f"слово{i}" for i in range(5000)] + ["крепость", "дракон", "гильдия", "маяк", "река"]
+    paragraphs: List[str] = []
+    size = 0
+    while size < size_bytes:
+        paragraph = " ".join(rng.choice(words) for _ in range(rng.randint(20, 80))) + "."
+        paragraphs.append(paragraph)
+        size += len(paragraph.encode("utf-8")) + 1
+    return "\n".join(paragraphs)
+
+
+def bench_lore(repeat: int, size_mb: float = 1.0) -> None:
+    """Построение BM25-индекса сеттинга и поиск фрагментов для промпта сцены."""
+    print(f"\n{Colors.HEADER}--- Индекс сеттинга: {size_mb:g} МБ ---{Colors.ENDC}")
+    text = _synthetic_lore(int(size_mb * 1024 * 1024))
+    started = time.perf_counter()
+    index = LoreIndex.from_text(text)
+    build_ms = (time.perf_counter() - started) * 1000
+    query = "Герой поднимается к маяку у реки, где гильдия держит крепость"
+    rows = {
+        f"построение индекса ({len(index.chunks)} фрагментов)": build_ms,
+        "поиск top-4": _timeit(lambda: index.retrieve(query, 4), repeat),
+    }
+    _print_rows(rows, unit="мс")
+
+
+def _scene_prompts(setting: str, scene_count: int) -> List[str]:
+    return [
+        _get_scene_detail_prompt(
+            setting, f"Ситуация {i}", f"Вы решили: 'Путь {i}'. Это привело вас к следующей ситуации: 'Ситуация {i}'.",
+            "Текст предыдущей сцены. " * 40 if i > 1 else "",
+        )
+        for i in range(1, scene_count + 1)
+    ]
+
+
+def bench_prefix(repeat: int, local_model: str = "") -> None:
+    """Общее начало промптов сцен и prefill локальной модели с кэшем KV-состояний и без него."""
+    print(f"\n{Colors.HEADER}--- Общее начало промптов сцен (этап 4) ---{Colors.ENDC}")
+    setting = (project_root / "examples" / "example_fantasy.txt").read_text(encoding="utf-8")
+    prompts = _scene_prompts(setting, 8)
+    shared = estimate_tokens(os.path.commonprefix(prompts))
+    average = sum(estimate_tokens(prompt) for prompt in prompts) / len(prompts)
+    _print_rows({
+        "общее начало, токенов": shared,
+        "промпт сцены в среднем, токенов": average,
+        "доля общего начала, %": shared / average * 100,
+    }, unit="")
+    if not local_model:
+        print("  (prefill локальной модели измеряется с --local-model <файл.gguf>)")
+        return
+    if quest_generator.Llama is None:
+        print("  llama_cpp не установлен: prefill не измеряется.")
+        return
+    rows: Dict[str, float] = {}
+    for label, cache_mb in (("без кэша", "0"), ("с кэшем", str(quest_generator.DEFAULT_LOCAL_PROMPT_CACHE_MB))):
+        local_model_registry.clear()
+        with mock.patch.dict(os.environ, {"LOCAL_PROMPT_CACHE_MB": cache_mb}):
+            quest_generator._local_chat_completion("Прогрев.", local_model, {"type": "text"}, max_tokens=1)
+            elapsed = 0.0
+            for prompt in prompts:
+                # Посторонний промпт между сценами (другие этапы и генерации) вытесняет контекст модели
+                quest_generator._local_chat_completion("Другой этап.", local_model, {"type": "text"}, max_tokens=1)
+                started = time.perf_counter()
+                quest_generator._local_chat_completion(prompt, local_model, {"type": "text"}, max_tokens=1)
+                elapsed += time.perf_counter() - started
+        rows[f"prefill сцены, {label}"] = elapsed * 1000 / len(prompts)
+    local_model_registry.clear()
+    _print_rows(rows, unit="мс")
+
+
+BENCHMARKS = {
+    "clients": bench_clients,
+    "graph": bench_graph,
+    "pipeline": bench_pipeline,
+    "lore": bench_lore,
+    "prefix": bench_prefix,
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Бенчмарки Plotix")
+    parser.add_argument("names", nargs="*", help=f"Сценарии для запуска: {', '.join(BENCHMARKS)}")
+    parser.add_argument("--repeat", type=int, default=200, help="Число повторов в микро-бенчмарках")
+    parser.add_argument("--llm-latency", type=int, default=500, help="Задержка ответа LLM в сценарии pipeline, мс")
+    parser.add_argument("--lore-size", type=float, default=1.0, help="Размер сеттинга в сценарии lore, МБ")
+    parser.add_argument("--local-model", default="", help="Файл GGUF из LOCAL_MODEL_PATH для сценария prefix")
+    args = parser.parse_args()
+    unknown = [name for name in args.names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"Неизвестные сценарии: {', '.join(unknown)}")
+    for name in args.names or list(BENCHMARKS):
+        if name == "pipeline":
+            bench_pipeline(args.repeat, args.llm_latency / 1000)
+        elif name == "lore":
+            bench_lore(args.repeat, args.lore_size)
+        elif name == "prefix":
+            bench_prefix(args.repeat, args.local_model)
+        else:
+            BENCHMARKS[name](args.repeat)
+    print(f"\n{Colors.OKGREEN}Готово.{Colors.ENDC}")
+
+
+if __name__ == "__main__":
+    main()
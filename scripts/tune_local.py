@@ -0,0 +1,64 @@
+"""
+Подбор параметров llama.cpp для локальной модели под железо этой машины.
+
+Запуск из корня проекта:
+    python scripts/tune_local.py model.gguf              # подобрать (или показать сохраненные) параметры
+    python scripts/tune_local.py model.gguf --calibrate  # и замерить скорость prefill и генерации
+    python scripts/tune_local.py model.gguf --retune     # подобрать заново, даже если ничего не менялось
+
+Модель ищется в LOCAL_MODEL_PATH. Результат хранится в plotix_data/local_tuning.json и
+используется при каждой загрузке модели; ручные правки задаются в поле overrides записи модели
+или переменными LOCAL_N_CTX, LOCAL_N_THREADS, LOCAL_N_THREADS_BATCH, LOCAL_N_BATCH,
+LOCAL_N_GPU_LAYERS, LOCAL_USE_MMAP, LOCAL_USE_MLOCK.
+"""
+
+import argparse
+import json
+import os
+import sys
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+project_root = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(project_root))
+
+from app.services import quest_generator  # noqa: E402
+from app.services.local_tuning import (  # noqa: E402
+    apply_overrides,
+    calibrate_model,
+    detect_hardware,
+    read_gguf_metadata,
+    tune_model,
+)
+
+
+def main() -> int:
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Подбор параметров локальной модели Plotix")
+    parser.add_argument("model", help="Имя файла GGUF в LOCAL_MODEL_PATH")
+    parser.add_argument("--calibrate", action="store_true", help="Замерить скорость prefill и генерации")
+    parser.add_argument("--retune", action="store_true", help="Подобрать параметры заново")
+    args = parser.parse_args()
+
+    model_path = quest_generator._local_model_path(args.model)
+    if not os.path.exists(model_path):
+        parser.error(f"Локальная модель не найдена по пути: {model_path}")
+    metadata = read_gguf_metadata(model_path)
+    print(f"Модель: {metadata.get('general.name', args.model)} ({metadata.get('general.architecture', '?')})")
+    print(f"Железо: {detect_hardware()._asdict()}")
+    # Те же кэш промптов и число процессов, что и у приложения: иначе запись подберется заново при запуске
+    tuning_args = quest_generator._get_local_tuning_args()
+    entry = tune_model(model_path, retune=args.retune, **tuning_args)
+    print("Параметры:", json.dumps(apply_overrides(entry["params"], entry.get("overrides")), ensure_ascii=False))
+    if args.calibrate:
+        if quest_generator.Llama is None:
+            parser.error("Модуль llama_cpp не установлен: калибровка невозможна.")
+        calibration = calibrate_model(model_path, quest_generator.Llama, **tuning_args)
+        print(f"Prefill: {calibration['prompt_tokens_per_sec']} токенов/с, "
+              f"генерация: {calibration['generation_tokens_per_sec']} токенов/с")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,27 @@
+import pytest
+
+from app.services.circuit_breaker import circuit_breakers
+from app.services.job_queue import reset_job_manager
+from app.services.llm_clients import async_client_pool, client_pool
+from app.services.rate_limiter import rate_limiters
+
+
+@pytest.fixture(autouse=True)
+def isolated_data_dir(tmp_path, monkeypatch):
+    """Кэш и записи запусков пишутся во временную папку, а не в plotix_data проекта."""
+    monkeypatch.setenv("PLOTIX_DATA_DIR", str(tmp_path / "plotix_data"))
+
+
+@pytest.fixture(autouse=True)
+def reset_shared_state():
+    """Сбрасывает общие на процесс кэши, чтобы моки и лимиты не переходили между тестами."""
+    client_pool.clear()
+    async_client_pool.clear()
+    rate_limiters.clear()
+    circuit_breakers.clear()
+    yield
+    reset_job_manager()
+    client_pool.clear()
+    async_client_pool.clear()
+    rate_limiters.clear()
+    circuit_breakers.clear()
@@ -231,3 +231,70 @@ def test_delete_local_models_endpoint_partial_success(client, monkeypatch):
     )
     assert response.status_code == 207
     assert response.get_json() == {"status": "partial", "message": "Partial success"}
+
+
+def test_generate_rejects_unknown_stage_model(client, monkeypatch):
+    """Маршрут этапа на модель, которой нет у провайдера, отклоняется до начала генерации."""
+    from app.services import quest_generator
+
+    monkeypatch.setattr(quest_generator, "get_available_models", lambda provider, key: {"free": ["small"], "paid": []})
+    monkeypatch.setattr(quest_generator, "_model_list_cache", {})
+    response = client.post("/generate", json={
+        "setting": "s", "api_key": "k", "api_provider": "groq", "model": "m",
+        "stage_models": {"architect": {"api_provider": "groq", "model": "huge"}},
+    })
+    assert response.status_code == 400
+    assert "huge" in response.get_json()["message"]
+
+
+def test_resume_validates_request_before_streaming(client, monkeypatch):
+    """/generate/resume проверяет ключ, запуск, маршруты этапов и режим до начала потока."""
+    from app.services import quest_generator
+    from app.services.run_store import get_run_store
+
+    monkeypatch.setattr(quest_generator, "get_available_models", lambda provider, key: {"free": ["small"], "paid": []})
+    monkeypatch.setattr(quest_generator, "_model_list_cache", {})
+    monkeypatch.setattr("app.main.resume_quest_run", lambda *args, **kwargs: iter(()))
+    run_id = get_run_store().create({"api_provider": "groq", "model": "small"})
+
+    assert client.post("/generate/resume", json={"run_id": run_id}).status_code == 400
+    assert client.post("/generate/resume", json={"run_id": "missing", "api_key": "k"}).status_code == 404
+    response = client.post("/generate/resume", json={
+        "run_id": run_id, "api_key": "k", "stage_models": {"architect": {"api_provider": "groq", "model": "huge"}},
+    })
+    assert response.status_code == 400 and "huge" in response.get_json()["message"]
+    response = client.post("/generate/resume", json={"run_id": run_id, "api_key": "k", "pipeline_mode": "turbo"})
+    assert response.status_code == 400 and "turbo" in response.get_json()["message"]
+    assert client.post("/generate/resume", json={"run_id": run_id, "api_key": "k"}).status_code == 200
+
+
+def test_generate_parses_use_cache_strictly(client, monkeypatch):
+    """Строка "false" отключает кэш, а непонятное значение use_cache отклоняется с 400."""
+    calls = []
+    monkeypatch.setattr("app.main.create_quest_from_setting", lambda *args, **kwargs: calls.append(kwargs) or iter(()))
+    body = {"setting": "s", "api_key": "k", "api_provider": "vps_proxy", "model": "m"}
+
+    response = client.post("/generate", json={**body, "use_cache": "false"})
+    response.get_data()
+    assert response.status_code == 200 and calls[-1]["use_cache"] is False
+
+    for endpoint in ("/generate", "/jobs", "/generate/resume"):
+        response = client.post(endpoint, json={**body, "run_id": "r", "use_cache": "maybe"})
+        assert response.status_code == 400
+        assert "use_cache" in response.get_json()["message"]
+    assert len(calls) == 1
+
+
+def test_local_workers_stats_endpoint(client, monkeypatch):
+    """Без LOCAL_WORKERS пул выключен; с пулом отдаются процессы и длина очереди."""
+    from app.services import local_workers
+
+    monkeypatch.delenv("LOCAL_WORKERS", raising=False)
+    assert client.get("/api/local_workers/stats").get_json() == {"enabled": False}
+
+    pool = local_workers.LocalWorkerPool(2, health_interval=0)
+    monkeypatch.setenv("LOCAL_WORKERS", "2")
+    monkeypatch.setattr(local_workers, "_pool", pool)
+    data = client.get("/api/local_workers/stats").get_json()
+    assert data["enabled"] and data["size"] == 2 and data["queue_depth"] == 0
+    assert [worker["alive"] for worker in data["workers"]] == [False, False]  # процессы стартуют по первому запросу
@@ -0,0 +1,104 @@
+import asyncio
+import json
+import subprocess
+import sys
+
+from app import batch
+
+DEFAULTS = {"api_provider": "groq", "model": "m", "scene_count": 3, "tone": "", "pacing": "", "narrative_elements": []}
+
+
+def test_load_inputs_from_directory_and_jsonl(tmp_path):
+    (tmp_path / "b.txt").write_text("Город-улей\n", encoding="utf-8")
+    (tmp_path / "a.txt").write_text("Пустошь", encoding="utf-8")
+    assert batch.load_inputs(tmp_path) == [{"id": "a", "setting": "Пустошь"}, {"id": "b", "setting": "Город-улей"}]
+
+    jsonl = tmp_path / "settings.jsonl"
+    jsonl.write_text('{"setting": "Остров", "scene_count": 5}\n\n{"id": 7, "setting": "Степь"}\n', encoding="utf-8")
+    assert batch.load_inputs(jsonl) == [
+        {"id": "line_1", "setting": "Остров", "scene_count": 5},
+        {"id": "7", "setting": "Степь"},
+    ]
+
+
+def test_run_batch_limits_concurrency_and_skips_completed(tmp_path, monkeypatch):
+    """Не больше concurrency генераций одновременно; успешные id не генерируются повторно, ошибки — повторяются."""
+    active = 0
+    peak = 0
+    calls = []
+
+    async def fake_acreate(setting_text, api_key, api_provider, model, scene_count, tone, pacing, narrative_elements, use_cache=True, fallbacks=None, stage_models=None, pipeline_mode=None):
+        nonlocal active, peak
+        calls.append((setting_text, scene_count))
+        active += 1
+        peak = max(peak, active)
+        yield json.dumps({"status": "run", "run_id": "r" + setting_text})
+        await asyncio.sleep(0.01)
+        active -= 1
+        if setting_text == "плохой":
+            yield json.dumps({"status": "error", "message": "Неверный API ключ."}, ensure_ascii=False)
+        else:
+            yield json.dumps({"status": "done", "quest": {"title": setting_text}}, ensure_ascii=False)
+
+    monkeypatch.setattr(batch, "acreate_quest_from_setting", fake_acreate)
+    output = tmp_path / "out" / "quests.jsonl"
+    output.parent.mkdir()
+    output.write_text('{"id": "s0", "status": "done"}\n{"id": "s1", "status": "error"}\n{"id": "обрыв', encoding="utf-8")
+    items = [{"id": f"s{i}", "setting": f"сеттинг {i}"} for i in range(6)] + [{"id": "bad", "setting": "плохой", "scene_count": 9}]
+
+    result = asyncio.run(batch.run_batch(items, output, DEFAULTS, "k", concurrency=2, log=lambda message: None))
+
+    assert peak == 2
+    assert result["skipped"] == 1 and result["done"] == 5 and result["failed"] == 1
+    assert ("плохой", 9) in calls and ("сеттинг 0", 3) not in calls
+    records = [json.loads(line) for line in output.read_text(encoding="utf-8").splitlines()[3:]]
+    assert {r["id"] for r in records} == {"s1", "s2", "s3", "s4", "s5", "bad"}
+    bad = next(r for r in records if r["id"] == "bad")
+    assert bad["error"] == "Неверный API ключ." and bad["run_id"] == "rплохой"
+    assert batch.load_completed_ids(output) == {"s0", "s1", "s2", "s3", "s4", "s5"}
+    assert "квестов/мин" in batch.format_stats(result["latencies"], result["failed"], result["skipped"], result["elapsed"])
+
+
+def test_cancelled_inputs_are_not_failures_and_resume_their_run(tmp_path, monkeypatch):
+    """Отмена — отдельный статус вне ошибок и задержек; run_id сохраняется, и повторный запуск продолжает его."""
+    resumed = []
+
+    async def fake_acreate(setting_text, api_key, api_provider, model, scene_count, tone, pacing, narrative_elements, use_cache=True, fallbacks=None, stage_models=None, pipeline_mode=None):
+        yield json.dumps({"status": "run", "run_id": "r-" + setting_text})
+        yield json.dumps({"status": "cancelled", "message": "Генерация отменена.", "run_id": "r-" + setting_text}, ensure_ascii=False)
+
+    async def fake_aresume(run_id, api_key, api_provider=None, model=None, use_cache=True, fallbacks=None, stage_models=None, pipeline_mode=None):
+        resumed.append((run_id, api_provider, model))
+        yield json.dumps({"status": "done", "quest": {"title": run_id}})
+
+    class FakeStore:
+        def get(self, run_id):
+            if run_id != "r-отмена":
+                raise batch.RunNotFoundError(run_id)
+            return {"params": {}}
+
+    monkeypatch.setattr(batch, "acreate_quest_from_setting", fake_acreate)
+    monkeypatch.setattr(batch, "aresume_quest_run", fake_aresume)
+    monkeypatch.setattr(batch, "get_run_store", lambda: FakeStore())
+    output = tmp_path / "quests.jsonl"
+    items = [{"id": "c", "setting": "отмена"}]
+
+    result = asyncio.run(batch.run_batch(items, output, DEFAULTS, "k", concurrency=1, log=lambda message: None))
+
+    assert result["cancelled"] == 1 and result["failed"] == 0 and result["latencies"] == []
+    record = json.loads(output.read_text(encoding="utf-8"))
+    assert record["status"] == "cancelled" and record["run_id"] == "r-отмена"
+    assert batch.load_cancelled_runs(output) == {"c": "r-отмена"}
+    assert "отменено: 1" in batch.format_stats(result["latencies"], result["failed"], result["skipped"], result["elapsed"], result["cancelled"])
+
+    result = asyncio.run(batch.run_batch(items, output, DEFAULTS, "k", concurrency=1, log=lambda message: None))
+
+    assert resumed == [("r-отмена", "groq", "m")]
+    assert result["done"] == 1 and result["cancelled"] == 0
+    assert batch.load_completed_ids(output) == {"c"} and batch.load_cancelled_runs(output) == {}
+
+
+def test_batch_does_not_import_desktop_dependencies():
+    code = "import sys, app.batch; print('webview' in sys.modules or 'huggingface_hub' in sys.modules)"
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == "False"
@@ -0,0 +1,72 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from app.main import app
+from app.services import quest_generator
+from app.services.cancellation import CancelToken, GenerationCancelled, current_cancel_token
+from app.services.model_registry import local_model_registry
+
+
+def test_guard_cancels_awaiting_task_from_another_thread():
+    token = CancelToken()
+
+    async def main():
+        threading.Timer(0.05, token.cancel).start()
+        with pytest.raises(GenerationCancelled):
+            await token.guard(asyncio.sleep(10))
+        with pytest.raises(GenerationCancelled):
+            await token.guard(asyncio.sleep(0))
+
+    started = time.perf_counter()
+    asyncio.run(main())
+    assert time.perf_counter() - started < 1
+
+
+def test_token_reaches_worker_threads():
+    """asyncio.to_thread внутри guard видит токен — так его получает llama.cpp."""
+    token = CancelToken()
+
+    async def main():
+        return await token.guard(asyncio.to_thread(current_cancel_token.get))
+
+    assert asyncio.run(main()) is token
+
+
+class EndlessLlama:
+    """Локальная модель, которая генерирует токены, пока ее не остановят."""
+
+    def __init__(self, **kwargs):
+        self.yielded = 0
+
+    def create_chat_completion(self, stream=False, **kwargs):
+        assert stream is True
+        while True:
+            self.yielded += 1
+            if self.yielded == 3:
+                current_cancel_token.get().cancel()
+            yield {"choices": [{"delta": {"content": "т"}}]}
+
+
+def test_local_generation_stops_between_tokens(tmp_path, monkeypatch):
+    (tmp_path / "model.gguf").write_bytes(b"gguf")
+    monkeypatch.setenv("LOCAL_MODEL_PATH", str(tmp_path))
+    monkeypatch.setattr(quest_generator, "Llama", EndlessLlama)
+    token = CancelToken()
+    current = current_cancel_token.set(token)
+    try:
+        with pytest.raises(GenerationCancelled):
+            quest_generator._local_chat_completion("промпт", "model.gguf", {"type": "text"})
+        # Модель сразу освобождена для следующей генерации
+        assert [m["in_use"] for m in local_model_registry.stats()["resident_models"]] == [0]
+    finally:
+        current_cancel_token.reset(current)
+        local_model_registry.clear()
+
+
+def test_cancel_endpoint_unknown_run():
+    response = app.test_client().post("/generate/" + "0" * 32 + "/cancel")
+    assert response.status_code == 404
+    assert response.get_json()["status"] == "error"
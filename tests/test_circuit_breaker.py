@@ -0,0 +1,83 @@
+import json
+import time
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import groq
+import httpx
+import pytest
+
+from app.main import app
+from app.services.async_bridge import run_sync
+from app.services.circuit_breaker import CircuitBreaker, CircuitOpenError, circuit_breakers, key_id
+from app.services.quest_generator import LLMTarget, _acall_llm_failover, _call_llm
+
+
+def test_breaker_opens_after_consecutive_failures_and_half_opens():
+    breaker = CircuitBreaker(failure_threshold=2, cooldown=0.05)
+    breaker.record_failure("HTTP 503")
+    breaker.record_success()
+    breaker.record_failure("HTTP 503")
+    assert breaker.allow()  # успех между ошибками сбрасывает счетчик
+    breaker.record_failure("HTTP 503")
+    assert breaker.is_open and not breaker.allow()
+
+    time.sleep(0.06)
+    assert breaker.allow()  # пробный запрос
+    assert not breaker.allow()  # второй ждет результата пробного
+    breaker.record_failure("HTTP 500")
+    assert breaker.is_open
+
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.snapshot()["state"] == "closed" and breaker.allow()
+
+
+def _server_error():
+    response = httpx.Response(503, request=httpx.Request("POST", "https://api.groq.com"))
+    return groq.InternalServerError("unavailable", response=response, body=None)
+
+
+@patch("app.services.rate_limiter.asyncio.sleep", new_callable=AsyncMock)
+@patch("app.services.llm_clients.openai.AsyncOpenAI")
+@patch("app.services.llm_clients.AsyncGroq")
+def test_open_breaker_routes_calls_to_fallback(mock_groq, mock_openai, mock_sleep, monkeypatch):
+    """5xx подряд открывают автомат groq; следующие запросы сразу идут к резервному провайдеру."""
+    monkeypatch.setenv("CIRCUIT_FAILURE_THRESHOLD", "2")
+    groq_create = AsyncMock(side_effect=[_server_error(), _server_error()])
+    mock_groq.return_value.chat.completions.with_raw_response.create = groq_create
+    ok_response = MagicMock()
+    ok_response.headers = {}
+    ok_response.parse = AsyncMock()
+    ok_response.parse.return_value.choices[0].message.content = '{"ok": true}'
+    mock_openai.return_value.chat.completions.with_raw_response.create = AsyncMock(return_value=ok_response)
+
+    with pytest.raises(CircuitOpenError):
+        _call_llm("промпт", "groq", "key", "model")
+    assert groq_create.call_count == 2
+
+    chain = [LLMTarget("groq", "key", "model"), LLMTarget("openai", "key2", "gpt")]
+    assert run_sync(_acall_llm_failover("промпт", chain)) == '{"ok": true}'
+    assert groq_create.call_count == 2
+
+    health = app.test_client().get("/api/providers/health").get_json()
+    [groq_health] = health["groq"]
+    [openai_health] = health["openai"]
+    assert groq_health["state"] == "open" and groq_health["last_error"] == "HTTP 503"
+    assert openai_health["state"] == "closed" and openai_health["total_successes"] == 1
+    assert groq_health["key_id"] == key_id("key") and "key" not in groq_health.values()
+    circuit_breakers.clear()
+
+
+def test_breakers_are_separate_per_api_key():
+    """Ключ A, исчерпавший квоту, открывает только свой автомат: ключ B того же провайдера работает."""
+    breaker_a = circuit_breakers.get("groq", "key-a")
+    for _ in range(breaker_a.failure_threshold):
+        breaker_a.record_failure("HTTP 429")
+
+    assert not circuit_breakers.get("groq", "key-a").allow()
+    assert circuit_breakers.get("groq", "key-b").allow()
+
+    states = {entry["key_id"]: entry["state"] for entry in circuit_breakers.health()["groq"]}
+    assert states == {key_id("key-a"): "open", key_id("key-b"): "closed"}
+    assert "key-a" not in json.dumps(circuit_breakers.health())
@@ -9,7 +9,7 @@ from app.services.quest_generator import (
 )
 
 
-@patch("app.services.quest_generator.Groq")
+@patch("app.services.llm_clients.Groq")
 def test_create_quest_groq_success(mock_groq):
     """Тестирует успешный путь с провайдером Groq."""
     mock_response_content = '{"questTitle": "Успешный тест Groq"}'
@@ -23,7 +23,7 @@ def test_create_quest_groq_success(mock_groq):
     mock_groq.return_value.chat.completions.create.assert_called_once()
 
 
-@patch("app.services.quest_generator.openai.OpenAI")
+@patch("app.services.llm_clients.openai.OpenAI")
 def test_create_quest_openai_success(mock_openai):
     """Тестирует успешный путь с провайдером OpenAI."""
     mock_response_content = '{"questTitle": "Успешный тест OpenAI"}'
@@ -35,7 +35,7 @@ def test_create_quest_openai_success(mock_openai):
     mock_openai.return_value.chat.completions.create.assert_called_once()
 
 
-@patch("app.services.quest_generator.genai")
+@patch("app.services.llm_clients.genai")
 def test_create_quest_gemini_success(mock_genai):
     """Тестирует успешный путь с провайдером Gemini."""
     mock_response = MagicMock()
@@ -47,10 +47,10 @@ def test_create_quest_gemini_success(mock_genai):
         "любой сеттинг", "fake_key", "gemini", "gemini-pro"
     )
     assert result == {"questTitle": "Успешный тест Gemini"}
-    mock_genai.configure.assert_called_once_with(api_key="fake_key")
+    mock_genai.configure.assert_not_called()
 
 
-@patch("app.services.quest_generator.Groq")
+@patch("app.services.llm_clients.Groq")
 def test_create_quest_api_error(mock_groq):
     """Тестирует случай, когда API (на примере Groq) возвращает ошибку."""
     mock_groq.return_value.chat.completions.create.side_effect = Exception("API Error")
@@ -61,7 +61,7 @@ def test_create_quest_api_error(mock_groq):
     assert "Произошла ошибка при обращении к API groq: API Error" in result["error"]
 
 
-@patch("app.services.quest_generator.Groq")
+@patch("app.services.llm_clients.Groq")
 def test_create_quest_no_content(mock_groq):
     """Тестирует случай, когда API (на примере Groq) не вернуло контент."""
     mock_completion = MagicMock()
@@ -74,31 +74,31 @@ def test_create_quest_no_content(mock_groq):
     assert result["error"] == "LLM returned no content."
 
 
-@patch("app.services.quest_generator.Groq")
+@patch("app.services.llm_clients.Groq")
 def test_validate_key_groq_success(mock_groq):
     """Тестирует успешную валидацию ключа Groq."""
     mock_groq.return_value.models.list.return_value = MagicMock()
     assert validate_api_key("groq", "valid") == {"status": "ok"}
 
 
-@patch("app.services.quest_generator.openai.OpenAI")
+@patch("app.services.llm_clients.openai.OpenAI")
 def test_validate_key_openai_success(mock_openai):
     """Тестирует успешную валидацию ключа OpenAI."""
     mock_openai.return_value.models.list.return_value = MagicMock()
     assert validate_api_key("openai", "valid") == {"status": "ok"}
 
 
-@patch("app.services.quest_generator.genai")
+@patch("app.services.llm_clients.genai")
 def test_validate_key_gemini_success(mock_genai):
     """Тестирует успешную валидацию ключа Gemini."""
     mock_model = MagicMock()
     mock_model.supported_generation_methods = ["generateContent"]
     mock_genai.list_models.return_value = [mock_model]
     assert validate_api_key("gemini", "valid") == {"status": "ok"}
-    mock_genai.configure.assert_called_once_with(api_key="valid")
+    mock_genai.configure.assert_not_called()
 
 
-@patch("app.services.quest_generator.genai")
+@patch("app.services.llm_clients.genai")
 def test_validate_key_gemini_no_models(mock_genai):
     """Тестирует валидацию Gemini, когда не найдено подходящих моделей."""
     mock_genai.list_models.return_value = []
@@ -107,7 +107,7 @@ def test_validate_key_gemini_no_models(mock_genai):
     assert "Ошибка проверки ключа" in result["message"]
 
 
-@patch("app.services.quest_generator.Groq")
+@patch("app.services.llm_clients.Groq")
 def test_validate_key_api_error_401(mock_groq):
     """Тестирует обработку ошибки 401 (неверный ключ)."""
     mock_groq.return_value.models.list.side_effect = Exception("401 Invalid Key")
@@ -115,7 +115,7 @@ def test_validate_key_api_error_401(mock_groq):
     assert result == {"status": "error", "message": "Неверный API ключ."}
 
 
-@patch("app.services.quest_generator.Groq")
+@patch("app.services.llm_clients.Groq")
 def test_validate_key_generic_api_error(mock_groq):
     """Тестирует обработку общей ошибки API."""
     mock_groq.return_value.models.list.side_effect = Exception("Connection Timeout")
@@ -132,7 +132,7 @@ def test_validate_key_unknown_provider():
     assert result == {"error": "Unknown API provider: foobar"}
 
 
-@patch("app.services.quest_generator.Groq")
+@patch("app.services.llm_clients.Groq")
 def test_get_available_models_groq_success(mock_groq):
     """Тестирует успешное получение моделей от Groq."""
     mock_model = MagicMock()
@@ -142,7 +142,7 @@ def test_get_available_models_groq_success(mock_groq):
     assert result == {"free": ["llama3-8b-8192"], "paid": []}
 
 
-@patch("app.services.quest_generator.openai.OpenAI")
+@patch("app.services.llm_clients.openai.OpenAI")
 def test_get_available_models_openai_success(mock_openai):
     """Тестирует успешное получение моделей от OpenAI."""
     mock_model = MagicMock()
@@ -152,7 +152,7 @@ def test_get_available_models_openai_success(mock_openai):
     assert result == {"free": [], "paid": ["gpt-4"]}
 
 
-@patch("app.services.quest_generator.genai")
+@patch("app.services.llm_clients.genai")
 def test_get_available_models_gemini_success(mock_genai):
     """Тестирует успешное получение моделей от Gemini."""
     mock_model = MagicMock()
@@ -169,7 +169,7 @@ def test_get_available_models_unknown_provider():
     assert result == {"error": "Unknown API provider: foobar"}
 
 
-@patch("app.services.quest_generator.Groq")
+@patch("app.services.llm_clients.Groq")
 def test_get_available_models_api_error(mock_groq):
     """Тестирует обработку ошибки API при получении моделей."""
     mock_groq.return_value.models.list.side_effect = Exception("API Error")
@@ -177,7 +177,7 @@ def test_get_available_models_api_error(mock_groq):
     assert result == {"error": "API Error"}
 
 
-@patch("app.services.quest_generator.Groq")
+@patch("app.services.llm_clients.Groq")
 def test_create_quest_json_decode_error_raw_content(mock_groq):
     """Тестирует случай, когда LLM возвращает невалидный, но немаркдаун JSON."""
     mock_completion = MagicMock()
@@ -195,7 +195,7 @@ def test_create_quest_json_decode_error_raw_content(mock_groq):
         assert "Raw content (original): '{this is not json}'." in log_message
 
 
-@patch("app.services.quest_generator.genai")
+@patch("app.services.llm_clients.genai")
 def test_create_quest_json_decode_error_markdown_valid_json(mock_genai):
     """Тестирует, что очистка markdown работает и валидный JSON внутри парсится."""
     mock_response = MagicMock()
@@ -208,10 +208,10 @@ def test_create_quest_json_decode_error_markdown_valid_json(mock_genai):
         "любой сеттинг", "fake_key", "gemini", "gemini-pro"
     )
     assert result == {"questTitle": "Parsed from markdown"}
-    mock_genai.configure.assert_called_once_with(api_key="fake_key")
+    mock_genai.configure.assert_not_called()
 
 
-@patch("app.services.quest_generator.genai")
+@patch("app.services.llm_clients.genai")
 def test_create_quest_json_decode_error_markdown_invalid_json(mock_genai):
     """Тестирует, что очистка markdown работает, но внутренний JSON невалиден."""
     mock_response_invalid = MagicMock()
@@ -240,7 +240,7 @@ def test_create_quest_json_decode_error_markdown_invalid_json(mock_genai):
         )
 
 
-@patch("app.services.quest_generator.Groq")
+@patch("app.services.llm_clients.Groq")
 def test_create_quest_api_rate_limit_error(mock_groq):
     """Тестирует обработку ошибки превышения лимита запросов."""
     mock_groq.return_value.chat.completions.create.side_effect = Exception(
@@ -253,7 +253,7 @@ def test_create_quest_api_rate_limit_error(mock_groq):
     assert "Превышен лимит запросов к API. Попробуйте позже." in result["error"]
 
 
-@patch("app.services.quest_generator.Groq")
+@patch("app.services.llm_clients.Groq")
 def test_create_quest_api_invalid_key_error(mock_groq):
     """Тестирует обработку ошибки неверного API ключа."""
     mock_groq.return_value.chat.completions.create.side_effect = Exception(
@@ -266,7 +266,7 @@ def test_create_quest_api_invalid_key_error(mock_groq):
     assert "Неверный API ключ. Пожалуйста, проверьте ваш ключ." in result["error"]
 
 
-@patch("app.services.quest_generator.Groq")
+@patch("app.services.llm_clients.Groq")
 def test_create_quest_api_model_not_found_error(mock_groq):
     """Тестирует обработку ошибки "модель не найдена"."""
     mock_groq.return_value.chat.completions.create.side_effect = Exception(
@@ -282,7 +282,7 @@ def test_create_quest_api_model_not_found_error(mock_groq):
     )
 
 
-@patch("app.services.quest_generator.genai")
+@patch("app.services.llm_clients.genai")
 def test_create_quest_api_model_deprecated_error(mock_genai):
     """Тестирует обработку ошибки "модель устарела"."""
     mock_model_genai = MagicMock()
@@ -302,7 +302,7 @@ def test_create_quest_api_model_deprecated_error(mock_genai):
     )
 
 
-@patch("app.services.quest_generator.Groq")
+@patch("app.services.llm_clients.Groq")
 def test_create_quest_api_general_error(mock_groq):
     """Тестирует обработку общей, неопознанной ошибки API."""
     mock_groq.return_value.chat.completions.create.side_effect = Exception(
@@ -318,7 +318,7 @@ def test_create_quest_api_general_error(mock_groq):
     )
 
 
-@patch("app.services.quest_generator.openai.OpenAI")
+@patch("app.services.llm_clients.openai.OpenAI")
 def test_create_quest_api_quota_exceeded_error(mock_openai):
     """Тестирует обработку ошибки превышения квоты OpenAI."""
     mock_openai.return_value.chat.completions.create.side_effect = Exception(
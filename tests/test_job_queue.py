@@ -0,0 +1,153 @@
+import json
+import threading
+import time
+
+import pytest
+
+from app.main import app
+from app.services import job_queue
+from app.services.job_queue import JobManager, JobNotFoundError, QueueFullError
+
+
+def wait_for(manager, job_id, statuses=("done", "failed"), timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        info = manager.get(job_id)
+        if info["status"] in statuses:
+            return info
+        time.sleep(0.01)
+    raise AssertionError(f"Задание {job_id} не дошло до {statuses}: {manager.get(job_id)}")
+
+
+def fake_runner(gate=None, log=None):
+    """Имитация create_quest_from_setting: run, skeleton, черновик, готовая сцена, done."""
+    def runner(setting_text, api_key, api_provider, model, **kwargs):
+        if log is not None:
+            log.append((setting_text, api_key, api_provider))
+        yield json.dumps({"status": "run", "run_id": "a" * 32, "resumed": False})
+        yield json.dumps({"status": "skeleton", "quest": {"scenes": [{"scene_id": "scene_1"}, {"scene_id": "scene_2"}]}})
+        if gate is not None:
+            gate.wait(5)
+        yield json.dumps({"status": "scene_delta", "deltas": {"scene_1": "Те"}}, ensure_ascii=False)
+        yield json.dumps({"status": "scene_ready", "scene_id": "scene_1", "message": "4/6: сцена готова"}, ensure_ascii=False)
+        yield json.dumps({"status": "done", "quest": {"setting": setting_text}}, ensure_ascii=False)
+    return runner
+
+
+def params(provider="groq", setting="Киберпанк"):
+    return {"setting_text": setting, "api_provider": provider, "model": "m", "scene_count": 2,
+            "tone": "", "pacing": "", "narrative_elements": [], "use_cache": True}
+
+
+def test_job_runs_and_replays_persisted_events(tmp_path):
+    """Задание выполняется в фоне; повторное подключение отдает сохраненные события с seq, без черновиков."""
+    log = []
+    manager = JobManager(tmp_path / "jobs.sqlite3", workers=1, runner=fake_runner(log=log))
+    try:
+        job_id = manager.submit(params(), "secret-key")
+        info = wait_for(manager, job_id)
+        assert info["status"] == "done" and info["run_id"] == "a" * 32
+        assert info["progress"] == {"scenes_total": 2, "scenes_ready": 1, "stage": "scene_ready", "message": "4/6: сцена готова"}
+        assert log == [("Киберпанк", "secret-key", "groq")]
+
+        events = [json.loads(line) for line in manager.events(job_id)]
+        assert [e["seq"] for e in events] == [1, 2, 3, 4]
+        assert [e["status"] for e in events] == ["run", "skeleton", "scene_ready", "done"]
+        assert [json.loads(line)["status"] for line in manager.events(job_id, after=3)] == ["done"]
+        # Ключ API не попадает в базу
+        assert b"secret-key" not in (tmp_path / "jobs.sqlite3").read_bytes()
+    finally:
+        manager.shutdown(timeout=5)
+
+
+def test_live_listener_gets_drafts_and_finishes(tmp_path):
+    gate = threading.Event()
+    manager = JobManager(tmp_path / "jobs.sqlite3", workers=1, runner=fake_runner(gate=gate))
+    try:
+        job_id = manager.submit(params(), "k")
+        wait_for(manager, job_id, statuses=("running",))
+        received = []
+        reader = threading.Thread(target=lambda: received.extend(json.loads(line) for line in manager.events(job_id, timeout=5)))
+        reader.start()
+        time.sleep(0.05)
+        gate.set()
+        reader.join(5)
+        assert [e["status"] for e in received] == ["run", "skeleton", "scene_delta", "scene_ready", "done"]
+        assert "seq" not in received[2]
+    finally:
+        manager.shutdown(timeout=5)
+
+
+def test_provider_concurrency_cap(tmp_path, monkeypatch):
+    """JOB_CONCURRENCY_<PROVIDER> ограничивает одновременные генерации провайдера, другие провайдеры не ждут."""
+    monkeypatch.setenv("JOB_CONCURRENCY_GROQ", "1")
+    gate = threading.Event()
+    manager = JobManager(tmp_path / "jobs.sqlite3", workers=3, runner=fake_runner(gate=gate))
+    try:
+        first = manager.submit(params("groq"), "k")
+        second = manager.submit(params("groq"), "k")
+        other = manager.submit(params("openai"), "k")
+        wait_for(manager, first, statuses=("running",))
+        wait_for(manager, other, statuses=("running",))
+        time.sleep(0.05)
+        assert manager.get(second)["status"] == "queued"
+        assert manager.get(second)["queue_position"] == 0
+        gate.set()
+        for job_id in (first, second, other):
+            assert wait_for(manager, job_id)["status"] == "done"
+    finally:
+        gate.set()
+        manager.shutdown(timeout=5)
+
+
+def test_queue_limit_and_restart_marks_jobs_interrupted(tmp_path):
+    gate = threading.Event()
+    db_path = tmp_path / "jobs.sqlite3"
+    manager = JobManager(db_path, workers=1, max_queued=1, runner=fake_runner(gate=gate))
+    running = manager.submit(params(), "k")
+    wait_for(manager, running, statuses=("running",))
+    queued = manager.submit(params(), "k")
+    with pytest.raises(QueueFullError):
+        manager.submit(params(), "k")
+    manager._stopping = True  # имитация падения процесса: воркер не возьмет новое задание
+    restarted = JobManager(db_path, workers=1, runner=fake_runner())
+    try:
+        for job_id in (running, queued):
+            info = restarted.get(job_id)
+            assert info["status"] == "interrupted" and info["error"]
+        with pytest.raises(JobNotFoundError):
+            restarted.get("missing")
+    finally:
+        gate.set()
+        manager.shutdown(timeout=5)
+        restarted.shutdown(timeout=5)
+
+
+def test_jobs_endpoints(tmp_path, monkeypatch):
+    monkeypatch.setattr(job_queue, "_manager", JobManager(tmp_path / "jobs.sqlite3", workers=1, runner=fake_runner()))
+    client = app.test_client()
+
+    assert client.post("/jobs", json={"setting": "x"}).status_code == 400
+    response = client.post("/jobs", json={"setting": "Город", "api_key": "k", "api_provider": "groq", "model": "m"})
+    assert response.status_code == 202
+    job_id = response.get_json()["job_id"]
+
+    lines = [json.loads(line) for line in client.get(f"/jobs/{job_id}/events").data.decode("utf-8").splitlines()]
+    assert lines[-1]["status"] == "done" and lines[-1]["quest"] == {"setting": "Город"}
+    assert client.get(f"/jobs/{job_id}").get_json()["status"] == "done"
+    assert client.get("/jobs/" + "0" * 32).status_code == 404
+    assert client.get("/jobs/" + "0" * 32 + "/events").status_code == 404
+
+
+def test_cancelled_generation_marks_job_cancelled(tmp_path):
+    def runner(**kwargs):
+        yield json.dumps({"status": "run", "run_id": "b" * 32, "resumed": False})
+        yield json.dumps({"status": "cancelled", "message": "Генерация отменена.", "run_id": "b" * 32}, ensure_ascii=False)
+
+    manager = JobManager(tmp_path / "jobs.sqlite3", workers=1, runner=runner)
+    try:
+        job_id = manager.submit(params(), "k")
+        info = wait_for(manager, job_id, statuses=("done", "failed", "cancelled"))
+        assert info["status"] == "cancelled" and info["run_id"] == "b" * 32
+    finally:
+        manager.shutdown(timeout=5)
@@ -0,0 +1,128 @@
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+from app.services.llm_cache import LLMResponseCache, get_llm_cache, reset_llm_cache
+from app.services.async_bridge import run_sync
+from app.services.quest_generator import _acall_llm, _call_llm
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = LLMResponseCache(tmp_path / "cache.sqlite3", max_bytes=1024, ttl_seconds=60)
+    yield cache
+    cache.close()
+
+
+@pytest.fixture
+def enabled_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("LLM_CACHE_ENABLED", "true")
+    monkeypatch.setenv("PLOTIX_DATA_DIR", str(tmp_path))
+    reset_llm_cache()
+    yield get_llm_cache()
+    reset_llm_cache()
+
+
+def test_cache_hit_and_miss(cache):
+    key = cache.make_key("groq", "model", "промпт", "json_object", 0.7)
+    assert cache.get(key) is None
+    cache.set(key, '{"ok": true}')
+    assert cache.get(key) == '{"ok": true}'
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+
+def test_cache_key_depends_on_all_parameters(cache):
+    base = ("groq", "model", "промпт", "json_object", 0.7, 800)
+    keys = {cache.make_key(*base)}
+    for index, value in enumerate(["openai", "other", "другой промпт", "text", 0.2, 2000]):
+        changed = list(base)
+        changed[index] = value
+        keys.add(cache.make_key(*changed))
+    assert len(keys) == 7
+
+
+def test_cache_entries_expire_after_ttl(cache):
+    key = cache.make_key("groq", "model", "промпт", "text", 0.7)
+    with patch("app.services.llm_cache.time.time", return_value=1000.0):
+        cache.set(key, "ответ")
+    with patch("app.services.llm_cache.time.time", return_value=1061.0):
+        assert cache.get(key) is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_cache_evicts_least_recently_used_over_budget(cache):
+    """При превышении max_bytes удаляются записи, которые дольше всего не читались."""
+    with patch("app.services.llm_cache.time.time") as clock:
+        for moment, key in enumerate(["a", "b", "c"]):
+            clock.return_value = 1000.0 + moment
+            cache.set(key, "x" * 300)
+        clock.return_value = 1010.0
+        assert cache.get("a") is not None  # "a" снова свежая, первой уйдет "b"
+        clock.return_value = 1011.0
+        cache.set("d", "x" * 300)
+        assert cache.stats()["size_bytes"] <= 1024
+        assert cache.get("b") is None
+        assert cache.get("a") is not None and cache.get("d") is not None
+
+
+def test_cache_disabled_by_default(monkeypatch):
+    monkeypatch.delenv("LLM_CACHE_ENABLED", raising=False)
+    reset_llm_cache()
+    assert get_llm_cache() is None
+
+
+def _mock_groq_response(mock_groq, content):
+    response = MagicMock()
+    response.parse = AsyncMock()
+    response.headers = {}
+    response.parse.return_value.choices[0].message.content = content
+    response.parse.return_value.usage.total_tokens = 10
+    create = AsyncMock(return_value=response)
+    mock_groq.return_value.chat.completions.with_raw_response.create = create
+    return create
+
+
+@patch("app.services.llm_clients.AsyncGroq")
+def test_call_llm_served_from_cache(mock_groq, enabled_cache):
+    """Повторный одинаковый запрос не доходит до провайдера."""
+    create = _mock_groq_response(mock_groq, '{"ok": true}')
+    assert _call_llm("промпт", "groq", "key", "model") == '{"ok": true}'
+    assert _call_llm("промпт", "groq", "key", "model") == '{"ok": true}'
+    assert create.call_count == 1
+    assert enabled_cache.stats()["hits"] == 1
+
+
+@patch("app.services.llm_clients.AsyncGroq")
+def test_call_llm_bypass_refreshes_cache(mock_groq, enabled_cache):
+    """use_cache=False идет к провайдеру, но сохраняет свежий ответ."""
+    create = _mock_groq_response(mock_groq, '{"v": 1}')
+    _call_llm("промпт", "groq", "key", "model")
+    create.return_value.parse.return_value.choices[0].message.content = '{"v": 2}'
+    assert _call_llm("промпт", "groq", "key", "model", use_cache=False) == '{"v": 2}'
+    assert _call_llm("промпт", "groq", "key", "model") == '{"v": 2}'
+    assert create.call_count == 2
+
+
+@patch("app.services.llm_clients.AsyncGroq")
+def test_call_llm_does_not_cache_invalid_json(mock_groq, enabled_cache):
+    create = _mock_groq_response(mock_groq, "не JSON")
+    _call_llm("промпт", "groq", "key", "model")
+    _call_llm("промпт", "groq", "key", "model")
+    assert create.call_count == 2
+    assert enabled_cache.stats()["entries"] == 0
+
+
+@patch("app.services.llm_clients.AsyncGroq")
+def test_call_llm_cache_keyed_by_output_budget(mock_groq, enabled_cache):
+    """Ответ, обрезанный пределом max_tokens, не кэшируется и не подменяет ответ с другим пределом."""
+    create = _mock_groq_response(mock_groq, "обрезанный ответ")
+    create.return_value.parse.return_value.choices[0].finish_reason = "length"
+    run_sync(_acall_llm("промпт", "groq", "key", "model", force_text_response=True, max_tokens=10))
+    assert enabled_cache.stats()["entries"] == 0
+
+    create.return_value.parse.return_value.choices[0].message.content = "полный ответ"
+    create.return_value.parse.return_value.choices[0].finish_reason = "stop"
+    assert run_sync(_acall_llm("промпт", "groq", "key", "model", force_text_response=True, max_tokens=10)) == "полный ответ"
+    assert run_sync(_acall_llm("промпт", "groq", "key", "model", force_text_response=True, max_tokens=10)) == "полный ответ"
+    run_sync(_acall_llm("промпт", "groq", "key", "model", force_text_response=True, max_tokens=2000))
+    assert create.call_count == 3
@@ -0,0 +1,92 @@
+import asyncio
+from unittest.mock import patch
+
+import pytest
+import requests
+
+from app.services.llm_clients import ClientPool, GeminiSession
+
+
+@patch("app.services.llm_clients.Groq")
+def test_client_pool_reuses_client_per_key(mock_groq):
+    """Один и тот же ключ получает один и тот же клиент."""
+    pool = ClientPool()
+    first = pool.get("groq", "key-1")
+    second = pool.get("groq", "key-1")
+    assert first is second
+    mock_groq.assert_called_once_with(api_key="key-1")
+    assert (pool.hits, pool.misses) == (1, 1)
+
+
+@patch("app.services.llm_clients.openai.OpenAI")
+def test_client_pool_separates_keys_and_base_urls(mock_openai):
+    """Разные ключи и base_url — разные клиенты."""
+    pool = ClientPool()
+    pool.get("openai", "key-1")
+    pool.get("openai", "key-2")
+    pool.get("openai", "key-1", base_url="http://localhost:8000/v1")
+    assert mock_openai.call_count == 3
+
+
+@patch("app.services.llm_clients.Groq")
+def test_client_pool_evicts_lru(mock_groq):
+    """Кэш ограничен по размеру и вытесняет давно не использованные клиенты."""
+    pool = ClientPool(max_size=2)
+    pool.get("groq", "a")
+    pool.get("groq", "b")
+    pool.get("groq", "a")
+    pool.get("groq", "c")  # вытесняет "b"
+    pool.get("groq", "b")
+    assert mock_groq.call_count == 4
+
+
+def test_client_pool_vps_proxy_uses_shared_session():
+    """Для vps_proxy используется общая requests.Session с пулом соединений."""
+    pool = ClientPool()
+    session = pool.get("vps_proxy")
+    assert isinstance(session, requests.Session)
+    assert pool.get("vps_proxy") is session
+
+
+def test_client_pool_unknown_provider():
+    with pytest.raises(ValueError, match="Unknown API provider: foobar"):
+        ClientPool().get("foobar", "key")
+
+
+@patch("app.services.llm_clients.genai_client")
+@patch("app.services.llm_clients.genai")
+def test_gemini_session_isolated_from_global_configure(mock_genai, mock_genai_client):
+    """Сессия Gemini настраивает собственный менеджер клиентов, не трогая genai.configure."""
+    manager = mock_genai_client._ClientManager.return_value
+    session = GeminiSession("gemini-key")
+    model = session.generative_model("gemini-pro")
+
+    assert session.generative_model("gemini-pro") is model
+    manager.configure.assert_called_once_with(api_key="gemini-key")
+    mock_genai.configure.assert_not_called()
+    assert model._client is manager.get_default_client.return_value
+
+
+def test_gemini_sdk_supports_isolated_clients():
+    """Установленный google-generativeai все еще дает отдельный клиент каждому ключу (иначе SDK изменился)."""
+    session = GeminiSession("gemini-key")
+    assert session._manager is not None
+    assert session.generative_model("gemini-pro")._client is not None
+
+    async def async_client():  # асинхронный gRPC-клиент создается внутри цикла событий
+        return session.async_generative_model("gemini-pro")._async_client
+
+    assert asyncio.run(async_client()) is not None
+
+
+@patch("app.services.llm_clients.genai_client", new=object())
+@patch("app.services.llm_clients.genai")
+def test_gemini_session_falls_back_to_configure(mock_genai):
+    """Без внутренностей SDK сессия работает через genai.configure и обычную GenerativeModel."""
+    session = GeminiSession("gemini-key")
+    model = session.generative_model("gemini-pro")
+
+    assert model is mock_genai.GenerativeModel.return_value
+    mock_genai.configure.assert_called_once_with(api_key="gemini-key")
+    session.list_models()
+    mock_genai.list_models.assert_called_once_with()
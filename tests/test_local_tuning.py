@@ -0,0 +1,215 @@
+import json
+import os
+import struct
+
+import pytest
+
+from app.services import local_tuning
+from app.services.local_tuning import (
+    GGUFError,
+    HardwareInfo,
+    ModelInfo,
+    calibrate_model,
+    clear_tuning_cache,
+    get_local_params,
+    read_gguf_metadata,
+    read_model_info,
+    tune_parameters,
+)
+
+HARDWARE = HardwareInfo(logical_cpus=16, physical_cores=8, total_ram=64 * 2**30, available_ram=32 * 2**30, gpu_offload=False)
+
+
+def _gguf_string(text):
+    data = text.encode("utf-8")
+    return struct.pack("<Q", len(data)) + data
+
+
+def _write_gguf(path, context_length=2048):
+    """Минимальный GGUF v3: метаданные архитектуры и массив токенов словаря."""
+    items = [
+        (_gguf_string("general.architecture"), struct.pack("<I", 8) + _gguf_string("llama")),
+        (_gguf_string("tokenizer.ggml.tokens"), struct.pack("<IIQ", 9, 8, 3) + b"".join(_gguf_string(t) for t in ("a", "бв", "г"))),
+        (_gguf_string("tokenizer.ggml.scores"), struct.pack("<IIQ", 9, 6, 3) + struct.pack("<3f", 0.1, 0.2, 0.3)),
+        (_gguf_string("llama.context_length"), struct.pack("<II", 4, context_length)),
+        (_gguf_string("llama.block_count"), struct.pack("<II", 4, 32)),
+        (_gguf_string("llama.embedding_length"), struct.pack("<II", 4, 4096)),
+        (_gguf_string("llama.attention.head_count"), struct.pack("<II", 4, 32)),
+        (_gguf_string("llama.attention.head_count_kv"), struct.pack("<II", 4, 8)),
+    ]
+    header = b"GGUF" + struct.pack("<IQQ", 3, 0, len(items))
+    path.write_bytes(header + b"".join(key + value for key, value in items) + b"\0" * 64)
+    return str(path)
+
+
+def test_read_gguf_metadata_skips_arrays(tmp_path):
+    """Из заголовка читаются скалярные метаданные, массивы словаря пропускаются."""
+    metadata = read_gguf_metadata(_write_gguf(tmp_path / "m.gguf"))
+    assert metadata["general.architecture"] == "llama"
+    assert metadata["llama.context_length"] == 2048 and metadata["llama.attention.head_count_kv"] == 8
+    assert "tokenizer.ggml.tokens" not in metadata
+
+    (tmp_path / "bad.gguf").write_bytes(b"gguf")
+    with pytest.raises(GGUFError):
+        read_gguf_metadata(str(tmp_path / "bad.gguf"))
+    assert read_model_info(str(tmp_path / "bad.gguf")) == ModelInfo(4)
+
+
+def test_tune_parameters_for_cpu_and_tight_memory(tmp_path):
+    """Потоки генерации — по физическим ядрам, prefill — по всем CPU; контекст ужимается под память."""
+    info = read_model_info(_write_gguf(tmp_path / "m.gguf", context_length=32768))
+    params = tune_parameters(info, HARDWARE)
+    assert params["n_ctx"] == 4096 and params["n_batch"] == 512
+    assert (params["n_threads"], params["n_threads_batch"], params["n_gpu_layers"]) == (8, 16, 0)
+
+    tight = HARDWARE._replace(available_ram=info.file_size + 300 * 2**20)  # KV-кэш на 4096 токенов — 512 МБ
+    assert tune_parameters(info, tight)["n_ctx"] == 2048
+    assert tune_parameters(info, HARDWARE._replace(gpu_offload=True))["n_gpu_layers"] == -1
+
+
+def test_local_params_are_stored_and_overridable(tmp_path, monkeypatch):
+    """Подобранные параметры сохраняются по модели и переиспользуются; файл и окружение их переопределяют."""
+    clear_tuning_cache()
+    monkeypatch.setattr(local_tuning, "detect_hardware", lambda: HARDWARE)
+    model_path = _write_gguf(tmp_path / "m.gguf")
+    calls = []
+    original = local_tuning.tune_parameters
+    monkeypatch.setattr(local_tuning, "tune_parameters", lambda *args: calls.append(args) or original(*args))
+
+    assert get_local_params(model_path)["n_ctx"] == 2048
+    clear_tuning_cache()
+    assert get_local_params(model_path)["n_threads"] == 8
+    assert len(calls) == 1  # вторая загрузка берет параметры из файла
+
+    store_path = local_tuning.get_local_tuning_store().path
+    data = json.loads(store_path.read_text(encoding="utf-8"))
+    data["m.gguf"]["overrides"] = {"n_threads": 6, "n_batch": 256}
+    store_path.write_text(json.dumps(data), encoding="utf-8")
+    clear_tuning_cache()
+    monkeypatch.setenv("LOCAL_N_THREADS", "4")
+    monkeypatch.setenv("LOCAL_USE_MLOCK", "false")
+    params = get_local_params(model_path)
+    assert (params["n_threads"], params["n_batch"], params["use_mlock"]) == (4, 256, False)
+
+    # Другой файл модели — параметры подбираются заново, ручные переопределения остаются
+    _write_gguf(tmp_path / "m.gguf", context_length=8192)
+    os.utime(model_path, ns=(1, 1))
+    clear_tuning_cache()
+    assert get_local_params(model_path)["n_ctx"] == 4096 and len(calls) == 2
+    assert json.loads(store_path.read_text(encoding="utf-8"))["m.gguf"]["overrides"] == {"n_threads": 6, "n_batch": 256}
+    clear_tuning_cache()
+
+
+class CalibrationLlama:
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+
+    def tokenize(self, data):
+        return list(range(200))
+
+    def reset(self):
+        pass
+
+    def create_completion(self, prompt, max_tokens, temperature):
+        return {"usage": {"completion_tokens": max_tokens}}
+
+
+def test_calibration_is_saved_with_model_entry(tmp_path, monkeypatch):
+    """Калибровка загружает модель с подобранными параметрами и сохраняет скорость в запись модели."""
+    clear_tuning_cache()
+    monkeypatch.setattr(local_tuning, "detect_hardware", lambda: HARDWARE)
+    model_path = _write_gguf(tmp_path / "m.gguf")
+    calibration = calibrate_model(model_path, CalibrationLlama)
+    assert calibration["prompt_tokens_per_sec"] > 0 and calibration["generation_tokens_per_sec"] > 0
+    assert calibration["params"]["n_threads"] == 8
+    entry = local_tuning.get_local_tuning_store().get("m.gguf")
+    assert entry["calibration"] == calibration
+
+    # Замер с памятью под кэш промптов, как у приложения, не теряется при следующей загрузке
+    calibration = calibrate_model(model_path, CalibrationLlama, extra_bytes=2**30)
+    clear_tuning_cache()
+    get_local_params(model_path, extra_bytes=2**30)
+    assert local_tuning.get_local_tuning_store().get("m.gguf")["calibration"] == calibration
+    clear_tuning_cache()
+
+
+def test_local_model_loads_with_tuned_params_and_budget(tmp_path, monkeypatch):
+    """Локальная модель загружается с подобранными параметрами, а бюджеты этапов — по ее контексту."""
+    from app.services import quest_generator
+    from app.services.model_registry import local_model_registry
+
+    clear_tuning_cache()
+    monkeypatch.setattr(local_tuning, "detect_hardware", lambda: HARDWARE)
+    monkeypatch.setenv("LOCAL_MODEL_PATH", str(tmp_path))
+    _write_gguf(tmp_path / "m.gguf")
+    loaded = []
+
+    class RecordingLlama(CalibrationLlama):
+        def __init__(self, **kwargs):
+            loaded.append(kwargs)
+
+        def create_chat_completion(self, **kwargs):
+            return {"choices": [{"message": {"content": "ответ"}}]}
+
+    monkeypatch.setattr(quest_generator, "Llama", RecordingLlama)
+    try:
+        quest_generator._local_chat_completion("промпт", "m.gguf", {"type": "text"})
+    finally:
+        local_model_registry.clear()
+        clear_tuning_cache()
+    assert loaded[0]["n_ctx"] == 2048 and loaded[0]["n_threads"] == 8 and loaded[0]["n_gpu_layers"] == 0
+    budget = quest_generator._get_target_budget("director", quest_generator.LLMTarget("local", "", "m.gguf"))
+    assert budget.input_tokens + budget.output_tokens <= 2048
+
+
+def test_context_accounts_for_prompt_cache_everywhere(tmp_path, monkeypatch):
+    """Память под кэш промптов учитывается при подборе контекста — одинаково для бюджетов, корректора и загрузки."""
+    from app.services import quest_generator
+
+    clear_tuning_cache()
+    monkeypatch.setattr(local_tuning, "detect_hardware", lambda: HARDWARE)
+    monkeypatch.setenv("LOCAL_MODEL_PATH", str(tmp_path))
+    monkeypatch.delenv("LOCAL_WORKERS", raising=False)
+    monkeypatch.setattr(quest_generator, "LlamaRAMCache", lambda capacity_bytes: None)
+    _write_gguf(tmp_path / "m.gguf", context_length=8192)
+    target = quest_generator.LLMTarget("local", "", "m.gguf")
+    try:
+        monkeypatch.setenv("LOCAL_PROMPT_CACHE_MB", "0")
+        assert quest_generator._get_target_budget("director", target).output_tokens == 2048  # n_ctx 4096
+        wide_chunk = quest_generator._get_correction_chunk_tokens([target])
+
+        # Кэш промптов занимает почти всю свободную память: контекст уменьшается и в бюджетах, и в кусках корректора
+        monkeypatch.setenv("LOCAL_PROMPT_CACHE_MB", str(32 * 1024 - 300))
+        budget = quest_generator._get_target_budget("director", target)
+        assert budget.input_tokens + budget.output_tokens <= 2048
+        chunk = quest_generator._get_correction_chunk_tokens([target])
+        overhead = quest_generator._estimate_tokens(quest_generator._get_correction_prompt(""))
+        assert chunk < wide_chunk and overhead + 2 * chunk <= 2048
+        entry = local_tuning.get_local_tuning_store().get("m.gguf")
+        assert entry["extra_bytes"] == (32 * 1024 - 300) * 2**20 and entry["params"]["n_ctx"] == 2048
+    finally:
+        clear_tuning_cache()
+
+
+def test_worker_processes_share_memory_budget(tmp_path, monkeypatch):
+    """KV-кэш и кэш промптов у каждого процесса-исполнителя свои: контекст подбирается под их сумму."""
+    clear_tuning_cache()
+    monkeypatch.setattr(local_tuning, "detect_hardware", lambda: HARDWARE)
+    model_path = _write_gguf(tmp_path / "m.gguf", context_length=8192)
+    extra_bytes = 7 * 2**30 + 600 * 2**20  # кэш промптов: в 32 ГБ помещается четырежды лишь с меньшим KV-кэшем
+    try:
+        assert get_local_params(model_path, extra_bytes)["n_ctx"] == 4096
+        params = get_local_params(model_path, extra_bytes, processes=4)
+        assert params["n_ctx"] == 2048 and params["n_threads"] == 2
+        assert local_tuning.get_local_tuning_store().get("m.gguf")["processes"] == 4
+    finally:
+        clear_tuning_cache()
+
+
+def test_model_weights_are_counted_once_for_all_processes(tmp_path):
+    """Веса общие через mmap: модель, помещающаяся в память один раз, но не N раз, не ужимает контекст."""
+    info = read_model_info(_write_gguf(tmp_path / "m.gguf", context_length=4096))._replace(file_size=20 * 2**30)
+    single = tune_parameters(info, HARDWARE)
+    assert single["n_ctx"] == 4096
+    assert tune_parameters(info, HARDWARE, processes=2)["n_ctx"] == single["n_ctx"]
+    assert tune_parameters(info, HARDWARE, processes=4)["n_ctx"] == single["n_ctx"]
@@ -0,0 +1,152 @@
+import os
+import threading
+import time
+
+import pytest
+
+from app.services import local_workers
+from app.services.cancellation import CancelToken, GenerationCancelled
+from app.services.local_workers import LocalWorkerError, LocalWorkerPool
+from app.services.model_registry import LocalModelRegistry
+
+# Загрузчик для процессов-исполнителей: модуль теста импортируется в них заново после spawn
+FAKE_LOADER = f"{__name__}:FakeWorkerLlama"
+
+
+class FakeWorkerLlama:
+    """Модель в процессе-исполнителе: отвечает своим pid, по команде падает или генерирует бесконечно."""
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+
+    def create_chat_completion(self, messages, stream=False, **options):
+        prompt = messages[0]["content"]
+        if prompt == "упади":
+            os._exit(1)
+        if prompt == "бесконечно":
+            return self._endless()
+        if prompt.startswith("подожди"):
+            time.sleep(float(prompt.split()[1]))
+        content = f"{os.getpid()}:{self.kwargs['n_threads']}:{prompt}"
+        if not stream:
+            return {"choices": [{"message": {"content": content}}]}
+        return ({"choices": [{"delta": {"content": ch}}]} for ch in content)
+
+    def _endless(self):
+        while True:
+            time.sleep(0.01)
+            yield {"choices": [{"delta": {"content": "т"}}]}
+
+
+def _chat(pool, prompt, **kwargs):
+    response = pool.chat_completion("model.gguf", {"n_threads": 2}, [{"role": "user", "content": prompt}], {}, **kwargs)
+    return response["choices"][0]["message"]["content"]
+
+
+@pytest.fixture
+def pool():
+    pool = LocalWorkerPool(2, loader=FAKE_LOADER, health_interval=0, ping_timeout=10.0)
+    yield pool
+    pool.shutdown()
+
+
+def test_pool_runs_requests_in_separate_processes(pool):
+    """Запросы выполняются в процессах-исполнителях параллельно; куски ответа приходят в on_delta."""
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(_chat(pool, "подожди 0.5"))) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    pids = {int(result.split(":")[0]) for result in results}
+    assert len(pids) == 2 and os.getpid() not in pids
+
+    deltas = []
+    assert _chat(pool, "привет", on_delta=deltas.append).endswith(":2:привет")
+    assert "".join(deltas).endswith(":2:привет")
+    stats = pool.stats()
+    assert stats["queue_depth"] == 0 and sum(worker["requests"] for worker in stats["workers"]) == 3
+
+
+def test_crashed_worker_is_restarted(pool):
+    """Аварийное завершение процесса — ошибка запроса, а не приложения; процесс перезапускается."""
+    with pytest.raises(LocalWorkerError):
+        _chat(pool, "упади")
+    assert _chat(pool, "снова").endswith(":снова")
+    assert sum(worker["restarts"] for worker in pool.stats()["workers"]) == 1
+
+
+def test_cancel_stops_generation_and_keeps_worker(pool):
+    """Отмена прерывает генерацию в процессе между токенами, процесс остается рабочим."""
+    token = CancelToken()
+    threading.Timer(0.5, token.cancel).start()
+    with pytest.raises(GenerationCancelled):
+        _chat(pool, "бесконечно", cancel_token=token)
+    assert _chat(pool, "дальше").endswith(":дальше")
+    assert sum(worker["restarts"] for worker in pool.stats()["workers"]) == 0
+
+
+def test_health_check_restarts_dead_worker_and_reports_queue():
+    """Проверка здоровья перезапускает убитый процесс; ждущие свободный процесс запросы видны в очереди."""
+    pool = LocalWorkerPool(1, loader=FAKE_LOADER, health_interval=0, ping_timeout=10.0)
+    try:
+        _chat(pool, "старт")
+        assert pool.check_health() == 0
+        pool._workers[0].process.kill()
+        pool._workers[0].process.join()
+        assert pool.check_health() == 1
+        assert pool.stats()["workers"][0]["alive"]
+
+        threads = [threading.Thread(target=_chat, args=(pool, "подожди 1")) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        deadline = time.monotonic() + 5
+        while pool.stats()["queue_depth"] != 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert pool.stats()["queue_depth"] == 1
+        for thread in threads:
+            thread.join()
+        assert pool.stats()["queue_depth"] == 0
+    finally:
+        pool.shutdown()
+
+
+def test_local_provider_uses_worker_pool(tmp_path, monkeypatch):
+    """С LOCAL_WORKERS вызов локальной модели идет через пул, а потоки делятся между процессами."""
+    from app.services import quest_generator
+
+    (tmp_path / "model.gguf").write_bytes(b"gguf")
+    monkeypatch.setenv("LOCAL_MODEL_PATH", str(tmp_path))
+    monkeypatch.setenv("LOCAL_WORKERS", "2")
+    monkeypatch.setattr(quest_generator, "Llama", object)
+    pool = LocalWorkerPool(2, loader=FAKE_LOADER, health_interval=0)
+    monkeypatch.setattr(local_workers, "_pool", pool)
+    try:
+        response = quest_generator._local_chat_completion("вопрос", "model.gguf", {"type": "text"})
+        pid, n_threads, prompt = response["choices"][0]["message"]["content"].split(":")
+        assert int(pid) != os.getpid() and prompt == "вопрос"
+        assert int(n_threads) == max(1, quest_generator.get_local_params(str(tmp_path / "model.gguf"))["n_threads"] // 2)
+        assert quest_generator._get_provider_concurrency("local") == 2
+    finally:
+        pool.shutdown()
+
+
+def test_pool_splits_ram_budget_between_workers(tmp_path, monkeypatch):
+    """Каждый процесс получает свою долю общего бюджета RAM; общие веса он учитывает в ней по 1/N."""
+    monkeypatch.setenv("LOCAL_MODEL_RAM_BUDGET_MB", "400")
+    pool = LocalWorkerPool(4, health_interval=0)
+    assert pool.worker_ram_budget_bytes == 100 * 1024 * 1024
+    assert pool.stats()["worker_ram_budget_bytes"] == 100 * 1024 * 1024
+    assert LocalWorkerPool(2, health_interval=0, ram_budget_bytes=1000).worker_ram_budget_bytes == 500
+
+    # Модель на 300 МБ одна на весь пул: в долю каждого из четырех процессов идет 75 МБ
+    registry = LocalModelRegistry(ram_budget_bytes=pool.worker_ram_budget_bytes, shared_by=pool.size)
+    model_path = tmp_path / "m.gguf"
+    model_path.write_bytes(b"")
+    with open(model_path, "r+b") as f:
+        f.truncate(300 * 1024 * 1024)
+    with registry.lease(str(model_path), lambda **kwargs: object(), extra_bytes=1024 * 1024):
+        assert registry.stats()["resident_bytes"] == 76 * 1024 * 1024 <= pool.worker_ram_budget_bytes
+    with registry.lease(str(model_path), lambda **kwargs: object(), use_mmap=False):
+        assert registry.stats()["resident_bytes"] == 300 * 1024 * 1024  # без mmap копия весов своя
+    registry.shutdown()
@@ -0,0 +1,31 @@
+from app.services.lore_index import LoreIndex
+
+LORE = [
+    "Гильдия алхимиков владеет северной крепостью и торгует зельями.",
+    "Речной народ живет на плотах и поклоняется великому сому.",
+    "В горах спит древний дракон, охраняющий золото королей.",
+    "Королевская стража патрулирует дороги между городами.",
+]
+
+
+def test_search_ranks_relevant_chunk_first_across_word_forms():
+    """Поиск находит фрагмент по другим формам слов и ставит самый релевантный первым."""
+    index = LoreIndex(LORE)
+    assert index.search("Герой штурмует крепость алхимиков", top_k=2)[0] == 0
+    assert index.search("Дракона разбудили в горах", top_k=1) == [2]
+
+
+def test_retrieve_skips_unrelated_and_keeps_document_order():
+    """Фрагменты без общих слов с запросом не возвращаются, найденные идут в порядке сеттинга."""
+    index = LoreIndex(LORE)
+    assert index.retrieve("Неизвестное слово", top_k=3) == []
+    assert index.retrieve("Стража королей и дракон", top_k=4) == [LORE[2], LORE[3]]
+
+
+def test_from_text_splits_long_setting_into_chunks():
+    """Длинный сеттинг делится на фрагменты по абзацам; пустой индекс ничего не находит."""
+    text = "\n".join(f"Абзац про город номер {i}. " + "обычное описание " * 30 for i in range(20))
+    index = LoreIndex.from_text(text, chunk_tokens=200)
+    assert len(index.chunks) > 5
+    assert index.retrieve("город", top_k=3)
+    assert LoreIndex([]).retrieve("город") == []
@@ -0,0 +1,176 @@
+import threading
+import time
+from unittest.mock import MagicMock
+
+from app.services import quest_generator
+from app.services.model_registry import LocalModelRegistry, local_model_registry
+
+
+def _make_model_file(tmp_path, name, size):
+    path = tmp_path / name
+    path.write_bytes(b"\0" * size)
+    return str(path)
+
+
+def test_registry_reuses_loaded_model(tmp_path):
+    """Повторный вызов с теми же параметрами не загружает модель заново."""
+    model_path = _make_model_file(tmp_path, "a.gguf", 10)
+    loader = MagicMock()
+    registry = LocalModelRegistry(ram_budget_bytes=None, idle_timeout=0)
+
+    with registry.lease(model_path, loader=loader) as first:
+        pass
+    with registry.lease(model_path, loader=loader) as second:
+        pass
+
+    assert first is second
+    loader.assert_called_once()
+
+
+def test_registry_key_includes_ctx_and_chat_format(tmp_path):
+    """Разные n_ctx или chat_format — разные экземпляры."""
+    model_path = _make_model_file(tmp_path, "a.gguf", 10)
+    loader = MagicMock(side_effect=lambda **kwargs: MagicMock())
+    registry = LocalModelRegistry(ram_budget_bytes=None, idle_timeout=0)
+
+    with registry.lease(model_path, loader=loader, n_ctx=2048):
+        pass
+    with registry.lease(model_path, loader=loader, n_ctx=4096):
+        pass
+    with registry.lease(model_path, loader=loader, n_ctx=4096, chat_format="llama-3"):
+        pass
+
+    assert loader.call_count == 3
+
+
+def test_registry_reloads_on_changed_load_params(tmp_path):
+    """После смены параметров загрузки модель загружается заново, прежний свободный экземпляр выгружается."""
+    model_path = _make_model_file(tmp_path, "a.gguf", 10)
+    loader = MagicMock(side_effect=lambda **kwargs: MagicMock())
+    registry = LocalModelRegistry(ram_budget_bytes=None, idle_timeout=0)
+
+    with registry.lease(model_path, loader=loader, n_threads=4) as first:
+        pass
+    with registry.lease(model_path, loader=loader, n_threads=4, extra_bytes=10) as second:
+        pass
+    with registry.lease(model_path, loader=loader, n_threads=8, extra_bytes=10) as third:
+        pass
+
+    assert loader.call_count == 3
+    assert loader.call_args.kwargs["n_threads"] == 8
+    first.close.assert_called_once()
+    second.close.assert_called_once()
+    assert [m["size"] for m in registry.stats()["resident_models"]] == [20]
+    third.close.assert_not_called()
+
+
+def test_registry_evicts_lru_over_budget(tmp_path):
+    """При превышении бюджета RAM вытесняется давно не использованная модель."""
+    path_a = _make_model_file(tmp_path, "a.gguf", 60)
+    path_b = _make_model_file(tmp_path, "b.gguf", 60)
+    instances = {}
+    loader = MagicMock(side_effect=lambda **kwargs: instances.setdefault(kwargs["model_path"], MagicMock()))
+    registry = LocalModelRegistry(ram_budget_bytes=100, idle_timeout=0)
+
+    with registry.lease(path_a, loader=loader):
+        pass
+    with registry.lease(path_b, loader=loader):
+        pass
+
+    resident = [m["path"] for m in registry.stats()["resident_models"]]
+    assert resident == [path_b]
+    instances[path_a].close.assert_called_once()
+
+
+def test_registry_unloads_idle_models(tmp_path):
+    """Модели, простаивающие дольше idle_timeout, выгружаются."""
+    model_path = _make_model_file(tmp_path, "a.gguf", 10)
+    registry = LocalModelRegistry(ram_budget_bytes=None, idle_timeout=0.05)
+
+    with registry.lease(model_path, loader=MagicMock()):
+        assert registry.evict_idle() == 0  # занятая модель не выгружается
+    time.sleep(0.1)
+
+    assert registry.evict_idle() == 1
+    assert registry.stats()["resident_models"] == []
+    registry.shutdown()
+
+
+def test_registry_concurrent_leases_load_once(tmp_path):
+    """Параллельные запросы одной модели приводят к единственной загрузке."""
+    model_path = _make_model_file(tmp_path, "a.gguf", 10)
+
+    def slow_loader(**kwargs):
+        time.sleep(0.05)
+        return MagicMock()
+
+    loader = MagicMock(side_effect=slow_loader)
+    registry = LocalModelRegistry(ram_budget_bytes=None, idle_timeout=0)
+    seen = []
+
+    def worker():
+        with registry.lease(model_path, loader=loader) as llm:
+            seen.append(llm)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    loader.assert_called_once()
+    assert len(seen) == 8 and all(llm is seen[0] for llm in seen)
+
+
+def test_registry_counts_extra_bytes_in_budget(tmp_path):
+    """Память сверх файла модели (кэш промптов) учитывается в бюджете RAM."""
+    path_a = _make_model_file(tmp_path, "a.gguf", 30)
+    path_b = _make_model_file(tmp_path, "b.gguf", 30)
+    registry = LocalModelRegistry(ram_budget_bytes=100, idle_timeout=0)
+
+    with registry.lease(path_a, loader=MagicMock(), extra_bytes=40):
+        pass
+    assert registry.stats()["resident_bytes"] == 70
+    with registry.lease(path_b, loader=MagicMock(), extra_bytes=40):
+        pass
+
+    assert [m["path"] for m in registry.stats()["resident_models"]] == [path_b]
+
+
+class CachingLlama:
+    """Локальная модель, запоминающая подключенный кэш промптов."""
+
+    def __init__(self, **kwargs):
+        self.cache = None
+
+    def set_cache(self, cache):
+        self.cache = cache
+
+    def create_chat_completion(self, **kwargs):
+        return {"choices": [{"message": {"content": "ответ"}}]}
+
+
+def test_local_model_gets_prompt_cache(tmp_path, monkeypatch):
+    """Резидентной локальной модели подключается кэш KV-состояний промптов заданной емкости."""
+    (tmp_path / "model.gguf").write_bytes(b"gguf")
+    monkeypatch.setenv("LOCAL_MODEL_PATH", str(tmp_path))
+    monkeypatch.setenv("LOCAL_PROMPT_CACHE_MB", "2")
+    loaded = []
+    monkeypatch.setattr(quest_generator, "Llama", lambda **kwargs: loaded.append(CachingLlama(**kwargs)) or loaded[-1])
+    monkeypatch.setattr(quest_generator, "LlamaRAMCache", lambda capacity_bytes: {"capacity_bytes": capacity_bytes})
+    try:
+        quest_generator._local_chat_completion("промпт", "model.gguf", {"type": "text"})
+        quest_generator._local_chat_completion("промпт", "model.gguf", {"type": "text"})
+        [resident] = local_model_registry.stats()["resident_models"]
+        assert resident["size"] == 4 + 2 * 1024 * 1024  # файл модели и емкость кэша
+        # Та же резидентная модель: второй вызов ее не загружает
+        assert len(loaded) == 1
+        assert loaded[0].cache == {"capacity_bytes": 2 * 1024 * 1024}
+
+        # Другая емкость кэша — другие параметры загрузки: модель загружается заново
+        monkeypatch.setenv("LOCAL_PROMPT_CACHE_MB", "0")
+        quest_generator._local_chat_completion("промпт", "model.gguf", {"type": "text"})
+        assert len(loaded) == 2 and loaded[1].cache is None
+        assert [m["size"] for m in local_model_registry.stats()["resident_models"]] == [4]
+    finally:
+        local_model_registry.clear()
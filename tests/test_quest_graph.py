@@ -0,0 +1,69 @@
+from app.services.quest_generator import _validate_and_clean_quest
+from app.services.quest_graph import QuestGraph
+
+
+def make_quest(edges, start="a", extra=()):
+    """Квест из списка переходов (откуда, куда); extra — сцены без исходящих переходов."""
+    choices = {}
+    for source, target in edges:
+        choices.setdefault(source, []).append({"text": f"{source}->{target}", "next_scene": target})
+        choices.setdefault(target, [])
+    for scene_id in extra:
+        choices.setdefault(scene_id, [])
+    return {
+        "start_scene": start,
+        "scenes": [{"scene_id": scene_id, "text": scene_id, "choices": items} for scene_id, items in choices.items()],
+    }
+
+
+def test_reachability_in_degree_and_report():
+    quest = make_quest([("a", "b"), ("a", "c"), ("b", "d"), ("c", "d"), ("x", "d")])
+    quest["scenes"][0]["choices"].append({"text": "в никуда", "next_scene": "missing"})
+    graph = QuestGraph(quest)
+
+    assert graph.reachable_ids() == {"a", "b", "c", "d"}
+    assert graph.in_degree()[graph.index["d"]] == 3
+    report = graph.report()
+    assert report["unreachable"] == ["x"]
+    assert report["orphans"] == ["x"]
+    assert report["endings"] == ["d"]
+    assert report["dangling"] == [{"scene_id": "a", "choice_index": 2, "next_scene": "missing"}]
+    assert report["has_cycle"] is False
+
+
+def test_topological_order_and_cycles():
+    graph = QuestGraph(make_quest([("a", "b"), ("b", "c"), ("a", "c")]))
+    order, has_cycle = graph.topological_order()
+    assert not has_cycle
+    assert [graph.scene_ids[i] for i in order] == ["a", "b", "c"]
+
+    cyclic = QuestGraph(make_quest([("a", "b"), ("b", "c"), ("c", "a"), ("c", "d")]))
+    assert cyclic.has_cycle()
+    back = cyclic.back_edges()
+    assert [(cyclic.scene_ids[s], cyclic.scene_ids[t]) for s, _, t in back] == [("c", "a")]
+
+
+def test_back_edges_break_all_cycles():
+    quest = make_quest([("a", "b"), ("b", "a"), ("b", "c"), ("c", "c"), ("d", "e"), ("e", "d")])
+    graph = QuestGraph(quest)
+    removed = {(s, c) for s, c, _ in graph.back_edges()}
+    for i, scene in enumerate(quest["scenes"]):
+        scene["choices"] = [choice for c, choice in enumerate(scene["choices"]) if (i, c) not in removed]
+    assert not QuestGraph(quest).has_cycle()
+
+
+def test_missing_start_and_duplicates():
+    quest = make_quest([("a", "b")], start="nope")
+    quest["scenes"].append({"scene_id": "a", "choices": []})
+    graph = QuestGraph(quest)
+    assert graph.start is None and graph.reachable_ids() == set()
+    assert graph.duplicate_ids == ["a"]
+
+
+def test_validator_removes_unreachable_scenes_on_large_graph():
+    """Валидатор линеен: цепочка из 20 000 сцен и ветка недостижимых сцен."""
+    chain = [(f"s{i}", f"s{i + 1}") for i in range(20_000)]
+    quest = make_quest(chain + [("orphan", "s5")], start="s0")
+    cleaned = _validate_and_clean_quest(quest)
+    assert len(cleaned["scenes"]) == 20_001
+    assert all(scene["scene_id"] != "orphan" for scene in cleaned["scenes"])
@@ -0,0 +1,659 @@
+import asyncio
+import json
+import os
+import re
+import time
+
+import pytest
+
+from app.services.quest_generator import (
+    _diff_quests,
+    acreate_quest_from_setting,
+    cancel_generation,
+    create_quest_from_setting,
+    resume_quest_run,
+)
+from app.services.run_store import get_run_store
+
+# Ветвящийся граф из 7 сцен глубиной 3: scene_1 -> (2, 3), 2 -> (4, 5), 3 -> (6, 7)
+BRANCHING_SKELETON = {
+    "start_scene": "scene_1",
+    "scenes": [
+        {"scene_id": f"scene_{i}", "summary": f"Ситуация {i}", "choices": [
+            {"choice_summary": f"Путь {i}->{child}", "next_scene": f"scene_{child}"}
+            for child in (2 * i, 2 * i + 1) if child <= 7
+        ]}
+        for i in range(1, 8)
+    ],
+}
+
+
+class FakeLLM:
+    """Имитирует ответы LLM для каждого этапа конвейера по тексту промпта."""
+
+    def __init__(self, skeleton=None, delay=0.0):
+        self.skeleton = skeleton or BRANCHING_SKELETON
+        self.delay = delay
+        self.calls = []
+        self.providers = []
+        self.models = []
+        self.max_tokens = []
+        self.cache_flags = []
+        self.active = 0
+        self.max_active = 0
+
+    async def __call__(self, prompt, api_provider, api_key, model, force_text_response=False, use_cache=True, on_delta=None, max_wait=None, schema=None, max_tokens=None):
+        self.calls.append(prompt)
+        self.providers.append(api_provider)
+        self.models.append(model)
+        self.max_tokens.append(max_tokens)
+        self.cache_flags.append(use_cache)
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(self.delay)
+            response = self.respond(prompt)
+            if on_delta is not None:
+                # Отдаем ответ мелкими кусками, как потоковый API
+                for start in range(0, len(response), 5):
+                    on_delta(response[start:start + 5])
+                    await asyncio.sleep(0)
+            return response
+        finally:
+            self.active -= 1
+
+    def respond(self, prompt):
+        if "редактор сеттингов" in prompt:
+            return "Сжатый сеттинг."
+        if "ведущий геймдизайнер" in prompt:
+            return json.dumps({"concept": "Концепт квеста.", "scenes": [f"Ситуация {i}" for i in range(1, len(self.skeleton["scenes"]) + 1)]}, ensure_ascii=False)
+        if "автор интерактивных квестов" in prompt:
+            return json.dumps({"start_scene": self.skeleton["start_scene"], "scenes": [
+                {"scene_id": scene["scene_id"], "text": f"Текст: {scene['summary']}",
+                 "choices": [{"text": c["choice_summary"], "next_scene": c["next_scene"]} for c in scene["choices"]]}
+                for scene in self.skeleton["scenes"]
+            ]}, ensure_ascii=False)
+        if "эксперт-геймдизайнер" in prompt:
+            return "Концепт квеста."
+        if "технический ассистент" in prompt:
+            return "\n".join(f"{i}. Ситуация {i}" for i in range(1, len(self.skeleton["scenes"]) + 1))
+        if "геймдизайнер-нарративщик" in prompt:
+            return json.dumps(self.skeleton, ensure_ascii=False)
+        if "сценарист интерактивных историй" in prompt:
+            summary = re.search(r'ТЕКУЩЕЙ ИГРОВОЙ СИТУАЦИИ:\n"(.*)"', prompt).group(1)
+            return json.dumps({"text": f"Текст: {summary}", "choices_text": ["Первое действие", "Второе действие"]}, ensure_ascii=False)
+        if "редактор-корректор" in prompt:
+            return re.search(r"JSON для вычитки:\*\*\n---\n([\s\S]*)\n---", prompt).group(1)
+        raise AssertionError(f"Неожиданный промпт: {prompt[:80]}")
+
+    def scene_prompts(self):
+        return [p for p in self.calls if "сценарист интерактивных историй" in p]
+
+
+def run_pipeline(**overrides):
+    params = dict(
+        setting_text="Сеттинг", api_key="key", api_provider="groq", model="m",
+        scene_count=7, tone="", pacing="", narrative_elements=[],
+    )
+    params.update(overrides)
+    return [json.loads(event) for event in create_quest_from_setting(**params)]
+
+
+@pytest.fixture
+def fake_llm(monkeypatch):
+    llm = FakeLLM()
+    monkeypatch.setattr("app.services.quest_generator._acall_llm", llm)
+    return llm
+
+
+def test_pipeline_produces_detailed_quest(fake_llm):
+    """Конвейер проходит все этапы и возвращает квест со всеми сценами в исходном порядке."""
+    events = run_pipeline()
+    assert events[-1]["status"] == "done"
+    quest = events[-1]["quest"]
+    assert [s["scene_id"] for s in quest["scenes"]] == [f"scene_{i}" for i in range(1, 8)]
+    assert quest["scenes"][0]["text"] == "Текст: Ситуация 1"
+    assert quest["scenes"][0]["choices"][0] == {"next_scene": "scene_2", "text": "Первое действие"}
+    detail_messages = [e["message"] for e in events if e["status"] == "detailing_scene"]
+    assert sorted(detail_messages) == sorted(f"4/6: Сценарист пишет текст для сцены {i}/7..." for i in range(1, 8))
+
+
+def test_pipeline_passes_cache_bypass_to_every_stage(fake_llm):
+    run_pipeline(use_cache=False)
+    assert fake_llm.cache_flags and not any(fake_llm.cache_flags)
+
+
+def test_scene_detail_uses_parent_text(fake_llm):
+    """Промпт сцены содержит готовый текст родительской сцены и выбор, который к ней привел."""
+    run_pipeline()
+    prompt = next(p for p in fake_llm.scene_prompts() if '"Ситуация 5"' in p)
+    assert "Текст: Ситуация 2" in prompt
+    assert "Вы решили: 'Путь 2->5'" in prompt
+
+
+def test_scene_detail_runs_siblings_in_parallel(monkeypatch):
+    """Независимые ветки детализируются одновременно: время ~ глубине графа, а не числу сцен."""
+    llm = FakeLLM(delay=0.1)
+    monkeypatch.setattr("app.services.quest_generator._acall_llm", llm)
+    monkeypatch.setenv("LLM_CONCURRENCY_GROQ", "4")
+
+    started = time.perf_counter()
+    events = run_pipeline()
+    elapsed = time.perf_counter() - started
+
+    assert events[-1]["status"] == "done"
+    assert llm.max_active == 4
+    # 4 последовательных вызова до этапа 4 + 3 уровня графа + корректор (против 12 последовательно)
+    assert elapsed < 1.0
+
+
+def test_scene_detail_respects_concurrency_limit(fake_llm, monkeypatch):
+    monkeypatch.setenv("LLM_CONCURRENCY_GROQ", "1")
+    run_pipeline()
+    assert fake_llm.max_active == 1
+
+
+def test_scene_detail_survives_cycle_in_graph(monkeypatch):
+    """Цикл в скелете не приводит к зависанию планировщика."""
+    skeleton = {
+        "start_scene": "scene_1",
+        "scenes": [
+            {"scene_id": "scene_1", "summary": "A", "choices": [{"choice_summary": "к B", "next_scene": "scene_2"}]},
+            {"scene_id": "scene_2", "summary": "B", "choices": [{"choice_summary": "к A", "next_scene": "scene_1"}]},
+        ],
+    }
+    llm = FakeLLM(skeleton=skeleton)
+    monkeypatch.setattr("app.services.quest_generator._acall_llm", llm)
+    events = run_pipeline(scene_count=2)
+    assert events[-1]["status"] == "done"
+    assert len(llm.scene_prompts()) == 2
+
+
+def test_async_pipeline_runs_concurrent_generations(monkeypatch):
+    """Асинхронный конвейер: несколько генераций в одном цикле событий без потока на каждую."""
+    llm = FakeLLM(delay=0.05)
+    monkeypatch.setattr("app.services.quest_generator._acall_llm", llm)
+
+    async def collect():
+        return [event async for event in acreate_quest_from_setting("Сеттинг", "key", "groq", "m", 7, "", "", [])]
+
+    async def main():
+        return await asyncio.gather(*(collect() for _ in range(10)))
+
+    started = time.perf_counter()
+    results = asyncio.run(main())
+    elapsed = time.perf_counter() - started
+
+    assert all(json.loads(events[-1])["status"] == "done" for events in results)
+    assert llm.max_active > 10
+    assert elapsed < 1.5  # 10 генераций по ~8 этапов ожидания, выполненные одновременно
+
+
+def test_sync_adapter_closes_async_pipeline(monkeypatch):
+    """Если потребитель бросил синхронный генератор, незавершенные запросы этапа 4 отменяются."""
+    llm = FakeLLM(delay=0.2)
+    monkeypatch.setattr("app.services.quest_generator._acall_llm", llm)
+    events = create_quest_from_setting("Сеттинг", "key", "groq", "m", 7, "", "", [])
+    for raw in events:
+        if json.loads(raw)["status"] == "detailing_scene":
+            break
+    events.close()
+    assert llm.active == 0
+
+
+def test_pipeline_streams_scene_text_deltas(fake_llm):
+    """Текст сцен приходит событиями scene_delta до финального результата и совпадает с ним."""
+    events = run_pipeline()
+    deltas = [e for e in events if e["status"] == "scene_delta"]
+    assert deltas and all("message" not in e for e in deltas)
+    streamed = {}
+    for event in deltas:
+        streamed[event["scene_id"]] = streamed.get(event["scene_id"], "") + event["delta"]
+    quest = events[-1]["quest"]
+    assert streamed == {scene["scene_id"]: scene["text"] for scene in quest["scenes"]}
+    # Первый текст виден раньше, чем закончились все сцены
+    assert events.index(deltas[0]) < max(i for i, e in enumerate(events) if e["status"] == "detailing_scene")
+
+
+def apply_progressive_events(events):
+    """Собирает квест так, как это делает клиент: skeleton -> scene_ready -> corrected."""
+    quest, scenes = None, {}
+    for event in events:
+        if event["status"] == "skeleton":
+            quest = {key: value for key, value in event["quest"].items() if key != "scenes"}
+            scenes = {scene["scene_id"]: scene for scene in event["quest"]["scenes"]}
+        elif event["status"] == "scene_ready":
+            scenes[event["scene"]["scene_id"]] = event["scene"]
+        elif event["status"] == "corrected":
+            for change in event["changes"]:
+                if change["op"] == "set":
+                    quest[change["key"]] = change["value"]
+                elif change["op"] == "unset":
+                    quest.pop(change["key"], None)
+                elif change["op"] == "set_scene":
+                    scenes[change["scene_id"]] = change["scene"]
+                elif change["op"] == "remove_scene":
+                    scenes.pop(change["scene_id"], None)
+    return quest, scenes
+
+
+class EditingFakeLLM(FakeLLM):
+    """Корректор правит текст scene_1 и пытается сломать структуру: удалить сцену и добавить поле."""
+
+    def respond(self, prompt):
+        response = super().respond(prompt)
+        if "редактор-корректор" not in prompt:
+            return response
+        chunk = json.loads(response)
+        chunk["title"] = "Квест"
+        for item in chunk["scenes"]:
+            if item["scene_id"] == "scene_1":
+                item["text"] = "Исправленный текст."
+        chunk["scenes"] = [item for item in chunk["scenes"] if item["scene_id"] != "scene_7"]
+        return json.dumps(chunk, ensure_ascii=False)
+
+
+def test_pipeline_emits_progressive_quest_events(monkeypatch):
+    """Скелет, готовые сцены и отличия корректора дают тот же квест, что и финальное событие."""
+    skeleton = json.loads(json.dumps(BRANCHING_SKELETON))
+    skeleton["scenes"].append({"scene_id": "scene_8", "summary": "Ситуация 8", "choices": []})  # недостижима до починки
+    llm = EditingFakeLLM(skeleton=skeleton)
+    monkeypatch.setattr("app.services.quest_generator._acall_llm", llm)
+    monkeypatch.setenv("CORRECTION_FORCE_FULL", "true")
+    events = run_pipeline(scene_count=8)
+    statuses = [e["status"] for e in events]
+
+    assert statuses.index("skeleton") < statuses.index("scene_ready") < statuses.index("corrected") < statuses.index("done")
+    assert statuses.count("scene_ready") == 8
+    repaired = events[statuses.index("skeleton")]["quest"]
+    assert repaired["scenes"][6]["choices"] == [{"choice_summary": "Ситуация 8", "next_scene": "scene_8"}]
+    ready = next(e["scene"] for e in events if e["status"] == "scene_ready")
+    assert ready["text"].startswith("Текст:") and "choice_summary" not in ready["choices"][0]
+
+    changes = events[statuses.index("corrected")]["changes"]
+    assert [(c["op"], c.get("scene_id") or c.get("key")) for c in changes] == [("set_scene", "scene_1")]
+    quest, scenes = apply_progressive_events(events)
+    final = events[-1]["quest"]
+    assert quest == {key: value for key, value in final.items() if key != "scenes"}
+    assert scenes == {scene["scene_id"]: scene for scene in final["scenes"]}
+    assert "scene_7" in scenes and "title" not in final
+
+
+def test_diff_quests_operations():
+    before = {"start_scene": "a", "note": "x", "scenes": [{"scene_id": "a"}, {"scene_id": "b"}]}
+    after = {"start_scene": "b", "title": "T", "scenes": [{"scene_id": "a", "text": "новый"}]}
+    assert _diff_quests(before, after) == [
+        {"op": "set", "key": "start_scene", "value": "b"},
+        {"op": "set", "key": "title", "value": "T"},
+        {"op": "unset", "key": "note"},
+        {"op": "set_scene", "scene_id": "a", "scene": {"scene_id": "a", "text": "новый"}},
+        {"op": "remove_scene", "scene_id": "b"},
+    ]
+
+
+class CountingCorrectorLLM(FakeLLM):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.correcting = 0
+        self.max_correcting = 0
+
+    async def __call__(self, prompt, *args, **kwargs):
+        is_correction = "редактор-корректор" in prompt
+        if is_correction:
+            self.correcting += 1
+            self.max_correcting = max(self.max_correcting, self.correcting)
+        try:
+            return await super().__call__(prompt, *args, **kwargs)
+        finally:
+            if is_correction:
+                self.correcting -= 1
+
+
+def test_corrector_splits_quest_into_parallel_chunks(monkeypatch):
+    """Корректор получает только тексты кусками не больше лимита, работает параллельно и не меняет структуру."""
+    llm = CountingCorrectorLLM(delay=0.05)
+    monkeypatch.setattr("app.services.quest_generator._acall_llm", llm)
+    monkeypatch.setenv("CORRECTION_CHUNK_TOKENS", "40")
+    monkeypatch.setenv("CORRECTION_FORCE_FULL", "true")
+    events = run_pipeline()
+
+    correction_prompts = [p for p in llm.calls if "редактор-корректор" in p]
+    assert len(correction_prompts) > 1
+    assert llm.max_correcting > 1
+    assert all("next_scene" not in p for p in correction_prompts)
+    assert sum(p.count('"scene_id"') for p in correction_prompts) == 7
+
+    quest = events[-1]["quest"]
+    assert [(s["scene_id"], [c["next_scene"] for c in s["choices"]]) for s in quest["scenes"]] == [
+        (s["scene_id"], [c["next_scene"] for c in s["choices"]]) for s in BRANCHING_SKELETON["scenes"]
+    ]
+    assert all(s["text"] == f"Текст: Ситуация {i}" for i, s in enumerate(quest["scenes"], 1))
+
+
+def test_corrector_keeps_text_when_chunk_is_invalid(monkeypatch):
+    monkeypatch.setenv("CORRECTION_FORCE_FULL", "true")
+    llm = FakeLLM()
+    original_respond = llm.respond
+    llm.respond = lambda prompt: "не JSON" if "редактор-корректор" in prompt else original_respond(prompt)
+    monkeypatch.setattr("app.services.quest_generator._acall_llm", llm)
+    events = run_pipeline()
+    assert events[-1]["status"] == "done"
+    assert events[-1]["quest"]["scenes"][0]["text"] == "Текст: Ситуация 1"
+
+
+class ContaminatedFakeLLM(FakeLLM):
+    """Сцены 3 и 5 получают латиницу и иероглифы, корректор их исправляет."""
+
+    def respond(self, prompt):
+        response = super().respond(prompt)
+        if "сценарист интерактивных историй" in prompt and re.search(r'"Ситуация [35]"', prompt):
+            detail = json.loads(response)
+            detail["text"] += " He tries to escape 不断."
+            return json.dumps(detail, ensure_ascii=False)
+        if "редактор-корректор" in prompt:
+            return response.replace(" He tries to escape 不断.", "")
+        return response
+
+
+def test_clean_quest_skips_corrector(fake_llm):
+    """Если в тексте нет посторонних письменностей, вызова корректора нет."""
+    events = run_pipeline()
+    assert not [p for p in fake_llm.calls if "редактор-корректор" in p]
+    check = next(e for e in events if e["status"] == "script_check")
+    assert check["scenes"] == {}
+    assert events[-1]["status"] == "done"
+
+
+def test_corrector_receives_only_contaminated_scenes(monkeypatch):
+    llm = ContaminatedFakeLLM()
+    monkeypatch.setattr("app.services.quest_generator._acall_llm", llm)
+    events = run_pipeline()
+
+    check = next(e for e in events if e["status"] == "script_check")
+    assert set(check["scenes"]) == {"scene_3", "scene_5"}
+    assert check["scenes"]["scene_3"]["latin_words"] == 4 and check["scenes"]["scene_3"]["cjk_chars"] == 2
+    correction_prompts = [p for p in llm.calls if "редактор-корректор" in p]
+    assert correction_prompts and all('"scene_1"' not in p for p in correction_prompts)
+    assert sum(p.count('"scene_id"') for p in correction_prompts) == 2
+    scenes = {s["scene_id"]: s for s in events[-1]["quest"]["scenes"]}
+    assert scenes["scene_3"]["text"] == "Текст: Ситуация 3"
+
+
+def test_director_graph_is_repaired_before_detailing(monkeypatch):
+    """Цикл и ссылка в никуда из ответа режиссёра исправляются без LLM и попадают в отчет."""
+    skeleton = {
+        "start_scene": "scene_1",
+        "scenes": [
+            {"scene_id": "scene_1", "summary": "A", "choices": [{"choice_summary": "к B", "next_scene": "scene_2"}]},
+            {"scene_id": "scene_2", "summary": "B", "choices": [
+                {"choice_summary": "к A", "next_scene": "scene_1"}, {"choice_summary": "в никуда", "next_scene": "scene_9"},
+            ]},
+        ],
+    }
+    monkeypatch.setattr("app.services.quest_generator._acall_llm", FakeLLM(skeleton=skeleton))
+    events = run_pipeline(scene_count=2)
+    repair = next(e for e in events if e["status"] == "graph_repair")
+    assert {(c["next_scene"], c["reason"]) for c in repair["report"]["removed_choices"]} == {("scene_1", "cycle"), ("scene_9", "unknown_scene")}
+    quest = events[-1]["quest"]
+    assert quest["scenes"][1]["choices"] == []
+
+
+class FailingSceneLLM(FakeLLM):
+    """Детализация сцены 5 падает, как после исчерпанных повторов."""
+
+    def respond(self, prompt):
+        if "сценарист интерактивных историй" in prompt and '"Ситуация 5"' in prompt:
+            raise RuntimeError("API недоступен")
+        return super().respond(prompt)
+
+
+def test_failed_run_resumes_from_last_checkpoint(monkeypatch):
+    """После сбоя на сцене продолжение не повторяет готовые этапы и сцены."""
+    monkeypatch.setattr("app.services.quest_generator._acall_llm", FailingSceneLLM())
+    events = run_pipeline()
+    run_id = events[0]["run_id"]
+    assert events[0] == {"status": "run", "run_id": run_id, "resumed": False}
+    assert events[-1]["status"] == "error" and events[-1]["run_id"] == run_id
+    store = get_run_store()
+    assert store.get(run_id)["status"] == "failed"
+    assert "api_key" not in store.get(run_id)["params"]
+    saved_scenes = store.load_scenes(run_id)
+    assert saved_scenes and 4 not in saved_scenes
+
+    llm = FakeLLM()
+    monkeypatch.setattr("app.services.quest_generator._acall_llm", llm)
+    resumed = [json.loads(event) for event in resume_quest_run(run_id, "key")]
+
+    assert resumed[0]["resumed"] is True
+    assert not [p for p in llm.calls if "сценарист интерактивных историй" not in p and "редактор-корректор" not in p]
+    assert len(llm.scene_prompts()) == 7 - len(saved_scenes)
+    assert resumed[-1]["status"] == "done"
+    assert [s["text"] for s in resumed[-1]["quest"]["scenes"]] == [f"Текст: Ситуация {i}" for i in range(1, 8)]
+    assert sum(1 for e in resumed if e["status"] == "scene_ready") == 7
+    assert store.get(run_id)["status"] == "done"
+
+    # Завершенный запуск отдает сохраненный результат без вызовов LLM
+    again = [json.loads(event) for event in resume_quest_run(run_id, "key")]
+    assert again[-1] == resumed[-1] and len(llm.calls) == 7 - len(saved_scenes)
+
+
+def test_resume_unknown_run(fake_llm):
+    events = [json.loads(event) for event in resume_quest_run("f" * 32, "key")]
+    assert events == [{"status": "error", "message": f"Запуск {'f' * 32} не найден или устарел."}]
+
+
+def test_cancel_stops_generation_between_scenes(monkeypatch):
+    """/generate/<run_id>/cancel прерывает ожидание ответа LLM и останавливает оставшиеся сцены."""
+    llm = FakeLLM(delay=0.2)
+    monkeypatch.setattr("app.services.quest_generator._acall_llm", llm)
+    events = []
+    started = time.perf_counter()
+    for raw in create_quest_from_setting("Сеттинг", "key", "groq", "m", 7, "", "", []):
+        event = json.loads(raw)
+        events.append(event)
+        if event["status"] == "detailing_scene":
+            assert cancel_generation(events[0]["run_id"]) is True
+
+    assert events[-1] == {"status": "cancelled", "message": "Генерация отменена.", "run_id": events[0]["run_id"]}
+    assert time.perf_counter() - started < 0.2 * 4
+    assert len(llm.scene_prompts()) <= 1 and llm.active == 0
+    assert get_run_store().get(events[0]["run_id"])["status"] == "cancelled"
+    # Генерация завершена — отменять больше нечего
+    assert cancel_generation(events[0]["run_id"]) is False
+
+
+def test_client_disconnect_marks_run_cancelled(monkeypatch):
+    llm = FakeLLM(delay=0.2)
+    monkeypatch.setattr("app.services.quest_generator._acall_llm", llm)
+    events = create_quest_from_setting("Сеттинг", "key", "groq", "m", 7, "", "", [])
+    run_id = json.loads(next(events))["run_id"]
+    next(events)
+    events.close()
+    assert llm.active == 0
+    assert get_run_store().get(run_id)["status"] == "cancelled"
+    assert cancel_generation(run_id) is False
+
+
+class OutageLLM(FakeLLM):
+    """groq отвечает только геймдизайнеру, дальше — 503 на каждый запрос."""
+
+    def respond(self, prompt):
+        if self.providers[-1] == "groq" and "эксперт-геймдизайнер" not in prompt:
+            raise RuntimeError("503 Service Unavailable")
+        return super().respond(prompt)
+
+
+def test_quest_finishes_on_fallback_provider(monkeypatch):
+    """При отказе основного провайдера этапы продолжаются на резервном, черновики сцен сбрасываются."""
+    llm = OutageLLM()
+    monkeypatch.setattr("app.services.quest_generator._acall_llm", llm)
+    events = run_pipeline(fallbacks=[{"api_provider": "openai", "model": "gpt", "api_key": "k2"}])
+
+    assert events[-1]["status"] == "done"
+    assert llm.providers[0] == "groq"
+    assert "openai" in llm.providers
+    assert [s["text"] for s in events[-1]["quest"]["scenes"]] == [f"Текст: Ситуация {i}" for i in range(1, 8)]
+    resets = [e for e in events if e["status"] == "scene_delta" and e.get("reset")]
+    assert len(resets) == 7
+
+
+def test_per_stage_fallback_chain_from_env(monkeypatch):
+    monkeypatch.setenv("LLM_FALLBACK_CHAIN", "openai:gpt, local:model.gguf")
+    monkeypatch.setenv("LLM_FALLBACK_CHAIN_WRITER", "gemini:flash")
+    monkeypatch.setenv("OPENAI_API_KEY", "env-key")
+    from app.services.quest_generator import LLMTarget, _build_llm_chain
+
+    assert _build_llm_chain("groq", "k", "m", None, "concept") == [
+        LLMTarget("groq", "k", "m"), LLMTarget("openai", "env-key", "gpt"), LLMTarget("local", "", "model.gguf"),
+    ]
+    assert _build_llm_chain("groq", "k", "m", None, "writer")[1:] == [LLMTarget("gemini", "", "flash")]
+    per_stage = {"director": [{"api_provider": "openai", "model": "gpt-4o"}], "default": []}
+    assert _build_llm_chain("groq", "k", "m", per_stage, "director")[1] == LLMTarget("openai", "env-key", "gpt-4o")
+    assert _build_llm_chain("groq", "k", "m", per_stage, "writer") == [LLMTarget("groq", "k", "m")]
+
+
+def test_stage_models_route_stages_and_report_served_models(fake_llm, monkeypatch):
+    """Архитектор и корректор идут на дешевую модель, сцены — на основную; события называют модели."""
+    monkeypatch.setenv("CORRECTION_FORCE_FULL", "true")
+    cheap = {"api_provider": "openai", "model": "gpt-mini", "api_key": "k2"}
+    events = run_pipeline(stage_models={"architect": cheap, "corrector": cheap})
+
+    assert events[-1]["status"] == "done"
+    served = {e["stage"]: e["models"] for e in events if e["status"] == "stage_model"}
+    assert served == {
+        "concept": ["groq/m"], "architect": ["openai/gpt-mini"], "director": ["groq/m"],
+        "writer": ["groq/m"], "corrector": ["openai/gpt-mini"],
+    }
+    assert next(e for e in events if e["status"] == "architect")["model"] == "openai/gpt-mini"
+    scene_models = {m for p, m in zip(fake_llm.calls, fake_llm.models) if "сценарист интерактивных историй" in p}
+    assert scene_models == {"m"}
+
+
+def test_stage_route_falls_back_to_main_model(monkeypatch):
+    """Если модель этапа недоступна, этап завершает основная модель запроса."""
+    monkeypatch.setenv("STAGE_MODEL_DIRECTOR", "openai:gpt-mini")
+    monkeypatch.setenv("OPENAI_API_KEY", "env-key")
+    from app.services.quest_generator import LLMTarget, _build_llm_chain
+
+    assert _build_llm_chain("groq", "k", "m", [], "director") == [LLMTarget("openai", "env-key", "gpt-mini"), LLMTarget("groq", "k", "m")]
+    assert _build_llm_chain("groq", "k", "m", [], "writer") == [LLMTarget("groq", "k", "m")]
+    # Ключ запроса подходит модели этапа того же провайдера
+    routed = _build_llm_chain("groq", "k", "m", [], "concept", {"concept": {"api_provider": "groq", "model": "small"}})
+    assert routed[0] == LLMTarget("groq", "k", "small")
+
+
+def test_validate_stage_models(monkeypatch):
+    from app.services import quest_generator
+
+    calls = []
+
+    def fake_models(api_provider, api_key):
+        calls.append(api_provider)
+        return {"free": ["llama-3.1-8b-instant"], "paid": ["gpt-4o-mini-2024-07-18"]}
+
+    monkeypatch.setattr(quest_generator, "get_available_models", fake_models)
+    monkeypatch.setattr(quest_generator, "_model_list_cache", {})
+    validate = quest_generator.validate_stage_models
+
+    assert validate("groq", "k", None) is None and calls == []
+    assert validate("groq", "k", {"architect": {"api_provider": "groq", "model": "llama-3.1-8b-instant"}}) is None
+    assert validate("groq", "k", {"corrector": {"api_provider": "groq", "model": "gpt-4o-mini"}}) is None
+    assert calls == ["groq"]  # список моделей закэширован
+    assert "недоступна" in validate("groq", "k", {"writer": {"api_provider": "groq", "model": "nope"}})
+    assert "Неизвестные этапы" in validate("groq", "k", {"polish": {"api_provider": "groq", "model": "x"}})
+    assert "api_provider и model" in validate("groq", "k", {"writer": {"model": "x"}})
+
+
+def test_fast_mode_builds_small_quest_in_two_calls(fake_llm, monkeypatch):
+    """Быстрый режим: концепт со списком сцен и граф с текстами — два вызова, вычитка пропущена."""
+    monkeypatch.setenv("CORRECTION_FORCE_FULL", "true")
+    events = run_pipeline(pipeline_mode="fast")
+
+    assert events[-1]["status"] == "done"
+    assert len(fake_llm.calls) == 2
+    quest = events[-1]["quest"]
+    assert [s["text"] for s in quest["scenes"]] == [f"Текст: Ситуация {i}" for i in range(1, 8)]
+    assert quest["scenes"][0]["choices"][0] == {"text": "Путь 1->2", "next_scene": "scene_2"}
+    assert not any(e["status"] == "fast_fallback" for e in events)
+    assert get_run_store().get(events[0]["run_id"])["params"]["pipeline_mode"] == "fast"
+
+
+class BrokenFusedLLM(FakeLLM):
+    """Объединенный граф с текстами теряет сцену — быстрый режим должен откатиться к этапам."""
+
+    def respond(self, prompt):
+        response = super().respond(prompt)
+        if "автор интерактивных квестов" in prompt:
+            quest = json.loads(response)
+            quest["scenes"].pop()
+            return json.dumps(quest, ensure_ascii=False)
+        return response
+
+
+def test_fast_mode_falls_back_to_full_pipeline(monkeypatch):
+    llm = BrokenFusedLLM()
+    monkeypatch.setattr("app.services.quest_generator._acall_llm", llm)
+    events = run_pipeline(pipeline_mode="fast")
+
+    assert events[-1]["status"] == "done"
+    fallback = next(e for e in events if e["status"] == "fast_fallback")
+    assert fallback["stage"] == "director"
+    # Концепт и список сцен из быстрого вызова сохранились: дальше режиссёр и 7 сцен
+    assert not any("эксперт-геймдизайнер" in p or "технический ассистент" in p for p in llm.calls)
+    assert len(llm.calls) == 2 + 1 + 7
+    assert [s["text"] for s in events[-1]["quest"]["scenes"]] == [f"Текст: Ситуация {i}" for i in range(1, 8)]
+
+
+def test_fast_mode_large_quest_details_scenes_separately(fake_llm, monkeypatch):
+    monkeypatch.setenv("FAST_MODE_MAX_SCENES", "5")
+    events = run_pipeline(pipeline_mode="fast")
+
+    assert events[-1]["status"] == "done"
+    assert len(fake_llm.calls) == 1 + 1 + 7
+    assert len(fake_llm.scene_prompts()) == 7
+
+
+def test_long_setting_is_digested_and_stages_report_tokens(fake_llm, monkeypatch):
+    """Длинный сеттинг сжимается скользящим пересказом по частям; в промпты попадает выжимка."""
+    monkeypatch.setenv("SETTING_MAX_TOKENS", "100")
+    monkeypatch.setenv("TOKEN_BUDGET_SETTING_DIGEST", "600:100")
+    setting = "\n".join(f"Абзац {i}: " + "подробное описание мира " * 20 for i in range(10))
+    events = run_pipeline(setting_text=setting)
+
+    assert events[-1]["status"] == "done"
+    digest_calls = [p for p in fake_llm.calls if "редактор сеттингов" in p]
+    assert len(digest_calls) > 1
+    assert "Сжатый сеттинг." in digest_calls[-1]  # следующая часть дописывается к выжимке
+    assert all(setting not in p and "Сжатый сеттинг." in p for p in fake_llm.scene_prompts())
+    writer = next(e for e in events if e["status"] == "stage_model" and e["stage"] == "writer")
+    assert writer["tokens"]["calls"] == 7 and writer["tokens"]["prompt"] > 0 and writer["tokens"]["completion"] > 0
+    # Предел ответа задан каждому вызову
+    assert all(isinstance(limit, int) and limit > 0 for limit in fake_llm.max_tokens)
+
+
+def test_scene_prompts_get_relevant_lore_chunks(fake_llm, monkeypatch):
+    """При длинном сеттинге сцена получает выжимку и только относящиеся к ней фрагменты оригинала."""
+    monkeypatch.setenv("SETTING_MAX_TOKENS", "100")
+    monkeypatch.setenv("LORE_CHUNK_TOKENS", "150")
+    monkeypatch.setenv("LORE_TOP_K", "1")
+    filler = "\n".join("Обычные земли, поля и леса без особых примет. " * 8 for _ in range(6))
+    setting = "Смотритель давно покинул старый маяк на краю света.\n" + filler
+    fake_llm.skeleton = json.loads(json.dumps(BRANCHING_SKELETON))
+    fake_llm.skeleton["scenes"][2]["summary"] = "Герой поднимается к маяку"
+    events = run_pipeline(setting_text=setting)
+
+    assert events[-1]["status"] == "done"
+    prompts = {re.search(r'ТЕКУЩЕЙ ИГРОВОЙ СИТУАЦИИ:\n"(.*)"', p).group(1): p for p in fake_llm.scene_prompts()}
+    assert "старый маяк на краю света" in prompts["Герой поднимается к маяку"]
+    assert "старый маяк на краю света" not in prompts["Ситуация 4"]
+    assert all("Сжатый сеттинг." in p and setting not in p for p in prompts.values())
+
+
+def test_scene_prompts_share_instructions_and_setting_prefix(fake_llm):
+    """Промпты сцен начинаются с общей части (инструкции и сеттинг), данные сцены идут после нее."""
+    setting = "Город под куполом, где воздух выдают по карточкам."
+    run_pipeline(setting_text=setting)
+    prompts = fake_llm.scene_prompts()
+    prefix = os.path.commonprefix(prompts)
+    assert len(prompts) == 7 and setting in prefix and "КЛЮЧЕВЫЕ ПРАВИЛА" in prefix
+    assert all(len(prefix) > len(p) // 2 for p in prompts)
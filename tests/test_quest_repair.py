@@ -0,0 +1,97 @@
+from app.services import quest_repair
+from app.services.quest_graph import QuestGraph
+from app.services.quest_repair import repair_quest_graph
+
+
+def scene(scene_id, *targets):
+    return {"scene_id": scene_id, "summary": f"Сцена {scene_id}", "choices": [{"choice_summary": t, "next_scene": t} for t in targets]}
+
+
+def assert_valid_dag(quest):
+    graph = QuestGraph(quest)
+    assert graph.start is not None
+    assert not graph.has_cycle()
+    assert not graph.dangling and not graph.duplicate_ids
+    assert all(graph.reachable())
+    assert any(not targets for targets in graph.successors)
+
+
+def test_clean_graph_is_left_untouched():
+    quest = {"start_scene": "a", "scenes": [scene("a", "b", "c"), scene("b", "c"), scene("c")]}
+    report = repair_quest_graph(quest)
+    assert report["changed"] is False
+    assert [len(s["choices"]) for s in quest["scenes"]] == [2, 1, 0]
+
+
+def test_removes_self_loops_duplicates_and_unknown_targets():
+    quest = {"start_scene": "a", "scenes": [scene("a", "a", "b", "b", "zzz"), scene("b")]}
+    report = repair_quest_graph(quest)
+    assert [(c["next_scene"], c["reason"]) for c in report["removed_choices"]] == [
+        ("a", "self_loop"), ("b", "duplicate"), ("zzz", "unknown_scene"),
+    ]
+    assert quest["scenes"][0]["choices"] == [{"choice_summary": "b", "next_scene": "b"}]
+    assert_valid_dag(quest)
+
+
+def test_breaks_cycles_and_fixes_start():
+    quest = {"start_scene": "missing", "scenes": [scene("a", "b"), scene("b", "c"), scene("c", "a", "d"), scene("d")]}
+    report = repair_quest_graph(quest)
+    assert report["start_scene"] == {"from": "missing", "to": "a"}
+    assert {"scene_id": "c", "next_scene": "a", "reason": "cycle"} in report["removed_choices"]
+    assert_valid_dag(quest)
+
+
+def test_reattaches_orphans_without_creating_cycles():
+    # Ветка x -> y -> b недостижима; ближайшая предыдущая достижимая сцена для x — b,
+    # но b — потомок x, поэтому x присоединяется к a
+    quest = {"start_scene": "a", "scenes": [scene("a", "b"), scene("b"), scene("x", "y"), scene("y", "b")]}
+    report = repair_quest_graph(quest)
+    assert report["reattached_scenes"] == [{"scene_id": "x", "parent_id": "a"}]
+    assert_valid_dag(quest)
+
+
+def test_drops_scenes_that_are_not_objects():
+    """Строки и другие не-объекты в списке сцен удаляются и попадают в отчет, а не роняют починку."""
+    quest = {"start_scene": "a", "scenes": ["oops", scene("a", "b"), None, scene("b")]}
+    report = repair_quest_graph(quest)
+    assert [(s["position"], s["reason"]) for s in report["removed_scenes"]] == [(0, "not_object"), (2, "not_object")]
+    assert report["changed"] is True
+    assert [s["scene_id"] for s in quest["scenes"]] == ["a", "b"]
+    assert_valid_dag(quest)
+
+    empty = {"start_scene": "a", "scenes": ["oops"]}
+    assert repair_quest_graph(empty)["changed"] is True and empty["scenes"] == []
+
+
+def test_renames_duplicate_and_missing_ids():
+    quest = {"start_scene": "a", "scenes": [scene("a", "b"), scene("b"), {"scene_id": "b", "choices": []}, {"choices": []}]}
+    report = repair_quest_graph(quest)
+    assert report["renamed_scenes"] == [{"from": "b", "to": "b_2"}, {"from": None, "to": "scene_4"}]
+    assert_valid_dag(quest)
+
+
+def test_repair_is_deterministic():
+    def make():
+        return {"start_scene": "s0", "scenes": [scene(f"s{i}", f"s{(i * 7 + 3) % 30}", f"s{(i * 11 + 5) % 30}") for i in range(30)]}
+    first, second = make(), make()
+    assert repair_quest_graph(first) == repair_quest_graph(second)
+    assert first == second
+    assert_valid_dag(first)
+
+
+def test_reattaches_many_orphans_without_rebuilding_graph(monkeypatch):
+    """Тысячи оторванных веток присоединяются без перестройки графа на каждую."""
+    builds = []
+
+    def counting_graph(quest):
+        builds.append(1)
+        return QuestGraph(quest)
+
+    monkeypatch.setattr(quest_repair, "QuestGraph", counting_graph)
+    quest = {"start_scene": "s0", "scenes": [scene("s0", "e")] + [scene(f"o{i}", f"c{i}") for i in range(2000)]
+             + [scene(f"c{i}", "e") for i in range(2000)] + [scene("e")]}
+    report = repair_quest_graph(quest)
+
+    assert len(report["reattached_scenes"]) == 2000
+    assert len(builds) == 1
+    assert_valid_dag(quest)
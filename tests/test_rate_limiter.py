@@ -0,0 +1,106 @@
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import groq
+import httpx
+import pytest
+
+from app.services.quest_generator import _call_llm
+from app.services.rate_limiter import (
+    ProviderRateLimiter,
+    RateLimiterRegistry,
+    TokenBucket,
+    parse_reset_duration,
+    rate_limiters,
+)
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [("6s", 6.0), ("1m30.5s", 90.5), ("120ms", 0.12), ("2", 2.0), ("1h", 3600.0), ("", None), (None, None), ("soon", None)],
+)
+def test_parse_reset_duration(value, expected):
+    if expected is None:
+        assert parse_reset_duration(value) is None
+    else:
+        assert parse_reset_duration(value) == pytest.approx(expected)
+
+
+def test_token_bucket_waits_when_exhausted():
+    """Пустое ведро возвращает время ожидания, пропорциональное недостаче."""
+    bucket = TokenBucket(per_minute=60)  # 1 в секунду
+    assert bucket.reserve(60, now=bucket.updated) == 0
+    assert bucket.reserve(2, now=bucket.updated) == pytest.approx(2.0)
+
+
+def test_unlimited_limiter_never_waits():
+    limiter = ProviderRateLimiter()
+    assert all(limiter.reserve(10_000) == 0 for _ in range(100))
+
+
+def test_limiter_requests_per_minute():
+    limiter = ProviderRateLimiter(requests_per_minute=2)
+    assert limiter.reserve() == 0
+    assert limiter.reserve() == 0
+    assert limiter.reserve() == pytest.approx(30.0, abs=0.1)
+
+
+def test_limiter_learns_tokens_from_headers():
+    """Лимит токенов узнается из x-ratelimit-* и ограничивает следующие запросы."""
+    limiter = ProviderRateLimiter()
+    limiter.update_from_headers({"x-ratelimit-limit-tokens": "6000", "x-ratelimit-remaining-tokens": "100"})
+    assert limiter.tokens is not None and limiter.tokens.capacity == 6000
+    assert limiter.reserve(estimated_tokens=1100) == pytest.approx(10.0, abs=0.1)
+
+
+def test_limiter_explicit_config_wins_over_headers():
+    limiter = ProviderRateLimiter(tokens_per_minute=1000)
+    limiter.update_from_headers({"x-ratelimit-limit-tokens": "6000"})
+    assert limiter.tokens.capacity == 1000
+
+
+def test_limiter_blocks_on_exhausted_requests_and_retry_after():
+    limiter = ProviderRateLimiter()
+    limiter.update_from_headers({"x-ratelimit-remaining-requests": "0", "x-ratelimit-reset-requests": "2s"})
+    assert limiter.reserve() == pytest.approx(2.0, abs=0.1)
+    limiter.penalize(5)
+    assert limiter.reserve() == pytest.approx(5.0, abs=0.1)
+
+
+def test_limiter_record_usage_returns_overestimate():
+    limiter = ProviderRateLimiter(tokens_per_minute=100)
+    limiter.reserve(estimated_tokens=100)
+    limiter.record_usage(estimated_tokens=100, actual_tokens=40)
+    assert limiter.reserve(estimated_tokens=60) == 0
+
+
+def test_registry_shares_limiter_per_key_and_reads_env(monkeypatch):
+    monkeypatch.setenv("LLM_RPM_OPENAI", "120")
+    monkeypatch.setenv("LLM_RPM_GROQ", "0")
+    registry = RateLimiterRegistry()
+    assert registry.get("openai", "a") is registry.get("openai", "a")
+    assert registry.get("openai", "a") is not registry.get("openai", "b")
+    assert registry.get("openai", "a").requests.capacity == 120
+    assert registry.get("groq", "a").requests is None  # 0 — без ограничения
+    assert registry.get("local").requests is None and registry.get("local").tokens is None
+
+
+@patch("app.services.rate_limiter.asyncio.sleep", new_callable=AsyncMock)
+@patch("app.services.llm_clients.AsyncGroq")
+def test_call_llm_429_uses_retry_after_and_shared_limiter(mock_groq, mock_sleep):
+    """После 429 пауза берется из retry-after и применяется к общему лимитеру ключа."""
+    response = httpx.Response(429, headers={"retry-after": "0.01"}, request=httpx.Request("POST", "https://api.groq.com"))
+    ok_response = MagicMock()
+    ok_response.parse = AsyncMock()
+    ok_response.headers = {"x-ratelimit-limit-tokens": "6000"}
+    ok_response.parse.return_value.choices[0].message.content = '{"ok": true}'
+    ok_response.parse.return_value.usage.total_tokens = 50
+    create = AsyncMock()
+    mock_groq.return_value.chat.completions.with_raw_response.create = create
+    create.side_effect = [groq.RateLimitError("rate limited", response=response, body=None), ok_response]
+
+    assert _call_llm("промпт", "groq", "key", "model") == '{"ok": true}'
+    assert create.call_count == 2
+    # Ждали ровно retry-after (через лимитер), а не фиксированную паузу в 1 секунду
+    mock_sleep.assert_called_once()
+    assert mock_sleep.call_args[0][0] == pytest.approx(0.01, abs=0.01)
+    assert rate_limiters.get("groq", "key").tokens.capacity == 6000
@@ -0,0 +1,43 @@
+import os
+import time
+
+import pytest
+
+from app.services.run_store import RunNotFoundError, RunStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return RunStore(tmp_path / "runs")
+
+
+def test_run_record_and_checkpoints(store):
+    run_id = store.create({"setting_text": "Сеттинг", "model": "m"})
+    assert store.get(run_id)["status"] == "running"
+    store.save_stage(run_id, "concept", "Концепт")
+    store.save_scene(run_id, 2, {"text": "Сцена"})
+    store.set_status(run_id, "failed", "ошибка")
+
+    assert store.load_stage(run_id, "concept") == "Концепт"
+    assert store.load_stage(run_id, "skeleton") is None
+    assert store.load_scenes(run_id) == {2: {"text": "Сцена"}}
+    assert store.get(run_id)["error"] == "ошибка"
+    assert not list((store.root / run_id).rglob("*.tmp"))
+
+
+def test_unknown_or_malformed_run_id(store):
+    with pytest.raises(RunNotFoundError):
+        store.get("0" * 32)
+    with pytest.raises(RunNotFoundError):
+        store.get("../../etc")
+
+
+def test_cleanup_removes_old_runs(store):
+    old_run = store.create({})
+    fresh_run = store.create({})
+    stale = time.time() - 10 * 86400
+    os.utime(store.root / old_run / "run.json", (stale, stale))
+    assert store.cleanup(max_age_seconds=7 * 86400) == 1
+    with pytest.raises(RunNotFoundError):
+        store.get(old_run)
+    assert store.get(fresh_run)["status"] == "running"
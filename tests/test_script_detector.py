@@ -0,0 +1,29 @@
+from app.services.script_detector import is_contaminated, scan_quest, scan_text
+
+
+def test_clean_russian_text():
+    stats = scan_text("Вы входите в зал, где правил Карл XII. Ёлка горит — 3 свечи!")
+    assert not is_contaminated(stats)
+    assert stats["words"] == 11
+
+
+def test_detects_latin_cjk_and_homoglyphs():
+    stats = scan_text("Он tries to escape, оставляя символ 不断 и стрaнный след.")
+    assert stats["latin_words"] == 3
+    assert stats["cjk_chars"] == 2
+    assert stats["mixed_words"] == 1  # латинская «a» в слове «стрaнный»
+    assert is_contaminated(stats)
+
+
+def test_detects_other_scripts():
+    assert scan_text("Слово λόγος")["other_chars"] == 5
+
+
+def test_scan_quest_reports_only_contaminated_scenes_including_choices():
+    quest = {"scenes": [
+        {"scene_id": "a", "text": "Чистый текст.", "choices": [{"text": "Идти"}]},
+        {"scene_id": "b", "text": "Чистый текст.", "choices": [{"text": "Go north"}]},
+    ]}
+    result = scan_quest(quest)
+    assert list(result) == ["b"]
+    assert result["b"]["latin_words"] == 2
@@ -0,0 +1,68 @@
+import json
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, patch
+
+import pytest
+
+from app.services.json_stream import JsonStringFieldStreamer
+from app.services.quest_generator import _call_llm
+
+
+def feed_all(streamer, chunks):
+    return "".join(streamer.feed(chunk) for chunk in chunks)
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 1000])
+def test_streamer_decodes_field_split_anywhere(size):
+    """Значение поля собирается одинаково при любой нарезке ответа на куски."""
+    value = 'Строка с "кавычками", \\ слэшем,\nпереводом и эмодзи 😀 é'
+    payload = json.dumps({"text": value, "choices_text": ["a", "b"]})  # ASCII-экранирование \\uXXXX
+    chunks = [payload[i:i + size] for i in range(0, len(payload), size)]
+    streamer = JsonStringFieldStreamer("text")
+    assert feed_all(streamer, chunks) == value
+    assert streamer.finished
+
+
+def test_streamer_ignores_other_fields_and_code_fence():
+    streamer = JsonStringFieldStreamer("text")
+    chunks = ['```json\n{"choices_text": ["x"], ', '"te', 'xt"  :  "При', 'вет"}\n```']
+    assert feed_all(streamer, chunks) == "Привет"
+    assert streamer.feed(' "text": "еще"') == ""
+
+
+def _chunk(content=None, usage=None):
+    choices = [SimpleNamespace(delta=SimpleNamespace(content=content))] if content is not None else []
+    return SimpleNamespace(choices=choices, usage=usage)
+
+
+class FakeStream:
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._chunks)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+@patch("app.services.llm_clients.openai.AsyncOpenAI")
+def test_call_llm_streams_openai_deltas(mock_openai):
+    """С on_delta запрос идет потоком, куски передаются в колбэк, а результат не меняется."""
+    raw_response = SimpleNamespace(headers={})
+    raw_response.parse = AsyncMock(return_value=FakeStream(
+        [_chunk('{"text": '), _chunk('"Привет"}'), _chunk(usage=SimpleNamespace(total_tokens=12))]
+    ))
+    create = AsyncMock(return_value=raw_response)
+    mock_openai.return_value.chat.completions.with_raw_response.create = create
+
+    received = []
+    result = _call_llm("промпт", "openai", "key", "model", on_delta=received.append)
+
+    assert result == '{"text": "Привет"}'
+    assert received == ['{"text": ', '"Привет"}']
+    assert create.call_args.kwargs["stream"] is True
+    assert create.call_args.kwargs["stream_options"] == {"include_usage": True}
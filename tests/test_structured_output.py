@@ -0,0 +1,81 @@
+import json
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import httpx
+import openai
+import pytest
+
+from app.services import quest_generator
+from app.services.quest_generator import _call_llm
+from app.services.structured_output import (
+    RESPONSE_SCHEMAS,
+    gemini_generation_config,
+    llama_response_format,
+    normalize_json_response,
+    openai_response_format,
+    parse_json_lenient,
+)
+
+
+@pytest.mark.parametrize("raw, expected", [
+    ('Вот квест:\n```json\n{"text": "Привет", "choices_text": ["a",]}\n```', {"text": "Привет", "choices_text": ["a"]}),
+    ('{"text": "строка\nс переводом"} Надеюсь, подойдет!', {"text": "строка\nс переводом"}),
+    ('{"scenes": [{"scene_id": "s1", "text": "ok"}, {"scene_id": "s2", "text": "обор', {"scenes": [{"scene_id": "s1", "text": "ok"}, {"scene_id": "s2", "text": "обор"}]}),
+    ('{"a": 1, "b":', {"a": 1}),
+])
+def test_lenient_parser_repairs_common_model_errors(raw, expected):
+    assert parse_json_lenient(raw) == expected
+
+
+def test_lenient_parser_rejects_text_without_json():
+    with pytest.raises(ValueError):
+        parse_json_lenient("Извините, я не могу помочь.")
+    # Валидный ответ не переписывается, невосстановимый возвращается как есть
+    assert normalize_json_response('{"ok": true}') == '{"ok": true}'
+    assert normalize_json_response("нет json") == "нет json"
+
+
+def test_schemas_are_strict_for_every_object():
+    def objects(schema):
+        if isinstance(schema, dict):
+            if schema.get("type") == "object":
+                yield schema
+            for value in schema.values():
+                yield from objects(value)
+
+    for name, schema in RESPONSE_SCHEMAS.items():
+        for obj in objects(schema):
+            assert obj["additionalProperties"] is False and set(obj["required"]) == set(obj["properties"]), name
+    assert openai_response_format("skeleton")["json_schema"]["strict"] is True
+    assert "additionalProperties" not in json.dumps(gemini_generation_config("scene_detail"))
+    assert llama_response_format("scene_detail")["schema"] == RESPONSE_SCHEMAS["scene_detail"]
+
+
+def _completion(content):
+    raw_response = MagicMock()
+    raw_response.headers = {}
+    raw_response.parse = AsyncMock(return_value=SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=None,
+    ))
+    return raw_response
+
+
+@patch("app.services.llm_clients.openai.AsyncOpenAI")
+def test_openai_gets_schema_and_falls_back_to_json_mode(mock_openai, monkeypatch):
+    """Схема уходит в structured outputs; модель, которая ее отклонила, дальше работает в JSON mode."""
+    monkeypatch.setattr(quest_generator, "_schema_unsupported", set())
+    rejected = openai.BadRequestError(
+        "response_format json_schema is not supported", response=httpx.Response(400, request=httpx.Request("POST", "https://api.openai.com")), body=None,
+    )
+    create = AsyncMock(side_effect=[_completion('{"text": "a", "choices_text": []}'), rejected, _completion('{"text": "b",}')])
+    mock_openai.return_value.chat.completions.with_raw_response.create = create
+
+    assert _call_llm("промпт 1", "openai", "key", "gpt-4o-mini", schema="scene_detail") == '{"text": "a", "choices_text": []}'
+    assert create.call_args.kwargs["response_format"]["type"] == "json_schema"
+
+    # Висячая запятая исправлена без повторного запроса
+    assert json.loads(_call_llm("промпт 2", "openai", "key", "gpt-3.5-turbo", schema="scene_detail")) == {"text": "b"}
+    assert create.call_count == 3
+    assert create.call_args.kwargs["response_format"] == {"type": "json_object"}
+    assert ("openai", "gpt-3.5-turbo") in quest_generator._schema_unsupported
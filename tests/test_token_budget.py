@@ -0,0 +1,38 @@
+from app.services.token_budget import (
+    LOCAL_N_CTX,
+    StageBudget,
+    estimate_tokens,
+    get_stage_budget,
+    split_by_tokens,
+    truncate_to_tokens,
+)
+
+
+def test_estimate_distinguishes_cyrillic_and_latin():
+    assert estimate_tokens("а" * 300) == 101
+    assert estimate_tokens("a" * 300) == 76
+
+
+def test_truncate_keeps_head_or_tail_on_sentence_boundary():
+    text = " ".join(f"Предложение номер {i}." for i in range(100))
+    head = truncate_to_tokens(text, 50)
+    tail = truncate_to_tokens(text, 50, keep_tail=True)
+    assert estimate_tokens(head) <= 50 and estimate_tokens(tail) <= 50
+    assert head.startswith("Предложение номер 0.") and head.endswith(".…")
+    assert tail.startswith("…Предложение") and tail.endswith("номер 99.")
+    assert truncate_to_tokens("Коротко.", 50) == "Коротко."
+
+
+def test_split_by_tokens_covers_whole_text():
+    text = "\n".join("Абзац " + "слово " * 40 for _ in range(6)) + "\n" + "х" * 2000
+    parts = split_by_tokens(text, 120)
+    assert "".join(parts) == text
+    assert all(estimate_tokens(part) <= 120 for part in parts)
+
+
+def test_stage_budget_env_override_and_local_context(monkeypatch):
+    monkeypatch.setenv("TOKEN_BUDGET_WRITER", "5000:3000")
+    assert get_stage_budget("writer", "openai") == StageBudget(5000, 3000)
+    local = get_stage_budget("writer", "local")
+    assert local.output_tokens == LOCAL_N_CTX // 2
+    assert local.input_tokens + local.output_tokens < LOCAL_N_CTX